@@ -70,12 +70,22 @@ def download_urls(url_list,download_folder_root,zip=False):
                     print('downloading ' + files[i]['name'] + ' to ' + download_folder)
                     urllib.request.urlretrieve(files[i]['url'],download_folder + files[i]['name'])
 
-def DownloadFile(url,filename):
-    r = requests.get(url)
-    with open(filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024): 
-            if chunk: # filter out keep-alive new chunks
-                f.write(chunk)
+def DownloadFile(url,filename,buffer_size=8*2**20):
+    # stream the response straight into one reusable buffer instead of holding the whole file in memory
+    r = requests.get(url, stream=True)
+    try:
+        # don't save an error page under the data file's name
+        r.raise_for_status()
+        r.raw.decode_content = True
+        buffer = memoryview(bytearray(buffer_size))
+        with open(filename, 'wb') as f:
+            while True:
+                n = r.raw.readinto(buffer)
+                if not n:
+                    break
+                f.write(buffer[:n])
+    finally:
+        r.close()
     return 
 
 def download_aop_files(data_product_id,site,year=None,download_folder='./data',match_string=None):
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Shared pytest fixtures for the download module tests, which run against the local stand-in
+for the NEON Data API in neon_mock_api.py (no network access needed).
+"""
+
+import pytest
+
+import neon_mock_api
+
+def chm_fixtures(ncols=2, nrows=2, size=10**4, site='JORN', month='2019-08'):
+    # synthetic CHM listing of a grid of tiles
+    names = neon_mock_api.aop_tile_names('D14', site, 'DP3', 'CHM.tif', 314000, 3610000, ncols, nrows)
+    return neon_mock_api.synthetic_fixtures({'DP3.30015.001': {site: {month: [(n, size) for n in names]}}})
+
+@pytest.fixture
+def mock_api():
+    # a function starting a MockNeonApi (stopped after the test); defaults to a 2 x 2 grid of CHM tiles
+    servers = []
+    def start(fixtures=None, **options):
+        mock = neon_mock_api.MockNeonApi(fixtures if fixtures is not None else chm_fixtures(), **options)
+        mock.start()
+        servers.append(mock)
+        return mock
+    yield start
+    for mock in servers:
+        mock.stop()
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Batch download of several NEON AOP data products, sites and years as a single job, using the
+AopApiHandler in neon_aop_download.py.
+
+A job spec lists products x sites x years (plus an optional tile filter). The scheduler plans every
+file up front, interleaves the downloads across products and sites, caps the total bandwidth and
+disk usage, and records progress in a state file so an interrupted job picks up where it stopped.
+
+Usage:
+
+    import neon_aop_batch as neon_batch
+    job = neon_batch.BatchJob(products=['DP3.30015.001','DP3.30024.001','DP3.30006.001','DP1.30003.001'],
+                              sites=['SERC','JORN'], years=['2021','2022'],
+                              download_folder='./data/batch')
+    scheduler = neon_batch.BatchScheduler(job, state_file='./data/batch/job_state.json',
+                                          max_workers=8, max_bandwidth=200*10**6, max_disk_bytes=2*10**12)
+    scheduler.run()
+"""
+
+import os, json, time, threading, itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from neon_aop_download import AopApiHandler, DownloadPlan, RateLimiter, print_download_size
+
+class BatchJob:
+    """
+    BatchJob describes a multi-product, multi-site download
+    --------
+    Inputs:
+        products: list of data product codes (eg. ['DP3.30015.001','DP3.30024.001'])
+        sites: list of 4-digit NEON site codes, or 'all' for every site where the product is available
+        years (optional): list of years (eg. ['2021','2022']); default (None) is all years
+        download_folder (optional): root folder; files go in <download_folder>/<product>/<site>/<year>
+        match_string, bbox, points, polygon, buffer (optional): file / tile filter applied to every
+            product and site (see AopApiHandler.build_download_plan)
+    """
+    def __init__(self, products, sites, years=None, download_folder='./data', match_string=None,
+                 bbox=None, points=None, polygon=None, buffer=0):
+        self.products = list(products)
+        self.sites = sites if sites == 'all' else list(sites)
+        self.years = [str(year) for year in years] if years else None
+        self.download_folder = download_folder
+        self.match_string = match_string
+        self.bbox = bbox
+        self.points = points
+        self.polygon = polygon
+        self.buffer = buffer
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(**spec)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def folder(self, product, site, year=None):
+        if year is None:
+            return os.path.join(self.download_folder, product, site)
+        return os.path.join(self.download_folder, product, site, year)
+
+class BatchScheduler:
+    """
+    BatchScheduler plans and runs a BatchJob
+    --------
+    Inputs:
+        job: BatchJob
+        state_file: json file recording the plan (progress is appended to state_file + '.progress'); 
+            rerunning with the same state_file skips the catalog queries and the completed files
+        handler (optional): AopApiHandler to use; by default one is created with token, max_workers
+            and max_bandwidth (max_bandwidth also caps a given handler)
+        token (optional): NEON API token
+        max_workers (optional): number of files downloaded at once, across all products and sites; default = 4
+        max_bandwidth (optional): cap on the total download rate, in bytes/s
+        max_disk_bytes (optional): cap on the bytes this job writes; files beyond it, or beyond the free space on
+            disk (less the handler's min_free_bytes), are deferred to a later run
+        order, near, products (optional): download in this order instead of interleaving the products and
+            sites, eg. order='product' to fetch every DTM before the point clouds (see DownloadPlan.prioritize)
+    """
+    def __init__(self, job, state_file, handler=None, token=None, max_workers=4, max_bandwidth=None, max_disk_bytes=None,
+                 order=None, near=None, products=None):
+        self.job = job
+        self.order = order if order is not None or near is None else 'distance'
+        self.near = near
+        self.products = products
+        self.state_file = state_file
+        self.max_workers = max_workers
+        self.max_disk_bytes = max_disk_bytes
+        if handler is None:
+            handler = AopApiHandler(token=token, max_workers=max_workers, max_bandwidth=max_bandwidth)
+        elif max_bandwidth:
+            # cap the given handler too (replacing its own cap)
+            handler.bandwidth = RateLimiter(max_bandwidth, max(max_bandwidth, handler.buffer_size))
+        self.handler = handler
+        self._lock = threading.Lock()
+        self.progress_file = state_file + '.progress'
+        self.state = self._load_state()
+
+    def _load_state(self):
+        # round-trip the spec through json so tuples (eg. bbox) compare equal to the saved lists
+        state = {'job': json.loads(json.dumps(self.job.to_dict())), 'groups': None, 'completed': {}, 'failed': {}}
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                saved = json.load(f)
+            if saved.get('job') != state['job']:
+                print('WARNING: job spec changed since ' + self.state_file + ' was written; planning again')
+                if os.path.exists(self.progress_file):
+                    os.remove(self.progress_file)
+                return state
+            state['groups'] = saved['groups']
+        # replay the progress log, one json line per finished (or failed) file
+        if os.path.exists(self.progress_file):
+            with open(self.progress_file, 'r+b') as f:
+                log = f.read()
+                # drop a last line cut short by an interruption, so new records don't run on from it
+                complete = log.rfind(b'\n') + 1
+                if complete < len(log):
+                    f.truncate(complete)
+            for line in log[:complete].decode().splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'error' in record:
+                    state['failed'][record['path']] = record['error']
+                else:
+                    state['completed'][record['path']] = record['bytes']
+                    state['failed'].pop(record['path'], None)
+        return state
+
+    def _save_state(self):
+        # the plan is written once; progress goes to the append-only log in _record
+        folder = os.path.dirname(self.state_file)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump({'job': self.state['job'], 'groups': self.state['groups']}, f)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def _record(self, record):
+        with self._lock:
+            with open(self.progress_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            if 'error' in record:
+                self.state['failed'][record['path']] = record['error']
+            else:
+                self.state['completed'][record['path']] = record['bytes']
+                self.state['failed'].pop(record['path'], None)
+
+    def plan(self):
+        """
+        plan lists every file of the job, grouped by (product, site); the groups are stored in the
+        state file, so a restarted job does not query the catalog again
+        """
+        if self.state['groups'] is not None:
+            return self.state['groups']
+
+        job = self.job
+        groups = []
+        for product in job.products:
+            sites = self.handler.list_sites_by_product(product) if job.sites == 'all' else job.sites
+            for site in sites:
+                plan = DownloadPlan()
+                for year in (job.years or [None]):
+                    year_plan = self.handler.build_download_plan(product, site, year, job.folder(product, site, year),
+                                                                 match_string=job.match_string, bbox=job.bbox,
+                                                                 points=job.points, polygon=job.polygon, buffer=job.buffer)
+                    plan.files.extend(year_plan.files)
+                if len(plan):
+                    groups.append({'product': product, 'site': site, 'files': plan.files})
+        self.state['groups'] = groups
+        self._save_state()
+        return groups
+
+    def save_lockfile(self, filename):
+        """
+        save_lockfile writes every planned file of the job (urls, sizes, checksums, release) to filename;
+        AopApiHandler.replay_lockfile fetches exactly those files later without querying the catalog
+        """
+        plan = DownloadPlan([f for group in self.plan() for f in group['files']])
+        return plan.save_lockfile(filename, self.job.download_folder, release=self.handler.release_tag or None,
+                                  job=self.job.to_dict())
+
+    def _is_done(self, entry):
+        size = self.state['completed'].get(entry['path'])
+        return size is not None and os.path.exists(entry['path']) and os.path.getsize(entry['path']) == size
+
+    def pending(self):
+        """
+        pending returns the files still to download, in the scheduler's order if it has one, otherwise 
+        interleaved round-robin across the (product, site) groups so every product and site makes progress together
+        """
+        queues = [[f for f in group['files'] if not self._is_done(f)] for group in self.plan()]
+        pending = [f for batch in itertools.zip_longest(*queues) for f in batch if f is not None]
+        if self.order is not None:
+            pending = DownloadPlan(pending).prioritize(self.order, self.near, self.products).files
+        return pending
+
+    def _within_disk_cap(self, pending):
+        # keep files (in scheduling order) until the job's bytes on disk would exceed max_disk_bytes
+        if self.max_disk_bytes is None:
+            return pending, []
+        used = sum(self.state['completed'].values())
+        keep, deferred = [], []
+        for entry in pending:
+            if used + entry['size'] <= self.max_disk_bytes:
+                keep.append(entry)
+                used += entry['size']
+            else:
+                deferred.append(entry)
+        return keep, deferred
+
+    def _download(self, entry):
+        folder = os.path.dirname(entry['path'])
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        return self.handler.download_one(entry, folder)
+
+    def run(self, on_complete=None):
+        """
+        run downloads all pending files; returns a summary dictionary of files downloaded, failed and
+        deferred (by max_disk_bytes), bytes and elapsed seconds; on_complete (optional) is called with 
+        each file's plan entry as soon as it is downloaded
+        """
+        pending, deferred = self._within_disk_cap(self.pending())
+        # also defer what won't fit in the free space of the target filesystem(s)
+        fits = DownloadPlan(pending).preflight(min_free_bytes=self.handler.min_free_bytes, on_insufficient='trim')
+        if len(fits) < len(pending):
+            kept = set(id(f) for f in fits)
+            deferred = [f for f in pending if id(f) not in kept] + deferred
+            pending = fits.files
+        print_download_size(sum(f['size'] for f in pending), len(pending))
+        if deferred:
+            print('WARNING: ' + str(len(deferred)) + ' files (' + str(sum(f['size'] for f in deferred)) +
+                  ' bytes) deferred, they would exceed max_disk_bytes or the free disk space')
+
+        start = time.perf_counter()
+        total_bytes = 0
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._download, entry): entry for entry in pending}
+            for future in as_completed(futures):
+                entry = futures[future]
+                try:
+                    nbytes = future.result()
+                except (requests.exceptions.RequestException, OSError) as e:
+                    print(entry['name'] + ': ' + str(e))
+                    failed.append(entry['name'])
+                    self._record({'path': entry['path'], 'error': str(e)})
+                    continue
+                total_bytes += nbytes
+                # the size on disk, not the bytes transferred: a file linked from the mirror transfers none
+                self._record({'path': entry['path'], 'bytes': os.path.getsize(entry['path'])})
+                self.handler.call_on_complete(on_complete, entry, None)
+        elapsed = time.perf_counter() - start
+        self.handler.save_manifests()
+
+        summary = {'files': len(pending) - len(failed),
+                   'failed': failed,
+                   'deferred': [f['name'] for f in deferred],
+                   'bytes': total_bytes,
+                   'seconds': elapsed}
+        print(f"downloaded {summary['files']} files ({round(total_bytes/(10**6),2)} MB) in {round(elapsed,1)} s; "
+              f"{len(failed)} failed, {len(deferred)} deferred")
+        return summary
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the NEON AOP download strategies against the local API stand-in in neon_mock_api.py,
+so changes to download_file, download_aop_files or AopApiHandler can be compared on the same workloads.
+
+Each scenario starts a MockNeonApi with a synthetic listing and network conditions:
+    many_small    many small KML tile boundaries (DPQA), where per-request overhead dominates
+    few_huge      a few large flightline reflectance .h5 files, where streaming throughput dominates
+    high_latency  medium-size tiles behind a 150 ms round trip
+    flaky         tiles on a link that fails 5% of requests and drops 10% of transfers part way
+
+and every strategy downloads the whole listing into a temporary folder:
+    functions          neon_aop_download_functions.download_aop_files (serial)
+    handler_serial     AopApiHandler, max_workers=1
+    handler_parallel   AopApiHandler, max_workers=8
+    async              AsyncAopApiHandler, max_concurrency=16 (if aiohttp is installed)
+
+reporting wall time, bytes, throughput, requests served by the mock (and faults it injected), files
+that failed, and the peak Python memory allocated during the run (tracemalloc).
+
+Usage:
+
+    python neon_aop_benchmark.py
+    python neon_aop_benchmark.py --scenarios many_small flaky --strategies handler_serial handler_parallel --repeat 3
+    python neon_aop_benchmark.py --scale 0.1 --json results.json
+
+or from Python:
+
+    import neon_aop_benchmark
+    results = neon_aop_benchmark.run_benchmarks(scenarios=['few_huge'], scale=0.25)
+"""
+
+import os, io, sys, json, time, shutil, tempfile, argparse, tracemalloc, contextlib, asyncio
+
+import neon_mock_api
+import neon_aop_download_functions
+from neon_aop_download import AopApiHandler
+
+def _scenario(product, site, month, files, description, **mock_options):
+    return {'product': product, 'site': site, 'month': month, 'files': files, 'description': description,
+            'mock_options': mock_options}
+
+def make_scenarios(scale=1.0):
+    """
+    make_scenarios returns the benchmark workloads; scale multiplies the number of small files and
+    the size of the large ones (eg. 0.1 for a quick run)
+    """
+    def count(n):
+        return max(1, int(n * scale))
+    boundaries = neon_mock_api.aop_tile_names('D02', 'SERC', 'DPQA', 'boundary.kml', 360000, 4300000, 25, 20)
+    flightlines = ['NEON_D14_JORN_DP1_20190826_16' + str(1421 + 100*i) + '_reflectance.h5' for i in range(3)]
+    tiles = neon_mock_api.aop_tile_names('D14', 'JORN', 'DP3', 'CHM.tif', 314000, 3610000, 10, 10)
+    return {
+        'many_small': _scenario('DP1.30003.001', 'SERC', '2022-06', [(n, 4*10**3) for n in boundaries[:count(500)]],
+                                'many small KML tile boundaries'),
+        'few_huge': _scenario('DP1.30006.001', 'JORN', '2019-08', [(n, int(200*10**6 * scale)) for n in flightlines],
+                              'a few large flightline .h5 files'),
+        'high_latency': _scenario('DP3.30015.001', 'JORN', '2019-08', [(n, 200*10**3) for n in tiles[:count(60)]],
+                                  'medium tiles behind a 150 ms round trip', latency=0.15),
+        'flaky': _scenario('DP3.30015.001', 'JORN', '2019-08', [(n, 10**6) for n in tiles[:count(40)]],
+                           '5% failed requests, 10% dropped transfers', error_rate=0.05, drop_rate=0.1, seed=42),
+    }
+
+def _run_functions(base_url, scenario, folder):
+    module = neon_aop_download_functions
+    module.NEON_API_URL = base_url
+    module._catalogs.clear()
+    module.download_aop_files(scenario['product'], scenario['site'], scenario['month'][:4], folder, check_size=False)
+
+def _run_handler(max_workers):
+    def run(base_url, scenario, folder):
+        handler = AopApiHandler(base_url=base_url, max_workers=max_workers)
+        return handler.download_aop_files(scenario['product'], scenario['site'], scenario['month'][:4], folder,
+                                          check_size=False)
+    return run
+
+def _run_async(base_url, scenario, folder):
+    import neon_aop_download_async
+    async def run():
+        async with neon_aop_download_async.AsyncAopApiHandler(base_url=base_url, max_concurrency=16) as handler:
+            return await handler.download_aop_files(scenario['product'], scenario['site'], scenario['month'][:4], folder)
+    return asyncio.run(run())
+
+STRATEGIES = {
+    'functions': _run_functions,
+    'handler_serial': _run_handler(1),
+    'handler_parallel': _run_handler(8),
+    'async': _run_async,
+}
+
+def _available_strategies():
+    try:
+        import aiohttp
+    except ImportError:
+        return [name for name in STRATEGIES if name != 'async']
+    return list(STRATEGIES)
+
+def run_benchmark(mock, scenario, strategy, trace_memory=True, quiet=True):
+    """
+    run_benchmark downloads a scenario's listing once with one strategy; returns a result dictionary
+    """
+    folder = tempfile.mkdtemp(prefix='neon_benchmark_')
+    mock.reset_stats()
+    if trace_memory:
+        tracemalloc.start()
+    output = io.StringIO()
+    error = None
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output if quiet else sys.stdout):
+            STRATEGIES[strategy](mock.base_url, scenario, folder)
+    except Exception as e:
+        error = repr(e)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    # count what actually landed on disk at the right size
+    expected = {f['name']: f['size'] for f in mock.files.values()}
+    complete = 0
+    nbytes = 0
+    for name, size in expected.items():
+        path = os.path.join(folder, name)
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            complete += 1
+            nbytes += size
+    shutil.rmtree(folder, ignore_errors=True)
+    stats = mock.stats()
+    return {'strategy': strategy, 'seconds': seconds, 'files': complete, 'failed': len(expected) - complete,
+            'bytes': nbytes, 'throughput': nbytes / seconds if seconds > 0 else 0.0,
+            'requests': stats['requests'], 'api_requests': stats['products'] + stats['sites'] + stats['data'],
+            'bytes_sent': stats['bytes_sent'], 'faults': stats['errors_injected'] + stats['drops'],
+            'peak_memory': peak, 'error': error}
+
+def run_benchmarks(scenarios=None, strategies=None, scale=1.0, repeat=1, trace_memory=True, quiet=True):
+    """
+    run_benchmarks runs every strategy on every scenario (repeat times each) and prints a report
+    --------
+    Inputs (all optional):
+        scenarios: names from make_scenarios; default is all of them
+        strategies: names from STRATEGIES; default is all that can run here
+        scale: workload scale (see make_scenarios); default = 1
+        repeat: runs per scenario and strategy; the report shows each run; default = 1
+        trace_memory: measure peak memory with tracemalloc (slows the run a little); default = True
+        quiet: hide the download modules' own printing; default = True
+    --------
+    Returns:
+    --------
+    list of result dictionaries, one per run, with the scenario name added
+    """
+    all_scenarios = make_scenarios(scale)
+    scenarios = scenarios or list(all_scenarios)
+    strategies = strategies or _available_strategies()
+    results = []
+    for name in scenarios:
+        scenario = all_scenarios[name]
+        fixtures = neon_mock_api.synthetic_fixtures({scenario['product']: {scenario['site']: {scenario['month']: scenario['files']}}})
+        with neon_mock_api.MockNeonApi(fixtures, **scenario['mock_options']) as mock:
+            # compute the payload checksums up front, so the first strategy isn't charged for them
+            for key in mock.documents:
+                mock.render(key)
+            total = sum(size for _, size in scenario['files'])
+            print('\n' + name + ': ' + scenario['description'] + ' (' + str(len(scenario['files'])) + ' files, ' +
+                  str(round(total/10**6, 1)) + ' MB)')
+            print(_report_line(None))
+            for strategy in strategies:
+                for run in range(repeat):
+                    result = run_benchmark(mock, scenario, strategy, trace_memory, quiet)
+                    result['scenario'] = name
+                    results.append(result)
+                    print(_report_line(result))
+    return results
+
+def _report_line(result):
+    if result is None:
+        return (f"{'strategy':<18}{'wall s':>9}{'MB/s':>9}{'files':>7}{'failed':>7}{'requests':>10}"
+                f"{'faults':>8}{'peak MB':>9}")
+    peak = '-' if result['peak_memory'] is None else str(round(result['peak_memory']/10**6, 1))
+    line = (f"{result['strategy']:<18}{result['seconds']:>9.2f}{result['throughput']/10**6:>9.2f}{result['files']:>7}"
+            f"{result['failed']:>7}{result['requests']:>10}{result['faults']:>8}{peak:>9}")
+    if result['error']:
+        line += '  ' + result['error']
+    return line
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark NEON AOP download strategies against a local mock API')
+    parser.add_argument('--scenarios', nargs='+', choices=list(make_scenarios()), help='default: all')
+    parser.add_argument('--strategies', nargs='+', choices=list(STRATEGIES), help='default: all that can run')
+    parser.add_argument('--scale', type=float, default=1.0, help='workload scale, eg. 0.1 for a quick run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario and strategy')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace memory (slightly faster)")
+    parser.add_argument('--verbose', action='store_true', help="show the download modules' output")
+    parser.add_argument('--json', help='also write the results to this json file')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scenarios, args.strategies, args.scale, args.repeat,
+                             trace_memory=not args.no_memory, quiet=not args.verbose)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -6,18 +6,1274 @@ Created on Mon Apr  8 08:18:00 2019
 Functions to display available urls and download NEON AOP data using the NEON Data API.
 """
 
-import requests, urllib, os
+import requests, urllib3, os, errno, re, math, time, threading, asyncio, json, hashlib, random, zlib, shutil, logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# responses that are worth retrying after a pause
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# name of the file, kept in each download folder, that records the checksum verification of each download
+MANIFEST_NAME = 'neon_manifest.json'
+
+# read buffer for streaming downloads; large blocks keep the per-chunk Python overhead negligible on multi-GB files
+BUFFER_SIZE = 8 * 2**20
+
+# version of the lockfile layout written by DownloadPlan.save_lockfile
+LOCKFILE_VERSION = 1
+
+# root of the NEON Data API; set the NEON_API_URL environment variable (or pass base_url) to use another server,
+# eg. the local stand-in in neon_mock_api.py
+NEON_API_URL = os.environ.get('NEON_API_URL', 'https://data.neonscience.org/api/v0/')
+
+def make_session(pool_size=10, max_retries=3, status_forcelist=RETRY_STATUS):
+    """
+    make_session creates a requests.Session with keep-alive connection pooling and a retry adapter
+    --------
+    Inputs:
+        pool_size: number of connections kept open per host; default = 10
+        max_retries: number of retries (with backoff) on connection errors and status_forcelist responses; default = 3
+        status_forcelist: response codes the adapter retries; pass () to handle them yourself (as AopApiHandler does)
+    """
+    session = requests.Session()
+    retry = Retry(total=max_retries, backoff_factor=0.5, status_forcelist=list(status_forcelist),
+                  respect_retry_after_header=bool(status_forcelist))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class ChecksumError(requests.exceptions.RequestException):
+    """a downloaded file did not match the md5 / crc32 reported by the API"""
+
+class EndpointError(requests.exceptions.RequestException):
+    """a file could not be fetched from any of the endpoints (see EndpointPool)"""
+
+def _same_checksum(a, b):
+    # the API may report crc32 with or without a 0x prefix
+    if a is None or b is None:
+        return False
+    a, b = str(a).lower(), str(b).lower()
+    if a.startswith('0x') or b.startswith('0x'):
+        return int(a, 16) == int(b, 16)
+    return a == b
+
+class StreamChecksum:
+    """
+    StreamChecksum keeps a running md5 and/or crc32 of a file as it is written, so a download can be
+    verified against the checksums in the API data['files'] without reading the file a second time
+    """
+    def __init__(self, md5=None, crc32=None):
+        self.expected_md5 = md5
+        self.expected_crc32 = crc32
+        self.reset()
+
+    def reset(self):
+        # start over, eg. when a resumed transfer is sent from the beginning again
+        self.nbytes = 0
+        self._md5 = hashlib.md5() if self.expected_md5 else None
+        self._crc32 = 0 if self.expected_crc32 else None
+
+    def update_from_file(self, filename, buffer_size=BUFFER_SIZE):
+        # add the bytes already in filename, eg. the part of a resumed download fetched earlier
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(buffer_size), b''):
+                self.update(block)
+
+    def update(self, block):
+        self.nbytes += len(block)
+        if self._md5 is not None:
+            self._md5.update(block)
+        if self._crc32 is not None:
+            self._crc32 = zlib.crc32(block, self._crc32)
+
+    def matches(self):
+        # True / False once verified, None if the API gave no checksum to verify against
+        if self._md5 is not None:
+            return _same_checksum(self._md5.hexdigest(), self.expected_md5)
+        if self._crc32 is not None:
+            return _same_checksum(format(self._crc32, '08x'), self.expected_crc32)
+        return None
+
+def quarantine_file(filename, source=None):
+    # move a download that failed verification (filename, or its source, eg. its .part file) into a 
+    # quarantine folder next to filename
+    quarantine_folder = os.path.join(os.path.dirname(filename), 'quarantine')
+    os.makedirs(quarantine_folder, exist_ok=True)
+    quarantined = os.path.join(quarantine_folder, os.path.basename(filename))
+    os.replace(source or filename, quarantined)
+    return quarantined
+
+def stream_to_file(r, f, buffer_size=BUFFER_SIZE, throttle=None, checksum=None, progress=None):
+    """
+    stream_to_file copies the body of a streamed (stream=True) response into an open binary file,
+    reading straight into one reusable buffer with readinto; returns the number of bytes written
+    throttle (optional) is called with the size of each block, eg. RateLimiter.consume to cap bandwidth
+    checksum (optional) is a StreamChecksum updated with every block as it is written
+    progress (optional) is called with the size of each block once it is written, eg. DownloadEvents.progress
+    """
+    r.raw.decode_content = True
+    buffer = memoryview(bytearray(buffer_size))
+    nbytes = 0
+    try:
+        while True:
+            n = r.raw.readinto(buffer)
+            if not n:
+                break
+            f.write(buffer[:n])
+            nbytes += n
+            if throttle is not None:
+                throttle(n)
+            if checksum is not None:
+                checksum.update(buffer[:n])
+            if progress is not None:
+                progress(n)
+    # report dropped connections the same way requests' iter_content does
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    return nbytes
+
+def preallocate(f, size):
+    # reserve disk space for the whole file up front; a full disk then fails before the transfer starts
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+
+class WaitClock:
+    """
+    WaitClock measures the wall-clock time during which at least one caller is waiting, so waits that
+    overlap (parallel workers, several hosts) are counted once; RateLimiters sharing a clock report their
+    combined throttled time in clock.seconds
+    """
+    def __init__(self):
+        self.seconds = 0.0
+        self._waiters = 0
+        self._mark = 0.0
+        self._lock = threading.Lock()
+
+    def waiting(self, delta):
+        # a caller starts (+1) or stops (-1) waiting
+        with self._lock:
+            now = time.monotonic()
+            if self._waiters:
+                self.seconds += now - self._mark
+            self._mark = now
+            self._waiters += delta
+
+class RateLimiter:
+    """
+    RateLimiter is a thread-safe token bucket that paces requests to the rate the API allows
+    --------
+    Inputs:
+        rate: requests per second to allow; default (None) is unlimited until the API reports a limit
+        capacity: largest burst of requests allowed at once; default = 10
+        clock: WaitClock to measure the time spent waiting with; default is one of its own
+    --------
+    After each response, update() reads the rate-limit headers (X-RateLimit-Limit, X-RateLimit-Remaining, 
+    X-RateLimit-Reset or their RateLimit-* equivalents): the steady rate is the limit over the window (the 
+    longest reset seen), bursts are capped at the limit, and an exhausted window pauses every caller until 
+    it resets. backoff() pauses every caller after a 429/5xx. acquire() blocks a thread, acquire_async() 
+    awaits in an event loop. The wall-clock time callers spent waiting is in throttled_seconds.
+    """
+    def __init__(self, rate=None, capacity=10, clock=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        # requests per window and window length (s), as reported by the API
+        self.limit = None
+        self.window = None
+        self.clock = clock if clock is not None else WaitClock()
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    @property
+    def throttled_seconds(self):
+        return self.clock.seconds
+
+    @staticmethod
+    def _header(headers, name):
+        for key in ('X-RateLimit-' + name, 'RateLimit-' + name):
+            value = headers.get(key)
+            if value is not None:
+                try:
+                    return float(value)
+                except ValueError:
+                    return None
+        return None
+
+    def _reserve(self):
+        # take a token if one is free; otherwise return the seconds to wait before trying again
+        with self._lock:
+            now = time.monotonic()
+            wait = self.paused_until - now
+            if wait <= 0:
+                if self.rate is None:
+                    self.requests += 1
+                    return 0.0
+                self.tokens = min(self._burst(), self.tokens + max(0.0, now - self.last) * self.rate)
+                self.last = max(self.last, now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return 0.0
+                wait = (1 - self.tokens) / self.rate
+            return wait
+
+    def acquire(self):
+        # block until a request may be sent
+        wait = self._reserve()
+        if not wait:
+            return
+        self.clock.waiting(1)
+        try:
+            while wait:
+                time.sleep(wait)
+                wait = self._reserve()
+        finally:
+            self.clock.waiting(-1)
+
+    async def acquire_async(self):
+        # as acquire, without blocking the event loop
+        wait = self._reserve()
+        if not wait:
+            return
+        self.clock.waiting(1)
+        try:
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self._reserve()
+        finally:
+            self.clock.waiting(-1)
+
+    def consume(self, amount):
+        # take amount tokens (eg. bytes), sleeping until the bucket has refilled; used as a bandwidth cap
+        if self.rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.clock.waiting(1)
+            try:
+                time.sleep(wait)
+            finally:
+                self.clock.waiting(-1)
+
+    def _burst(self):
+        # no more requests at once than the API allows in a whole window
+        return self.capacity if self.limit is None else max(1, min(self.capacity, self.limit))
+
+    def update(self, headers):
+        # adapt the rate to the limit the API reports, and wait out an exhausted window
+        limit = self._header(headers, 'Limit')
+        remaining = self._header(headers, 'Remaining')
+        reset = self._header(headers, 'Reset')
+        if remaining is None:
+            return
+        with self._lock:
+            if reset is not None and reset > 0:
+                # the reset counts down from the window length, so the longest one seen is the window
+                self.window = max(self.window or 0.0, reset)
+            if limit is not None and limit > 0 and self.window:
+                # a limit means nothing without its window, so it is only used once a reset has been seen
+                self.limit = limit
+                # keep a 10% margin so parallel workers don't overshoot the window
+                self.rate = 0.9 * limit / self.window
+            elif self.rate is None and reset:
+                self.rate = max(1.0, remaining) / reset
+            if remaining <= 0 and reset is not None:
+                # nothing left in this window: pause until it resets, then allow a fresh burst
+                self.paused_until = max(self.paused_until, time.monotonic() + reset)
+                self.tokens = float(self._burst())
+                self.last = self.paused_until
+            else:
+                self.tokens = min(self.tokens, remaining)
+
+    def backoff(self, attempt, retry_after=None, base=1.0, max_delay=60.0):
+        # pause all callers after a 429/5xx; honor Retry-After, otherwise exponential backoff with jitter
+        delay = None
+        if retry_after is not None:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                delay = None
+        if delay is None:
+            delay = min(max_delay, base * 2**attempt) * (0.5 + random.random())
+        with self._lock:
+            self.retries += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
+
+    def stats(self):
+        return {'requests': self.requests, 'retries': self.retries, 'throttled_seconds': self.throttled_seconds}
+
+class DownloadEvents:
+    """
+    DownloadEvents sends structured events about API requests and file transfers to pluggable sinks
+    --------
+    Every event is a dictionary with 'event', 'time' (unix seconds) and, by event:
+        start: name, url, path, size (expected bytes), host
+        progress: name, bytes, size, seconds, rate (bytes/s), eta (seconds, None if the size is unknown)
+        complete: name, path, bytes, seconds, rate, verified (True / None if there was no checksum); 
+                  bytes is 0 for a file linked from the mirror
+        error: name, path, bytes, seconds, error
+        failover: name, endpoint, error (a file that failed from one endpoint and is tried at the next)
+        request: url (without the token), host, status, seconds, attempt (0 for the first try)
+    A sink is any function taking the event dictionary: LoggingSink, JsonLinesSink, PrometheusTextfileSink, 
+    or your own. progress events are sent at most once every progress_interval seconds per file.
+    --------
+    Usage:
+    --------
+    neon_api = AopApiHandler(events=[LoggingSink(), JsonLinesSink('./data/download_events.jsonl')])
+    """
+    def __init__(self, sinks=None, progress_interval=1.0):
+        self.sinks = list(sinks) if sinks else []
+        self.progress_interval = progress_interval
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def emit(self, event, **fields):
+        if not self.sinks:
+            return
+        record = {'event': event, 'time': time.time()}
+        record.update(fields)
+        for sink in list(self.sinks):
+            try:
+                sink(record)
+            except Exception as e:
+                # a broken sink must not stop the download
+                print('WARNING: event sink ' + repr(sink) + ' failed: ' + str(e))
+
+    def progress(self, name, size=None, start=None):
+        # returns a function to call with the size of each block written; it sends throttled progress events
+        start = time.perf_counter() if start is None else start
+        state = {'bytes': 0, 'last': start}
+        def update(n):
+            state['bytes'] += n
+            now = time.perf_counter()
+            if now - state['last'] < self.progress_interval:
+                return
+            state['last'] = now
+            seconds = now - start
+            rate = state['bytes'] / seconds if seconds > 0 else 0.0
+            eta = (size - state['bytes']) / rate if size and rate > 0 else None
+            self.emit('progress', name=name, bytes=state['bytes'], size=size, seconds=seconds, rate=rate, eta=eta)
+        return update if self.sinks else None
+
+class LoggingSink:
+    """
+    LoggingSink writes download events to a logger (default: the 'neon_aop_download' logger); request 
+    and progress events are logged at DEBUG, start and complete at INFO, and errors at WARNING
+    """
+    def __init__(self, logger=None):
+        self.logger = logger if logger is not None else logging.getLogger('neon_aop_download')
+
+    def __call__(self, record):
+        event = record['event']
+        if event == 'start':
+            self.logger.info('downloading %s (%s)', record['name'], format_size(record['size'] or 0))
+        elif event == 'progress':
+            eta = ', eta ' + str(round(record['eta'])) + ' s' if record['eta'] is not None else ''
+            self.logger.debug('%s: %s at %s/s%s', record['name'], format_size(record['bytes']), 
+                              format_size(int(record['rate'])), eta)
+        elif event == 'complete':
+            self.logger.info('downloaded %s (%s in %.1f s, %s/s)', record['name'], format_size(record['bytes']), 
+                             record['seconds'], format_size(int(record['rate'])))
+        elif event == 'error':
+            self.logger.warning('download of %s failed after %.1f s: %s', record['name'], record['seconds'], record['error'])
+        elif event == 'failover':
+            self.logger.warning('%s failed from %s (%s), trying the next endpoint', record['name'], record['endpoint'], 
+                                record['error'])
+        elif event == 'request':
+            self.logger.debug('GET %s -> %s in %.3f s (attempt %d)', record['url'], record['status'], 
+                              record['seconds'], record['attempt'])
+
+class JsonLinesSink:
+    """
+    JsonLinesSink appends every download event as one json line to filename
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(line)
+
+class PrometheusTextfileSink:
+    """
+    PrometheusTextfileSink keeps running totals of the download events and writes them, in the Prometheus
+    text format, to filename (eg. in the node_exporter textfile collector directory); the file is rewritten
+    after every finished file and at most every write_interval seconds otherwise
+    --------
+    Metrics (prefix neon_download_):
+        files_total{status}, bytes_total, transfer_seconds_total, in_progress, last_rate_bytes_per_second,
+        requests_total{host,status}, request_seconds_total{host}, retries_total{host}
+    """
+    def __init__(self, filename, write_interval=10.0, prefix='neon_download'):
+        self.filename = filename
+        self.write_interval = write_interval
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+        self.files = {'complete': 0, 'error': 0}
+        self.bytes = 0
+        self.transfer_seconds = 0.0
+        self.in_progress = 0
+        self.last_rate = 0.0
+        self.requests = {}
+        self.request_seconds = {}
+        self.retries = {}
+
+    def __call__(self, record):
+        event = record['event']
+        with self._lock:
+            if event == 'start':
+                self.in_progress += 1
+            elif event in ('complete', 'error'):
+                self.in_progress -= 1
+                self.files[event] += 1
+                self.bytes += record['bytes'] or 0
+                self.transfer_seconds += record['seconds']
+                if event == 'complete':
+                    self.last_rate = record['rate']
+            elif event == 'request':
+                host = record['host']
+                key = (host, str(record['status']))
+                self.requests[key] = self.requests.get(key, 0) + 1
+                self.request_seconds[host] = self.request_seconds.get(host, 0.0) + record['seconds']
+                if record['attempt']:
+                    self.retries[host] = self.retries.get(host, 0) + 1
+            now = time.time()
+            if event in ('complete', 'error') or now - self._last_write >= self.write_interval:
+                self._last_write = now
+                self._write()
+
+    def _write(self):
+        p = self.prefix
+        lines = ['# TYPE ' + p + '_files_total counter']
+        lines += [p + '_files_total{status="' + status + '"} ' + str(n) for status, n in self.files.items()]
+        lines += ['# TYPE ' + p + '_bytes_total counter', p + '_bytes_total ' + str(self.bytes),
+                  '# TYPE ' + p + '_transfer_seconds_total counter', p + '_transfer_seconds_total ' + repr(self.transfer_seconds),
+                  '# TYPE ' + p + '_in_progress gauge', p + '_in_progress ' + str(self.in_progress),
+                  '# TYPE ' + p + '_last_rate_bytes_per_second gauge', p + '_last_rate_bytes_per_second ' + repr(self.last_rate),
+                  '# TYPE ' + p + '_requests_total counter']
+        lines += [p + '_requests_total{host="' + host + '",status="' + status + '"} ' + str(n) 
+                  for (host, status), n in sorted(self.requests.items())]
+        lines += ['# TYPE ' + p + '_request_seconds_total counter']
+        lines += [p + '_request_seconds_total{host="' + host + '"} ' + repr(seconds) 
+                  for host, seconds in sorted(self.request_seconds.items())]
+        lines += ['# TYPE ' + p + '_retries_total counter']
+        lines += [p + '_retries_total{host="' + host + '"} ' + str(n) for host, n in sorted(self.retries.items())]
+        # write to a temporary file and rename, so the collector never reads a half-written file
+        with open(self.filename + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.filename + '.tmp', self.filename)
+
+class ResponseCache:
+    """
+    ResponseCache is an on-disk cache of NEON API json responses (products/<dpid>, data/<dpid>/<site>/<month>)
+    --------
+    Inputs:
+        cache_dir: folder to store cached responses in
+        ttl: seconds a cached response is used without asking the API again; default = 3600
+        max_bytes: total size of the cache folder; least recently used entries are evicted beyond this; default = 500 MB
+    --------
+    Entries older than ttl are revalidated with If-None-Match / If-Modified-Since, so an unchanged 
+    document costs a 304 instead of a full download. The apiToken is stripped from the cache key 
+    (and never written to disk).
+    """
+    def __init__(self, cache_dir, ttl=3600, max_bytes=500*10**6):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # bytes written since the last eviction
+        self._added = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def cache_key(url):
+        # drop the apiToken so the same document is shared by every token (and the token isn't stored)
+        parts = urlparse(url)
+        query = [(k, v) for k, v in parse_qsl(parts.query) if k != 'apiToken']
+        return urlunparse(parts._replace(query=urlencode(query)))
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(self.cache_key(url).encode()).hexdigest() + '.json')
+
+    def get(self, url):
+        # return the cached entry ({'url', 'stored', 'etag', 'last_modified', 'body'}) or None
+        path = self._path(url)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # mark as recently used for the LRU eviction
+        os.utime(path)
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored'] < self.ttl
+
+    def revalidation_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url, body, headers=None):
+        headers = headers or {}
+        entry = {'url': self.cache_key(url),
+                 'stored': time.time(),
+                 'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified'),
+                 'body': body}
+        path = self._path(url)
+        tmp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+            size = f.tell()
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._added += size
+            added = self._added
+        # check the size every tenth of max_bytes written, rather than listing the folder on every put
+        if added >= self.max_bytes / 10:
+            self.evict()
+
+    def touch(self, url, entry):
+        # a 304 response: the cached body is still valid, restart its ttl
+        self.put(url, entry['body'], {'ETag': entry.get('etag'), 'Last-Modified': entry.get('last_modified')})
+
+    def evict(self):
+        # remove least recently used entries until the cache fits in max_bytes
+        with self._lock:
+            self._added = 0
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.cache_dir, name))
+
+class Endpoint:
+    """
+    Endpoint is one place the NEON AOP files can be fetched from: a mirror root (an http(s) url, eg. an 
+    institutional object store, or a local / NFS folder), or origin (the url the API returns). A file is 
+    found under a mirror root by its url path, eg. https://storage.googleapis.com/neon-aop-products/2019/... 
+    at <root>/neon-aop-products/2019/...
+    """
+    def __init__(self, root=None, name=None):
+        self.root = root
+        self.local = root is not None and urlparse(root).scheme not in ('http', 'https')
+        if self.local and root.startswith('file://'):
+            self.root = urlparse(root).path
+        self.name = name or (root if root is not None else 'origin')
+        self.latency = None
+        self.failures = 0
+        self.checked = 0.0
+
+    def source(self, url):
+        # where this endpoint holds the file at url
+        if self.root is None:
+            return url
+        path = urlparse(url).path.lstrip('/')
+        if self.local:
+            return os.path.join(self.root, *path.split('/'))
+        return self.root.rstrip('/') + '/' + path
+
+    def __repr__(self):
+        return 'Endpoint(' + repr(self.name) + ')'
+
+class EndpointPool:
+    """
+    EndpointPool chooses, for each file, the order in which to try an ordered list of endpoints: the 
+    healthy ones by measured latency (ties keep the listed order), then the ones that have been failing, 
+    with origin (the API url) last unless it is listed explicitly
+    --------
+    Inputs:
+        endpoints: list of mirror roots (http(s) urls, folders or file:// urls), Endpoint objects, or 
+            'origin' to place the API url somewhere other than last
+        probe_timeout (optional): seconds to wait for a latency probe; default = 5
+        probe_interval (optional): seconds between latency probes of an endpoint; default = 300
+        max_failures (optional): consecutive failed files after which an endpoint is considered down 
+            until its next probe; default = 3
+    --------
+    Latency is the time of a HEAD request to the root (any response below 500 counts as up), or of 
+    listing the folder for a local root. Files from every endpoint are verified against the API checksums.
+    --------
+    Usage:
+    --------
+    pool = EndpointPool(['https://objects.example.edu/neon', '/mnt/nfs/neon_cache'])
+    neon_api = AopApiHandler(endpoints=pool)
+    """
+    def __init__(self, endpoints, probe_timeout=5, probe_interval=300, max_failures=3):
+        self.endpoints = []
+        for e in endpoints:
+            if isinstance(e, Endpoint):
+                self.endpoints.append(e)
+            else:
+                self.endpoints.append(Endpoint(None if e == 'origin' else e))
+        if not any(e.root is None for e in self.endpoints):
+            self.endpoints.append(Endpoint())
+        self.probe_timeout = probe_timeout
+        self.probe_interval = probe_interval
+        self.max_failures = max_failures
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def coerce(cls, endpoints):
+        if endpoints is None or isinstance(endpoints, cls):
+            return endpoints
+        return cls(endpoints)
+
+    def probe(self, endpoint, url=None):
+        # measure the endpoint's latency (None if it is down); origin is measured at url's host
+        start = time.perf_counter()
+        try:
+            if endpoint.local:
+                os.listdir(endpoint.root)
+            else:
+                root = endpoint.root
+                if root is None:
+                    if url is None:
+                        return endpoint.latency
+                    parts = urlparse(url)
+                    root = parts.scheme + '://' + parts.netloc + '/'
+                status = self.session.head(root, timeout=self.probe_timeout, allow_redirects=False).status_code
+                if status >= 500:
+                    raise requests.exceptions.HTTPError(str(status))
+            latency = time.perf_counter() - start
+        except (requests.exceptions.RequestException, OSError):
+            latency = None
+        with self._lock:
+            endpoint.latency = latency
+            endpoint.checked = time.monotonic()
+            endpoint.failures = 0 if latency is not None else self.max_failures
+        return latency
+
+    def healthy(self, endpoint):
+        return endpoint.failures < self.max_failures and (endpoint.latency is not None or endpoint.checked == 0.0)
+
+    def candidates(self, url):
+        """
+        candidates returns the endpoints to try for the file at url, best first; endpoints whose last 
+        probe is older than probe_interval are probed again first
+        """
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if endpoint.checked == 0.0 or now - endpoint.checked > self.probe_interval:
+                self.probe(endpoint, url)
+        ranked = sorted(enumerate(self.endpoints),
+                        key=lambda item: (not self.healthy(item[1]),
+                                          item[1].latency if item[1].latency is not None else math.inf, item[0]))
+        return [endpoint for _, endpoint in ranked]
+
+    def record(self, endpoint, ok):
+        # note the outcome of a file fetched from endpoint
+        with self._lock:
+            endpoint.failures = 0 if ok else endpoint.failures + 1
+
+    def status(self):
+        return [{'endpoint': e.name, 'latency': e.latency, 'failures': e.failures, 'healthy': self.healthy(e)} 
+                for e in self.endpoints]
+
+def format_size(size):
+    # size in bytes as a human-readable string, in decimal (SI) units
+    if size < 10**3:
+        return str(size) + ' bytes'
+    for unit, scale in (('kB', 10**3), ('MB', 10**6), ('GB', 10**9)):
+        if size < scale * 10**3:
+            return str(round(size/scale, 2)) + ' ' + unit
+    return str(round(size/(10**12), 2)) + ' TB'
+
+def print_download_size(size, count=0):
+    # print the size of a download in human-readable units
+    if count !=0:
+        print('file count: ' + str(count))
+    print('Download size:', format_size(size))
+
+class InsufficientSpaceError(OSError):
+    # raised before a download starts when the planned files don't fit on disk or in the quota
+    pass
+
+def free_space(path):
+    # (device id, free bytes) of the filesystem path is (or will be) on, from its nearest existing parent folder
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev, shutil.disk_usage(path).free
+
+# AOP mosaic tiles are 1 km x 1 km and named by the UTM easting / northing of their lower-left corner,
+# eg. NEON_D02_SERC_DP3_368000_4306000_reflectance.h5 or NEON_D02_SERC_DPQA_364000_4306000_boundary.kml
+TILE_SIZE = 1000
+
+# default dependency order for DownloadPlan.prioritize(order='product'): a file is ranked by the first of 
+# these (case-insensitive) substrings found in its name or data url; eg. the DTM is needed to normalize 
+# the point cloud heights, so it comes before the .laz files
+PRODUCT_ORDER = ['boundary', 'DTM', 'DSM', 'CHM', 'slope', 'aspect', '.laz', 'reflectance']
+_TILE_COORDS = re.compile(r'_(\d{6,7})_(\d{7})_')
+
+def tile_coords(file_name):
+    # (easting, northing) of the lower-left corner of the tile a file belongs to; None for non-tiled files (eg. flightlines)
+    match = _TILE_COORDS.search(os.path.basename(file_name))
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+def _polygon_rings(polygon):
+    # outer rings of a polygon given as a list of (x, y) vertices, a GeoJSON geometry / Feature / FeatureCollection, 
+    # or any object with __geo_interface__ (eg. a shapely Polygon); holes are ignored, so selection is conservative
+    if hasattr(polygon, '__geo_interface__'):
+        polygon = polygon.__geo_interface__
+    if not isinstance(polygon, dict):
+        return [[tuple(v[:2]) for v in polygon]]
+    kind = polygon.get('type')
+    if kind == 'FeatureCollection':
+        return [ring for feature in polygon['features'] for ring in _polygon_rings(feature)]
+    if kind == 'Feature':
+        return _polygon_rings(polygon['geometry'])
+    if kind == 'Polygon':
+        return [[tuple(v[:2]) for v in polygon['coordinates'][0]]]
+    if kind == 'MultiPolygon':
+        return [[tuple(v[:2]) for v in part[0]] for part in polygon['coordinates']]
+    raise ValueError(f"unsupported geometry type: {kind}")
+
+def _point_in_ring(x, y, ring):
+    # ray casting
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i]
+        xj, yj = ring[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def _segments_cross(p1, p2, q1, q2):
+    def orient(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    d1, d2 = orient(q1, q2, p1), orient(q1, q2, p2)
+    d3, d4 = orient(p1, p2, q1), orient(p1, p2, q2)
+    return ((d1 > 0) != (d2 > 0)) and ((d3 > 0) != (d4 > 0))
+
+def _ring_intersects_box(ring, xmin, ymin, xmax, ymax):
+    if any(xmin < x < xmax and ymin < y < ymax for x, y in ring):
+        return True
+    corners = [(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)]
+    if any(_point_in_ring(x, y, ring) for x, y in corners):
+        return True
+    edges = list(zip(corners, corners[1:] + corners[:1]))
+    for a, b in zip(ring, ring[1:] + ring[:1]):
+        if any(_segments_cross(a, b, c, d) for c, d in edges):
+            return True
+    return False
+
+class TileIndex:
+    """
+    TileIndex is a grid hash of AOP tile files keyed on the (easting, northing) of their 1 km tile, 
+    for selecting exactly the tiles that cover a bounding box, a set of points or a polygon
+    --------
+    Inputs:
+        files: DownloadPlan entries (or API data['files'] dictionaries, or plain file names)
+        tile_size: tile width in meters; default = 1000
+    --------
+    Coordinates are UTM meters in the same zone as the site (the coordinates in the tile names).
+    --------
+    Usage:
+    --------
+    index = TileIndex(plan)
+    index.select_bbox((362050, 4305230, 365200, 4308050))
+    index.select_points([(364500, 4306500)], buffer=200)
+    index.select_polygon([(362050, 4308050), (364600, 4307460), (365200, 4306600), (363525, 4305230)])
+    """
+    def __init__(self, files, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.tiles = {}
+        for f in files:
+            coords = tile_coords(f if isinstance(f, str) else f['name'])
+            if coords is not None:
+                self.tiles.setdefault(coords, []).append(f)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def _key_range(self, vmin, vmax):
+        # tile origins overlapping [vmin, vmax]; a max edge exactly on a tile boundary doesn't pull in the next tile
+        first = math.floor(vmin / self.tile_size) * self.tile_size
+        last = math.floor(vmax / self.tile_size) * self.tile_size
+        if vmax > vmin and vmax == last:
+            last -= self.tile_size
+        return range(int(first), int(last) + 1, self.tile_size)
+
+    def tile_keys_in_bbox(self, xmin, ymin, xmax, ymax):
+        xs, ys = self._key_range(xmin, xmax), self._key_range(ymin, ymax)
+        if len(xs) * len(ys) > len(self.tiles):
+            # a box larger than the site: scanning the index is cheaper than enumerating the grid
+            return [k for k in self.tiles if k[0] in xs and k[1] in ys]
+        return [(x, y) for x in xs for y in ys if (x, y) in self.tiles]
+
+    def _files(self, keys):
+        return [f for key in sorted(set(keys)) for f in self.tiles[key]]
+
+    def select_bbox(self, bbox):
+        # bbox = (xmin, ymin, xmax, ymax)
+        return self._files(self.tile_keys_in_bbox(*bbox))
+
+    def select_points(self, points, buffer=0):
+        # tiles containing each (x, y) point, or within buffer meters of it
+        keys = []
+        for x, y in points:
+            keys.extend(self.tile_keys_in_bbox(x - buffer, y - buffer, x + buffer, y + buffer))
+        return self._files(keys)
+
+    def select_polygon(self, polygon):
+        keys = []
+        for ring in _polygon_rings(polygon):
+            xs = [v[0] for v in ring]
+            ys = [v[1] for v in ring]
+            for key in self.tile_keys_in_bbox(min(xs), min(ys), max(xs), max(ys)):
+                if _ring_intersects_box(ring, key[0], key[1], key[0] + self.tile_size, key[1] + self.tile_size):
+                    keys.append(key)
+        return self._files(keys)
+
+class SizePolicy:
+    """
+    SizePolicy decides whether a download goes ahead from its planned size, without prompting, 
+    so unattended jobs never block on input()
+    --------
+    Inputs (all optional):
+        max_bytes: refuse any download larger than this
+        auto_approve_bytes: approve downloads up to this size; larger ones are passed to callback,
+            or refused if there is no callback
+        callback: function(size, count) returning True to go ahead, for downloads above auto_approve_bytes
+            (or for every download, if auto_approve_bytes is not given)
+    With none of them set, every download is approved.
+    --------
+    Usage:
+    --------
+    neon_api.download_aop_files('DP3.30006.001','JORN','2019','./data/refl', size_policy=SizePolicy(max_bytes=50*10**9))
+    policy = SizePolicy(auto_approve_bytes=10**9, callback=lambda size, count: ask_slack_channel(size))
+    """
+    def __init__(self, max_bytes=None, auto_approve_bytes=None, callback=None):
+        self.max_bytes = max_bytes
+        self.auto_approve_bytes = auto_approve_bytes
+        self.callback = callback
+
+    @classmethod
+    def coerce(cls, policy):
+        # a number is a max_bytes threshold and a function is a callback
+        if policy is None or isinstance(policy, cls):
+            return policy
+        if callable(policy):
+            return cls(callback=policy)
+        return cls(max_bytes=policy)
+
+    def __call__(self, size, count=0):
+        if self.max_bytes is not None and size > self.max_bytes:
+            print('download of ' + format_size(size) + ' exceeds max_bytes (' + format_size(self.max_bytes) + ')')
+            return False
+        if self.auto_approve_bytes is not None and size <= self.auto_approve_bytes:
+            return True
+        if self.callback is not None:
+            return bool(self.callback(size, count))
+        if self.auto_approve_bytes is not None:
+            print('download of ' + format_size(size) + ' exceeds auto_approve_bytes (' + 
+                  format_size(self.auto_approve_bytes) + ') and there is no callback to approve it')
+            return False
+        return True
+
+def confirm_download(size, count=0, check_size=True, size_policy=None):
+    """
+    confirm_download decides whether a download of size bytes (count files) goes ahead: by size_policy 
+    (a SizePolicy, a max_bytes number or a function(size, count)) if given, otherwise by a (y/n) prompt 
+    when check_size is True; unattended jobs pass a size_policy rather than check_size
+    """
+    policy = SizePolicy.coerce(size_policy)
+    if policy is not None:
+        return policy(size, count)
+    if not check_size:
+        return True
+    return input("Do you want to continue with the download? (y/n) ") == "y"
+
+class DownloadPlan:
+    """
+    DownloadPlan holds every file a download will fetch, built from a single pass over the API 
+    data documents, so sizing, filtering and downloading never request the same metadata twice
+    --------
+    Each entry is a dictionary with the keys:
+        name, url, size, md5, crc32: as returned in the API data['files'] field
+        path: destination path of the downloaded file
+        data_url: the API data url (product/site/month) the file was listed under
+    --------
+    Usage:
+    --------
+    neon_api = AopApiHandler()
+    plan = neon_api.build_download_plan('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM')
+    plan.total_size()
+    plan = plan.filter(match_string='_CHM.tif')
+    plan.save('jorn_chm_plan.json')
+    neon_api.execute_plan(plan)
+    """
+    def __init__(self, files=None):
+        self.files = list(files) if files else []
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def add(self, file_info, download_folder, data_url=None, release=None):
+        self.files.append({'name': file_info['name'],
+                           'url': file_info['url'],
+                           'size': int(file_info.get('size') or 0),
+                           'md5': file_info.get('md5'),
+                           'crc32': file_info.get('crc32'),
+                           'path': os.path.join(download_folder, file_info['name']),
+                           'data_url': data_url,
+                           'release': release})
+
+    def total_size(self):
+        return sum(f['size'] for f in self.files)
+
+    def urls(self):
+        return [f['url'] for f in self.files]
+
+    def filter(self, match_string=None, file_list=None, ext=None, func=None):
+        """
+        filter returns a new DownloadPlan with only the files matching all of the given conditions
+        --------
+        Inputs:
+            match_string: substring of the file name
+            file_list: exact file names to keep
+            ext: file extension (eg. '.tif')
+            func: function taking a plan entry and returning True to keep it
+        """
+        file_set = set(file_list) if file_list is not None else None
+        files = []
+        for f in self.files:
+            if match_string is not None and match_string not in f['name']:
+                continue
+            if file_set is not None and f['name'] not in file_set:
+                continue
+            if ext is not None and not f['name'].endswith(ext):
+                continue
+            if func is not None and not func(f):
+                continue
+            files.append(f)
+        return DownloadPlan(files)
+
+    def select_tiles(self, bbox=None, points=None, polygon=None, buffer=0):
+        """
+        select_tiles returns a new DownloadPlan with only the tiled files covering a bounding box 
+        (xmin, ymin, xmax, ymax), a list of (x, y) points (optionally buffered by buffer meters), 
+        and/or a polygon (list of vertices, GeoJSON or shapely), all in the site's UTM coordinates
+        """
+        index = TileIndex(self.files)
+        selected = []
+        if bbox is not None:
+            selected.extend(index.select_bbox(bbox))
+        if points is not None:
+            selected.extend(index.select_points(points, buffer))
+        if polygon is not None:
+            selected.extend(index.select_polygon(polygon))
+        keep = set(id(f) for f in selected)
+        return DownloadPlan(f for f in self.files if id(f) in keep)
+
+    def print_size(self):
+        print_download_size(self.total_size(), len(self.files))
+
+    @staticmethod
+    def bytes_needed(entry):
+        # bytes an entry still has to add to the disk; files already present at their full size need none,
+        # and a left-over .part file (which the download resumes) needs only the rest
+        path = entry['path']
+        if os.path.exists(path) and os.path.getsize(path) == entry['size']:
+            return 0
+        if os.path.exists(path + '.part'):
+            return max(0, entry['size'] - os.path.getsize(path + '.part'))
+        return entry['size']
+
+    def preflight(self, quota=None, min_free_bytes=0, on_insufficient='raise'):
+        """
+        preflight checks, before any transfer starts, that the files still to download fit in the free
+        space of the filesystem(s) they are going to and in an optional quota
+        --------
+        Inputs:
+            quota (optional): maximum number of bytes the download may add
+            min_free_bytes (optional): space to leave free on each filesystem; default = 0
+            on_insufficient (optional): 'raise' (InsufficientSpaceError) or 'trim' (keep the files, in plan 
+                order, that fit and drop the rest); default = 'raise'
+        --------
+        Returns:
+        --------
+        this DownloadPlan if everything fits, otherwise the trimmed DownloadPlan
+        """
+        if on_insufficient not in ('raise', 'trim'):
+            raise ValueError("on_insufficient must be 'raise' or 'trim'")
+        # free space per filesystem, looked up once per destination folder
+        folders = {}
+        available = {}
+        for entry in self.files:
+            folder = os.path.dirname(entry['path']) or '.'
+            if folder not in folders:
+                device, free = free_space(folder)
+                folders[folder] = device
+                available[device] = free - min_free_bytes
+        needed = [self.bytes_needed(entry) for entry in self.files]
+        per_device = {}
+        for entry, nbytes in zip(self.files, needed):
+            device = folders[os.path.dirname(entry['path']) or '.']
+            per_device[device] = per_device.get(device, 0) + nbytes
+        total = sum(needed)
+        if (quota is None or total <= quota) and all(per_device[d] <= available[d] for d in per_device):
+            return self
+
+        short = [format_size(per_device[d]) + ' needed, ' + format_size(max(0, available[d])) + ' free'
+                 for d in per_device if per_device[d] > available[d]]
+        if quota is not None and total > quota:
+            short.append(format_size(total) + ' needed, quota is ' + format_size(quota))
+        if on_insufficient == 'raise':
+            raise InsufficientSpaceError(errno.ENOSPC, 'download does not fit: ' + '; '.join(short))
+
+        kept = []
+        kept_total = 0
+        for entry, nbytes in zip(self.files, needed):
+            device = folders[os.path.dirname(entry['path']) or '.']
+            # files already on disk need no space, so they are kept even on a full filesystem
+            if nbytes == 0 or (nbytes <= available[device] and (quota is None or kept_total + nbytes <= quota)):
+                kept.append(entry)
+                available[device] -= nbytes
+                kept_total += nbytes
+        print('WARNING: download does not fit (' + '; '.join(short) + '), keeping ' + str(len(kept)) + 
+              ' of ' + str(len(self.files)) + ' files')
+        return DownloadPlan(kept)
+
+    def prioritize(self, order, near=None, products=None):
+        """
+        prioritize returns a new DownloadPlan in the order the files should be downloaded, so the ones an 
+        analysis needs first don't wait behind the rest (downloads start in plan order; preflight trims 
+        from the end)
+        --------
+        Inputs:
+            order: 'distance' (tiles nearest to near first, untiled files last), 'smallest' (smallest files 
+                first), 'product' (by products, see below), a function taking a plan entry and returning a 
+                sort key, or a list of these to break ties in turn (eg. ['product', 'distance'])
+            near (optional): (x, y) point of interest for 'distance', in the site's UTM coordinates
+            products (optional): dependency order for 'product', as substrings of the file names or 
+                product codes (eg. ['DP3.30024.001', 'DP1.30003.001']); default is PRODUCT_ORDER; files 
+                matching none of them go last
+        --------
+        Usage:
+        --------
+        plan.prioritize('distance', near=(314500, 3610500))
+        plan.prioritize(['product', 'smallest'], products=['DTM', '.laz'])
+        """
+        orders = [order] if isinstance(order, str) or callable(order) else list(order)
+        ranks = [p.lower() for p in (products or PRODUCT_ORDER)]
+
+        def distance(entry):
+            coords = tile_coords(entry['name'])
+            if coords is None:
+                return math.inf
+            # from the center of the tile
+            return math.hypot(coords[0] + TILE_SIZE/2 - near[0], coords[1] + TILE_SIZE/2 - near[1])
+
+        def product_rank(entry):
+            text = (entry['name'] + ' ' + (entry.get('data_url') or '')).lower()
+            return next((i for i, p in enumerate(ranks) if p in text), len(ranks))
+
+        keys = []
+        for o in orders:
+            if callable(o):
+                keys.append(o)
+            elif o == 'distance':
+                if near is None:
+                    raise ValueError("order 'distance' needs a near=(x, y) point")
+                keys.append(distance)
+            elif o == 'smallest':
+                keys.append(lambda entry: entry['size'])
+            elif o == 'product':
+                keys.append(product_rank)
+            else:
+                raise ValueError("order must be 'distance', 'smallest', 'product' or a function: " + repr(o))
+        return DownloadPlan(sorted(self.files, key=lambda entry: tuple(key(entry) for key in keys)))
+
+    def to_dict(self):
+        return {'files': self.files}
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls(json.load(f)['files'])
+
+    def releases(self):
+        return sorted(set(f.get('release') for f in self.files if f.get('release')))
+
+    def save_lockfile(self, filename, download_folder, release=None, job=None):
+        """
+        save_lockfile writes the exact inputs of a download - file urls, sizes, checksums and release - so
+        it can be fetched again later (replay_lockfile) without querying the API catalog
+        --------
+        Inputs:
+            filename: lockfile to write (json)
+            download_folder: root folder of the download; file paths are stored relative to it, so a 
+                replay can put them somewhere else
+            release (optional): release tag the files were listed under (default: the release the data 
+                documents reported, if it was a single one)
+            job (optional): dictionary describing how the files were selected (product, site, year, ...)
+        """
+        if release is None and len(self.releases()) == 1:
+            release = self.releases()[0]
+        files = []
+        for f in self.files:
+            entry = dict(f)
+            entry['path'] = os.path.relpath(f['path'], download_folder)
+            files.append(entry)
+        lock = {'lockfile_version': LOCKFILE_VERSION,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'release': release,
+                'job': job or {},
+                'download_folder': download_folder,
+                'total_size': self.total_size(),
+                'files': files}
+        folder = os.path.dirname(filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(lock, f, indent=1)
+        os.replace(filename + '.tmp', filename)
+        return lock
+
+    @classmethod
+    def load_lockfile(cls, filename, download_folder=None):
+        """
+        load_lockfile reads a lockfile written by save_lockfile; returns (DownloadPlan, lockfile dictionary),
+        with the file paths under download_folder (default: the folder the lockfile was written for)
+        """
+        with open(filename) as f:
+            lock = json.load(f)
+        if lock.get('lockfile_version', 0) > LOCKFILE_VERSION:
+            raise ValueError(filename + ' was written by a newer version of neon_aop_download')
+        root = download_folder if download_folder is not None else lock['download_folder']
+        files = []
+        for entry in lock['files']:
+            entry = dict(entry)
+            entry['path'] = os.path.join(root, entry['path'])
+            files.append(entry)
+        return cls(files), lock
 
 class AopApiHandler:
-    def __init__(self, token=None, release_tag=None):
-        self.base_url = 'https://data.neonscience.org/api/v0/'
+    def __init__(self, token=None, release_tag=None, max_workers=1, max_per_host=4, pool_size=None, max_retries=3, session=None,
+                 cache_dir=None, cache_ttl=3600, cache_max_bytes=500*10**6, offline=False, rate_limit=None,
+                 buffer_size=BUFFER_SIZE, max_bandwidth=None, verify=True, verify_retries=1,
+                 disk_quota=None, min_free_bytes=0, on_insufficient_space='raise', events=None, size_policy=None,
+                 base_url=None, mirror=None, endpoints=None):
+        self.base_url = (base_url or NEON_API_URL).rstrip('/') + '/'
         self.data_url = self.base_url + 'data'
         self.product_url = self.base_url + 'products'
         self.token = token
         self.release_tag = release_tag
-        # determine this dynamically from the API? don't think you can query it directly by data product though
-        # LATEST requires elevated permissions (internal use only)
-        self.valid_aop_releases = ['RELEASE-2023', 'LATEST'] 
+        # annual releases are RELEASE-YYYY; LATEST requires elevated permissions (internal use only)
+        self.valid_aop_releases = ['RELEASE-2023', 'LATEST', 'PROVISIONAL']
+        if release_tag and release_tag not in self.valid_aop_releases and not re.match(r'RELEASE-\d{4}$', release_tag):
+            raise ValueError('Invalid release tag provided: ' + release_tag)
+        # number of files to download in parallel; 1 keeps the original serial behavior
+        self.max_workers = max_workers
+        # cap on simultaneous transfers to any single host
+        self.max_per_host = max_per_host
+        self._host_locks = {}
+        self._host_locks_lock = threading.Lock()
+        # shared pooled session for all metadata and file requests; the pool must be at least as
+        # large as the number of workers so parallel downloads don't open throwaway connections
+        if pool_size is None:
+            pool_size = max(10, max_workers)
+        # 429/5xx responses are retried by request() (through the rate limiter), not by the adapter
+        self.session = session if session is not None else make_session(pool_size, max_retries, status_forcelist=())
+        self.max_retries = max_retries
+        # token bucket per host, adapted to the rate-limit headers the API sends back
+        self.rate_limit = rate_limit
+        self._limiters = {}
+        # wall-clock time any request spent waiting on a limiter, shared by all hosts
+        self._throttle_clock = WaitClock()
+        # bytes read per block when streaming files to disk
+        self.buffer_size = buffer_size
+        # optional cap on total download bandwidth (bytes/s), shared by all workers
+        self.bandwidth = RateLimiter(max_bandwidth, max(max_bandwidth, buffer_size)) if max_bandwidth else None
+        # check downloads against the API md5/crc32 while they stream; mismatches are quarantined and fetched again
+        self.verify = verify
+        self.verify_retries = verify_retries
+        # verification manifests by download folder, written out at the end of download_file_list
+        self._manifests = {}
+        # optional on-disk cache of api json responses; offline=True answers only from the cache
+        self.cache = ResponseCache(cache_dir, cache_ttl, cache_max_bytes) if cache_dir else None
+        self.offline = offline
+        # pre-flight disk check of each plan: optional cap on the bytes a download may add, space to keep
+        # free, and whether a plan that doesn't fit is refused ('raise') or cut down to what fits ('trim')
+        self.disk_quota = disk_quota
+        self.min_free_bytes = min_free_bytes
+        self.on_insufficient_space = on_insufficient_space
+        # structured start / progress / complete / error / request events: a DownloadEvents, or a list of sinks
+        self.events = events if isinstance(events, DownloadEvents) else DownloadEvents(events)
+        # default size_policy of download_aop_files / download_aop_file_list (see SizePolicy)
+        self.size_policy = size_policy
+        # optional shared store of downloaded files keyed by checksum (neon_aop_mirror.LocalMirror): files it
+        # already holds are linked into the download folder instead of downloaded, new downloads are added to it
+        self.mirror = mirror
+        # optional mirrors of the file storage to fetch from, fastest healthy first, failing over per file 
+        # (an EndpointPool, or a list of mirror roots); None fetches every file from the url the API returns
+        self.endpoints = EndpointPool.coerce(endpoints)
 
     def construct_product_url(self, dpid):
         # Construct the base product URL
@@ -29,32 +1285,94 @@ class AopApiHandler:
         return url
 
     def get_full_data_url(self, data_url):
-        # Check if the provided release tag is valid
-        if self.release_tag and self.release_tag not in self.valid_release_tags:
-            print("Invalid release tag provided.")
-            return None
-
-        # Add the release tag if it's provided and valid
+        # add the release tag and the token (if set) to the url's query string
+        params = []
         if self.release_tag:
-            if '?' in data_url:
-                data_url += f"&release={self.release_tag}"
-            else:
-                data_url += f"?release={self.release_tag}"
-
-        # Add the token if it's provided
+            params.append(('release', self.release_tag))
         if self.token:
-            data_url += f"?apiToken={self.token}"
+            params.append(('apiToken', self.token))
+        if not params:
+            return data_url
+        parts = urlparse(data_url)
+        query = [(k, v) for k, v in parse_qsl(parts.query) if k not in ('release', 'apiToken')] + params
+        return urlunparse(parts._replace(query=urlencode(query)))
+
+    def _site_data_urls(self, product_doc, site, year=None):
+        # data urls of one site in a products document, limited to the pinned release's months (if any)
+        data_urls = []
+        for site_info in product_doc['data']['siteCodes']:
+            if site in site_info['siteCode']:
+                data_urls = site_info['availableDataUrls']
+                if self.release_tag and self.release_tag != 'LATEST':
+                    releases = {r['release']: r.get('availableMonths', []) for r in site_info.get('availableReleases', [])}
+                    if releases:
+                        months = releases.get(self.release_tag, [])
+                        data_urls = [url for url in data_urls if url.rstrip('/').split('/')[-1] in months]
+        if year:
+            data_urls = [url for url in data_urls if year in url]
+        return data_urls
 
-        return data_url
+    def rate_limiter(self, url):
+        # one RateLimiter per host, created on first use
+        host = urlparse(url).netloc
+        with self._host_locks_lock:
+            if host not in self._limiters:
+                self._limiters[host] = RateLimiter(self.rate_limit, clock=self._throttle_clock)
+            return self._limiters[host]
+
+    def throttle_stats(self):
+        # request, retry and throttle totals over all hosts
+        stats = {'requests': 0, 'retries': 0, 'throttled_seconds': self._throttle_clock.seconds}
+        for limiter in list(self._limiters.values()):
+            stats['requests'] += limiter.requests
+            stats['retries'] += limiter.retries
+        return stats
+
+    def request(self, url, **kwargs):
+        """
+        request sends a GET through the shared session, paced by the host's rate limiter and retried 
+        (with backoff and jitter) on 429 and 5xx responses; keyword arguments are passed to session.get
+        """
+        limiter = self.rate_limiter(url)
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            start = time.perf_counter()
+            response = self.session.get(url, **kwargs)
+            self.events.emit('request', url=ResponseCache.cache_key(url), host=urlparse(url).netloc,
+                             status=response.status_code, seconds=time.perf_counter() - start, attempt=attempt)
+            limiter.update(response.headers)
+            if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                return response
+            delay = limiter.backoff(attempt, response.headers.get('Retry-After'))
+            print(f"Request returned {response.status_code}, retrying in {round(delay,1)} s")
+            response.close()
+        return response
 
     def make_request(self, url):
+        # Serve the request from the cache if there is a fresh entry (or any entry, when offline)
+        entry = self.cache.get(url) if self.cache else None
+        if entry is not None and (self.offline or self.cache.is_fresh(entry)):
+            return entry['body']
+        if self.offline:
+            print(f"Offline and no cached response for {ResponseCache.cache_key(url)}")
+            return None
+
         # Make the API request
         try:
-            response = requests.get(url)
+            headers = self.cache.revalidation_headers(entry) if self.cache else {}
+            response = self.request(url, headers=headers)
+
+            # Cached copy is still current
+            if response.status_code == 304 and entry is not None:
+                self.cache.touch(url, entry)
+                return entry['body']
 
             # Check for successful response
             if response.status_code == 200:
-                return response.json()
+                body = response.json()
+                if self.cache:
+                    self.cache.put(url, body, response.headers)
+                return body
             else:
                 print(
                     f"Request failed with status code {response.status_code}")
@@ -119,13 +1437,14 @@ class AopApiHandler:
         product_url = self.construct_product_url(dpid)
         # print(product_url)
         r = self.make_request(product_url)
-        for i in range(len(r['data']['siteCodes'])):
-            if site in r['data']['siteCodes'][i]['siteCode']:
-                data_urls=r['data']['siteCodes'][i]['availableDataUrls']
-        if year:
-            data_urls = [url for url in data_urls if year in url]
+        if r is None:
+            # offline without a cached catalog, or the request failed (make_request printed why)
+            print('WARNING: no catalog of product ' + dpid + ', so no urls for site ' + site)
+            return None
+        data_urls = self._site_data_urls(r, site, year)
         if len(data_urls)==0:
-            print('WARNING: no urls found for product ' + dpid + ' at site ' + site)
+            print('WARNING: no urls found for product ' + dpid + ' at site ' + site + 
+                  (' in ' + self.release_tag if self.release_tag else ''))
         else:
             return data_urls   
     
@@ -138,7 +1457,7 @@ class AopApiHandler:
             
             if not os.path.exists(download_folder):
                 os.makedirs(download_folder)
-            full_url = self.get_full_url(url)
+            full_url = self.get_full_data_url(url)
 
             print('full url',full_url)
             
@@ -148,28 +1467,313 @@ class AopApiHandler:
                 if zip:
                     if '.zip' in files[i]['name']:
                         print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                        urllib.request.urlretrieve(files[i]['url'],download_folder + files[i]['name'])
+                        self.download_file(files[i]['url'],download_folder + files[i]['name'])
                 else:
                     if '.zip' not in files[i]['name']:
                         print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                        urllib.request.urlretrieve(files[i]['url'],download_folder + files[i]['name'])
+                        self.download_file(files[i]['url'],download_folder + files[i]['name'])
+
+    def _copy_local(self, source, filename, checksum=None):
+        # copy a file from a local / NFS mirror, checksummed as it is written
+        size = os.path.getsize(source)
+        progress = self.events.progress(os.path.basename(filename).replace('.part', ''), size or None)
+        buffer = memoryview(bytearray(self.buffer_size))
+        nbytes = 0
+        with open(source, 'rb') as src, open(filename, 'wb') as f:
+            while True:
+                n = src.readinto(buffer)
+                if not n:
+                    break
+                f.write(buffer[:n])
+                nbytes += n
+                if checksum is not None:
+                    checksum.update(buffer[:n])
+                if progress is not None:
+                    progress(n)
+        return nbytes
+
+    def _download_part(self, full_url, part_filename, checksum=None):
+        # fetch full_url into part_filename, resuming from its end with a Range request (also when it is
+        # left over from an earlier call) after a dropped connection, up to max_retries times; returns the 
+        # number of bytes transferred
+        name = os.path.basename(part_filename[:-len('.part')])
+        nbytes = 0
+        for attempt in range(self.max_retries + 1):
+            offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+            r = self.request(full_url, stream=True, headers={'Range': 'bytes=' + str(offset) + '-'} if offset else {})
+            try:
+                if r.status_code == 416 and offset:
+                    # nothing past offset: complete if the server's size (bytes */size) is the part's size
+                    total = r.headers.get('Content-Range', '').split('/')[-1]
+                    if total == str(offset):
+                        if checksum is not None:
+                            checksum.reset()
+                            checksum.update_from_file(part_filename)
+                        return nbytes
+                    os.remove(part_filename)
+                    continue
+                r.raise_for_status()
+                # 206 = the rest of the file, appended to the part; 200 = the server sent the whole file again
+                if r.status_code != 206:
+                    offset = 0
+                if checksum is not None:
+                    checksum.reset()
+                    if offset:
+                        checksum.update_from_file(part_filename)
+                length = int(r.headers.get('Content-Length', 0))
+                progress = self.events.progress(name, length or None)
+                with open(part_filename, 'r+b' if offset else 'wb') as f:
+                    f.seek(offset)
+                    try:
+                        preallocate(f, offset + length)
+                        throttle = self.bandwidth.consume if self.bandwidth else None
+                        stream_to_file(r, f, self.buffer_size, throttle, checksum, progress)
+                    finally:
+                        # keep what was written (a later attempt resumes from it), drop preallocated space
+                        size = f.tell()
+                        f.truncate(size)
+                        nbytes += size - offset
+                if not length or size == offset + length:
+                    return nbytes
+                print('download of ' + name + ' stopped at ' + str(size) + ' of ' + str(offset + length) + ' bytes, resuming')
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                print('download of ' + name + ' interrupted (' + str(e) + '), resuming')
+            finally:
+                r.close()
+        raise requests.exceptions.ConnectionError('download of ' + name + ' incomplete after ' + 
+                                                  str(self.max_retries + 1) + ' attempts')
+
+    def _transfer(self, full_url, part_filename, checksum=None, local=False):
+        if local:
+            return self._copy_local(full_url, part_filename, checksum)
+        return self._download_part(full_url, part_filename, checksum)
+
+    def _fetch(self, full_url, filename, md5=None, crc32=None, attempts=1, local=False):
+        # fetch one source into filename + '.part', verified against md5 / crc32 if given, and move it onto 
+        # filename only once it is complete (and matches), so a failure never leaves a truncated file under 
+        # the real name, or writes through a link to a mirrored file; a mismatch is quarantined and fetched again
+        part_filename = filename + '.part'
+        if not self.verify or not (md5 or crc32):
+            nbytes = self._transfer(full_url, part_filename, local=local)
+            os.replace(part_filename, filename)
+            return nbytes
+        for attempt in range(attempts):
+            checksum = StreamChecksum(md5, crc32)
+            nbytes = self._transfer(full_url, part_filename, checksum, local)
+            if checksum.matches():
+                os.replace(part_filename, filename)
+                return nbytes
+            quarantined = quarantine_file(filename, part_filename)
+            print('WARNING: checksum mismatch for ' + os.path.basename(filename) + ', moved to ' + quarantined)
+        raise ChecksumError('checksum mismatch for ' + os.path.basename(filename) + ' after ' + 
+                            str(attempts) + ' attempts')
+
+    def download_file(self, url, filename, md5=None, crc32=None):
+        """
+        download_file streams url to filename and returns the number of bytes written; if md5 or crc32 
+        are given (and self.verify is on), the file is checksummed as it streams, a mismatch is moved to 
+        a quarantine folder and downloaded again (up to verify_retries times), then ChecksumError is raised
+        --------
+        With endpoints set, the file is fetched from the best endpoint (see EndpointPool) and, if that 
+        fails or doesn't match the checksum, from the next one; a mirror gets one attempt per file, the 
+        API url gets verify_retries + 1
+        """
+        if self.endpoints is None:
+            return self._fetch(self.get_full_data_url(url), filename, md5, crc32, self.verify_retries + 1)
+
+        error = None
+        for endpoint in self.endpoints.candidates(url):
+            origin = endpoint.root is None
+            # the api token and release only go to the API url, not to the mirrors
+            source = self.get_full_data_url(url) if origin else endpoint.source(url)
+            try:
+                nbytes = self._fetch(source, filename, md5, crc32, self.verify_retries + 1 if origin else 1, endpoint.local)
+            except (requests.exceptions.RequestException, OSError) as e:
+                self.endpoints.record(endpoint, False)
+                self.events.emit('failover', name=os.path.basename(filename), endpoint=endpoint.name, error=str(e))
+                print('WARNING: ' + os.path.basename(filename) + ' failed from ' + endpoint.name + ' (' + str(e) + ')')
+                error = e
+                continue
+            self.endpoints.record(endpoint, True)
+            return nbytes
+        # a local mirror fails with an OSError; report it as a failed download like any other
+        raise EndpointError(os.path.basename(filename) + ' failed from every endpoint, last error: ' + str(error)) from error
+
+    def _record_verification(self, file_info, filename, verified):
+        # note the outcome for the folder's manifest (same layout as the functional module's neon_manifest.json)
+        folder = os.path.dirname(filename)
+        with self._host_locks_lock:
+            if folder not in self._manifests:
+                manifest_file = os.path.join(folder, MANIFEST_NAME)
+                manifest = {}
+                if os.path.exists(manifest_file):
+                    with open(manifest_file) as f:
+                        manifest = json.load(f)
+                self._manifests[folder] = manifest
+            stat = os.stat(filename) if os.path.exists(filename) else None
+            self._manifests[folder][file_info['name']] = {'size': stat.st_size if stat else None,
+                                                          'mtime': stat.st_mtime if stat else None,
+                                                          'md5': file_info.get('md5'),
+                                                          'crc32': file_info.get('crc32'),
+                                                          'verified': verified}
 
-    def download_file(self, url, filename):
+    def save_manifests(self):
+        # write the verification manifests of every folder downloaded to since the last call
+        with self._host_locks_lock:
+            for folder, manifest in self._manifests.items():
+                manifest_file = os.path.join(folder, MANIFEST_NAME)
+                with open(manifest_file + '.tmp', 'w') as f:
+                    json.dump(manifest, f, indent=1, sort_keys=True)
+                os.replace(manifest_file + '.tmp', manifest_file)
+            self._manifests = {}
 
-        full_url = self.get_full_data_url(url)
-        r = requests.get(full_url)
-        with open(filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024): 
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-        return
+    def _host_semaphore(self, url):
+        # one bounded semaphore per host, created on first use
+        host = urlparse(url).netloc
+        with self._host_locks_lock:
+            if host not in self._host_locks:
+                self._host_locks[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_locks[host]
+
+    def download_one(self, file_info, download_folder=None):
+        """
+        download_one downloads one file (an API file dictionary or a DownloadPlan entry), verified against 
+        its checksum and linked from / added to the mirror, as download_file_list does for each file; 
+        returns the bytes transferred (0 for a file linked from the mirror)
+        --------
+        Inputs:
+            file_info: dictionary with at least 'name' and 'url' keys; a plan entry's 'path' is its destination
+            download_folder: folder for a file with no 'path'
+        --------
+        Usage:
+        --------
+        plan = neon_api.build_download_plan('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM')
+        neon_api.download_one(plan.files[0])
+        """
+        filename = file_info.get('path') or os.path.join(download_folder, file_info['name'])
+        if self.mirror is not None:
+            start = time.perf_counter()
+            if self.mirror.materialize(file_info, filename):
+                print('linked ' + file_info['name'] + ' from the mirror to ' + os.path.dirname(filename))
+                self.events.emit('complete', name=file_info['name'], path=filename, bytes=0, 
+                                 seconds=time.perf_counter() - start, rate=0.0, verified=None)
+                return 0
+            if os.path.lexists(filename):
+                # may be a (read-only) link to a mirrored file: replace it rather than write through it
+                os.remove(filename)
+        print('downloading ' + file_info['name'] + ' to ' + os.path.dirname(filename))
+        verify = self.verify and bool(file_info.get('md5') or file_info.get('crc32'))
+        with self._host_semaphore(file_info['url']):
+            self.events.emit('start', name=file_info['name'], url=ResponseCache.cache_key(file_info['url']), path=filename,
+                             size=file_info.get('size'), host=urlparse(file_info['url']).netloc)
+            start = time.perf_counter()
+            try:
+                nbytes = self.download_file(file_info['url'], filename, file_info.get('md5'), file_info.get('crc32'))
+            except Exception as e:
+                if isinstance(e, ChecksumError):
+                    self._record_verification(file_info, filename, False)
+                self.events.emit('error', name=file_info['name'], path=filename, 
+                                 bytes=os.path.getsize(filename) if os.path.exists(filename) else 0,
+                                 seconds=time.perf_counter() - start, error=str(e))
+                raise
+        seconds = time.perf_counter() - start
+        if verify:
+            self._record_verification(file_info, filename, True)
+        if self.mirror is not None:
+            self.mirror.store(file_info, filename, verified=verify)
+        self.events.emit('complete', name=file_info['name'], path=filename, bytes=nbytes, seconds=seconds,
+                         rate=nbytes / seconds if seconds > 0 else 0.0, verified=True if verify else None)
+        return nbytes
+
+    def call_on_complete(self, on_complete, file_info, download_folder=None):
+        """
+        call_on_complete hands a downloaded file to on_complete(entry), with the entry's 'path' filled in, as 
+        download_file_list does; an exception raised by on_complete is printed, so it doesn't stop the downloads
+        """
+        if on_complete is None:
+            return
+        entry = dict(file_info, path=file_info.get('path') or os.path.join(download_folder, file_info['name']))
+        try:
+            on_complete(entry)
+        except Exception as e:
+            print('WARNING: on_complete failed for ' + file_info['name'] + ': ' + repr(e))
+
+    def download_file_list(self, file_infos, download_folder=None, max_workers=None, on_complete=None):
+        """
+        download_file_list downloads a list of files (the file dictionaries returned in the API 
+        data['files'] field, or DownloadPlan entries) using a bounded pool of worker threads; 
+        downloads start in list order
+        --------
+        Inputs:
+            file_infos: list of dictionaries with at least 'name' and 'url' keys (and optionally 'path')
+            download_folder: folder to store downloaded files that have no 'path'
+            max_workers (optional): number of parallel downloads; default is self.max_workers
+            on_complete (optional): function called with each file's entry (including its 'path') as soon 
+                as that file is on disk, to start processing it while the rest download; calls are made 
+                one at a time from the calling thread
+        --------
+        Returns:
+            dictionary with the number of files downloaded, failed, total bytes, elapsed seconds, 
+            throughput (bytes/s), and the requests, retries and seconds spent throttled by the rate limiter
+        """
+        if max_workers is None:
+            max_workers = self.max_workers
+
+        start = time.perf_counter()
+        throttle_start = self.throttle_stats()
+        total_bytes = 0
+        failed = []
+        try:
+            if max_workers <= 1:
+                for file_info in file_infos:
+                    try:
+                        total_bytes += self.download_one(file_info, download_folder)
+                    # OSError: a full disk, an unwritable folder or a mirror error fails this file, not the list
+                    except (requests.exceptions.RequestException, OSError) as e:
+                        print(file_info['name'] + ': ' + str(e))
+                        failed.append(file_info['name'])
+                        continue
+                    self.call_on_complete(on_complete, file_info, download_folder)
+            else:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = {executor.submit(self.download_one, file_info, download_folder): file_info 
+                               for file_info in file_infos}
+                    for future in as_completed(futures):
+                        try:
+                            total_bytes += future.result()
+                        except (requests.exceptions.RequestException, OSError) as e:
+                            print(futures[future]['name'] + ': ' + str(e))
+                            failed.append(futures[future]['name'])
+                            continue
+                        self.call_on_complete(on_complete, futures[future], download_folder)
+        finally:
+            # keep the verification records of the files done so far, even if the list is interrupted
+            self.save_manifests()
+        elapsed = time.perf_counter() - start
+
+        summary = {'files': len(file_infos) - len(failed),
+                   'failed': failed,
+                   'bytes': total_bytes,
+                   'seconds': elapsed,
+                   'throughput': total_bytes / elapsed if elapsed > 0 else 0.0}
+        for key, value in self.throttle_stats().items():
+            summary[key] = value - throttle_start[key]
+        if file_infos:
+            print(f"downloaded {summary['files']} files ({round(total_bytes/(10**6),2)} MB) in "
+                  f"{round(elapsed,1)} s, {round(summary['throughput']/(10**6),2)} MB/s")
+        if summary['retries'] or summary['throttled_seconds'] >= 0.1:
+            print(f"{summary['retries']} retries, {round(summary['throttled_seconds'],1)} s spent throttled")
+        return summary
 
     def list_all_files(self, urls, ext=None):
 
         all_files = []
         for url in urls:
-            r = requests.get(url)
-            files = r.json()['data']['files']
+            r = self.make_request(url)
+            files = r['data']['files']
             for i in range(len(files)):
                 if ext:
                     if files[i]['name'].endswith(ext):
@@ -184,8 +1788,8 @@ class AopApiHandler:
         size=int(0)
         count=int(0)
         for url in urls:
-            r = requests.get(url)
-            files = r.json()['data']['files']
+            r = self.make_request(url)
+            files = r['data']['files']
             for i in range(len(files)):
                 if match_string:
                     if match_string in files[i]['name']:
@@ -198,21 +1802,116 @@ class AopApiHandler:
                             count = count + 1
                 else:
                     size += int(files[i]['size'])
-        if count !=0:
-            print('file count: ' + str(count))
-        if size < 10**3:
-            print('Download size:',size,'bytes')
-        elif size > 10**3 and size < 10**6:
-            print('Download size:',round(size/(10**6),2),'kB')
-        elif size > 10**6 and size < 10**9:
-            print('Download size:',round(size/(10**6),2),'MB')
-        elif size > 10**9 and size < 10**12:
-            print('Download size:',round(size/(10**9),2),'GB')
-        else:
-            print('Download size:',round(size/(10**12),2),'TB')
+        print_download_size(size, count)
         return size
 
-    def download_aop_files(self, product, site, year=None, download_folder='./data', match_string=None, check_size=True):
+    def build_download_plan(self, product, site, year=None, download_folder='./data', match_string=None, file_list=None,
+                            bbox=None, points=None, polygon=None, buffer=0):
+        """
+        build_download_plan lists the NEON AOP files for a given data product, site, and optional year 
+        in a single pass over the API, without downloading anything
+        --------
+        Inputs:
+            required:
+                product: the data product code (eg. 'DP3.30015.001' - CHM)
+                site: the 4-digit NEON site code (eg. 'SRER', 'JORN')
+            
+            optional:
+                year: year (eg. '2020'); default (None) is all years
+                download_folder: folder the files will be stored in; default (./data) in current directory
+                match_string: only include files whose name contains this string
+                file_list: only include files with exactly these names
+                bbox, points, polygon, buffer: only include the tiles covering this area (see DownloadPlan.select_tiles)
+        --------
+        Returns:
+        --------
+        DownloadPlan
+        --------
+        Usage:
+        --------
+        plan = build_download_plan('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM')
+        """
+        urls = self.list_urls_by_product_site(product, site, year) or []
+
+        plan = DownloadPlan()
+        for url in urls:
+            full_url = self.get_full_data_url(url)
+            print(ResponseCache.cache_key(full_url))
+            r = self.make_request(full_url)
+            if r is None:
+                print('WARNING: no file listing returned for ' + url)
+                continue
+            self._add_listing(plan, r, download_folder, url)
+        plan = plan.filter(match_string=match_string, file_list=file_list)
+        if bbox is not None or points is not None or polygon is not None:
+            plan = plan.select_tiles(bbox, points, polygon, buffer)
+        return plan
+
+    def _add_listing(self, plan, r, download_folder, url):
+        # add the files of one data document to a plan, noting the release they belong to
+        release = r.get('data', {}).get('release')
+        if self.release_tag and self.release_tag != 'LATEST' and release and release != self.release_tag:
+            print('WARNING: ' + url + ' returned ' + release + ', not the pinned ' + self.release_tag)
+        for file_info in r.get('data', {}).get('files', []):
+            plan.add(file_info, download_folder, url, release)
+
+    def save_lockfile(self, plan, filename, download_folder, **job):
+        """
+        save_lockfile writes a plan's exact file urls, sizes, checksums and release to filename, so 
+        replay_lockfile can fetch the same inputs later; job keywords (eg. product='DP3.30015.001') are 
+        stored with it for reference
+        """
+        return plan.save_lockfile(filename, download_folder, release=self.release_tag or None, job=job)
+
+    def replay_lockfile(self, filename, download_folder=None, max_workers=None):
+        """
+        replay_lockfile downloads exactly the files recorded in a lockfile, verifying them against the
+        recorded checksums, without any catalog (products / data) queries
+        --------
+        Inputs:
+            filename: lockfile written by save_lockfile (or download_aop_files(..., lockfile=...))
+            download_folder (optional): where to put the files; default is the folder they were planned for
+            max_workers (optional): number of parallel downloads; default is the handler's max_workers
+        --------
+        Returns the summary dictionary from download_file_list
+        --------
+        Usage:
+        --------
+        neon_api = AopApiHandler(token=my_token, max_workers=8)
+        neon_api.replay_lockfile('./locks/jorn_chm_2019.lock.json', './rerun/JORN_2019/CHM')
+        """
+        plan, lock = DownloadPlan.load_lockfile(filename, download_folder)
+        if self.release_tag and lock.get('release') and lock['release'] != self.release_tag:
+            print('WARNING: ' + filename + ' was written for ' + lock['release'] + ', not ' + self.release_tag)
+        print('replaying ' + str(len(plan)) + ' files from ' + filename + 
+              (' (' + lock['release'] + ')' if lock.get('release') else ''))
+        return self.execute_plan(plan, max_workers)
+
+    def preflight(self, plan):
+        """
+        preflight checks a DownloadPlan against the free disk space and the handler's disk_quota, 
+        min_free_bytes and on_insufficient_space settings (see DownloadPlan.preflight)
+        """
+        return plan.preflight(self.disk_quota, self.min_free_bytes, self.on_insufficient_space)
+
+    def execute_plan(self, plan, max_workers=None, preflight=True, on_complete=None):
+        """
+        execute_plan downloads every file in a DownloadPlan to its destination path, in plan order (see 
+        DownloadPlan.prioritize), after checking that it fits on disk (preflight=False skips the check, 
+        eg. if the plan was already checked); on_complete is passed to download_file_list
+        --------
+        Returns the summary dictionary from download_file_list
+        """
+        if preflight:
+            plan = self.preflight(plan)
+        for folder in set(os.path.dirname(f['path']) for f in plan):
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+        return self.download_file_list(list(plan), max_workers=max_workers, on_complete=on_complete)
+
+    def download_aop_files(self, product, site, year=None, download_folder='./data', match_string=None, check_size=True, max_workers=None,
+                           bbox=None, points=None, polygon=None, buffer=0, size_policy=None, lockfile=None,
+                           order=None, near=None, on_complete=None):
         """
         download_aop_files downloads NEON AOP files from the API for a given data product, site, and 
         optional year, download folder, and match_string (eg. to download only a single tile if you know the name)
@@ -227,50 +1926,73 @@ class AopApiHandler:
                 download_folder: folder to store downloaded files; default (./data) in current directory
                 match_string: subset of data to match, need to use exact pattern for file name
                 check_size: prompt to continue download (y/n) after displaying size; default = True
+                size_policy: decide without prompting - a SizePolicy, a maximum size in bytes, or a function(size, count)
+                             returning True to continue; default (None) uses the handler's size_policy, if any
+                max_workers: number of files to download in parallel; default (None) uses the handler's max_workers
+                bbox: only download tiles overlapping (xmin, ymin, xmax, ymax), in the site's UTM coordinates
+                points: only download tiles containing these (x, y) points, or within buffer meters of them
+                polygon: only download tiles intersecting this polygon (list of (x, y) vertices, GeoJSON or shapely)
+                lockfile: also write the planned files (urls, sizes, checksums, release) to this json file,
+                          to fetch exactly the same inputs later with replay_lockfile
+                order: download order instead of API order - 'distance' (from near), 'smallest', 'product'
+                       or a list / function (see DownloadPlan.prioritize)
+                near: (x, y) point of interest for order='distance'; given alone, it implies order='distance'
+                on_complete: function called with each file's plan entry as soon as it is downloaded
+        --------
+        Returns:
+        --------
+        summary dictionary of files downloaded, failures, bytes, elapsed seconds and throughput (bytes/s), 
+        and the planned size ('planned_bytes') and whether it was approved ('approved'); nothing is 
+        downloaded if it was not
         --------
         Usage:
         --------
         download_aop_files('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM','314000_3610000_CHM.tif')
+        download_aop_files('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM',check_size=False,max_workers=8)
+        download_aop_files('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM',size_policy=SizePolicy(max_bytes=10**9))
+        download_aop_files('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM',points=[(314500,3610500)],buffer=100)
+        download_aop_files('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM',near=(314500,3610500),on_complete=process_tile)
         """
         
-        #get a list of the urls for a given data product, site, and year (if included)
-        
-        urls = self.list_urls_by_product_site(product, site, year)
+        #list the files for a given data product, site, and year (if included) in one pass over the api
+        plan = self.build_download_plan(product, site, year, download_folder, match_string=match_string,
+                                        bbox=bbox, points=points, polygon=polygon, buffer=buffer)
+        if order is None and near is not None:
+            order = 'distance'
+        if order is not None:
+            plan = plan.prioritize(order, near)
 
         #make the download folder if it doesn't already exist
         if not os.path.exists(download_folder):
             os.makedirs(download_folder)
         
-        #get the size of all the files you are planning to download
-        size = self.get_file_size(urls, match_string)
+        #record the exact inputs, so the download can be reproduced with replay_lockfile
+        if lockfile is not None:
+            self.save_lockfile(plan, lockfile, download_folder, product=product, site=site, year=year, 
+                               match_string=match_string)
         
-        #prompt to continue with download after displaying the file size
-        if check_size:
-            if input("Do you want to continue with the download? (y/n) ") != "y":
-                print('Exiting download_aop_files')
-                return
+        #check the files fit on disk, then display the size of all the files you are planning to download
+        plan = self.preflight(plan)
+        plan.print_size()
         
-        #download files in the urls
-        for url in urls:
-            full_url = self.get_full_data_url(url)
-            print(full_url)
-            r = self.make_request(full_url)
-            files = r['data']['files']
-            for i in range(len(files)):
-                if match_string is not None:
-                    if match_string in files[i]['name']:
-                        print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                        try:
-                            self.download_file(files[i]['url'],os.path.join(download_folder,files[i]['name']))
-                        except requests.exceptions.RequestException as e:
-                            print(e)
-                else:
-                    try:
-                        self.download_file(files[i]['url'],os.path.join(download_folder,files[i]['name']))
-                    except requests.exceptions.RequestException as e:
-                        print(e)
+        #decide whether to continue from the plan size (size_policy, or a prompt if check_size)
+        return self._execute_if_approved(plan, check_size, size_policy, max_workers, on_complete)
+
+    def _execute_if_approved(self, plan, check_size, size_policy, max_workers, on_complete=None):
+        size = plan.total_size()
+        policy = size_policy if size_policy is not None else self.size_policy
+        if not confirm_download(size, len(plan), check_size, policy):
+            print('Exiting download_aop_files')
+            return {'files': 0, 'failed': [], 'bytes': 0, 'seconds': 0.0, 'throughput': 0.0,
+                    'planned_bytes': size, 'approved': False}
+        
+        #download the files (in parallel if max_workers > 1)
+        summary = self.execute_plan(plan, max_workers, preflight=False, on_complete=on_complete)
+        summary.update(planned_bytes=size, approved=True)
+        return summary
 
-    def download_aop_file_list(self, product, site, file_list, year = None, download_folder = './data', check_size = False):
+    def download_aop_file_list(self, product, site, file_list, year = None, download_folder = './data', check_size = False, max_workers = None,
+                               size_policy = None):
         """
         download_aop_file_list downloads a list of NEON AOP files from the API for a given data product, site, and 
         optional year and download folder
@@ -284,7 +2006,10 @@ class AopApiHandler:
                 year: year (eg. '2020'); default (None) is all years
                 download_folder: folder to store downloaded files; default (./data) in current directory
                 match_string: subset of data to match, need to use exact pattern for file name
-                check_size: prompt to continue download (y/n) after displaying size; default = True
+                check_size: prompt to continue download (y/n) after displaying size; default = False
+                size_policy: decide without prompting - a SizePolicy, a maximum size in bytes, or a function(size, count)
+                             returning True to continue; default (None) uses the handler's size_policy, if any
+                max_workers: number of files to download in parallel; default (None) uses the handler's max_workers
         --------
         Usage:
         --------
@@ -298,42 +2023,61 @@ class AopApiHandler:
                                     check_size = False)
         """
         
-        #get a list of the urls for a given data product, site, and year (if included)
-        urls = self.list_urls_by_product_site(product, site, year)
+        #list the files in file_list for a given data product, site, and year (if included)
+        plan = self.build_download_plan(product, site, year, download_folder, file_list=file_list)
+        plan = self.preflight(plan)
         
         #make the download folder if it doesn't already exist
         if not os.path.exists(download_folder):
             os.makedirs(download_folder)
         
-        #get the size of all the files to be downloaded
-        #prompt to continue with download after displaying the file size
-        if check_size:
-            size = self.get_file_size(urls, file_list = file_list)
-            if input("Do you want to continue with the download? (y/n) ") != "y":
-                print('Exiting download_aop_files')
-                return
-
-        # Create a set of file names from file_list for faster lookup
-        file_set = set(file_list)
-
-        # Iterate through files in the API response and check if they are in file_list
-        for url in urls:
-            full_url = self.get_full_data_url(url)
-            r = self.make_request(full_url)
-            files = r.get('data', {}).get('files', [])
-            
-            for file_info in files:
-                file_name = file_info.get('name', '')
-                
-                if file_name in file_set:
-                    download_path = os.path.join(download_folder, file_name)
-                    print(f'Downloading {file_name} to {download_folder}')
-                    
-                    try:
-                        self.download_file(file_info['url'], download_path)
-                    except requests.exceptions.RequestException as e:
-                        print(e)
+        #display the size of all the files to be downloaded
+        #and decide whether to continue from it (size_policy, or a prompt if check_size)
+        if check_size or size_policy is not None or self.size_policy is not None:
+            plan.print_size()
+        return self._execute_if_approved(plan, check_size, size_policy, max_workers)
     
+    def read_aop_window(self, product, site, year, bbox, match_string=None, band=1, cache=None):
+        """
+        read_aop_window reads a small area of a tiled raster product (eg. CHM, DTM, slope, aspect) straight 
+        from the tiles' urls, without downloading the tiles: only the parts of each tile covering the area 
+        are fetched (with HTTP range requests, kept in a local block cache; see neon_aop_remote)
+        --------
+        Inputs:
+            required:
+                product: the data product code (eg. 'DP3.30015.001' - CHM)
+                site: the 4-digit NEON site code (eg. 'SRER', 'JORN')
+                year: year of the flight (eg. '2020')
+                bbox: area to read, (xmin, ymin, xmax, ymax) in the site's UTM coordinates
+            
+            optional:
+                match_string: subset of the file names, to pick one raster of a product with several 
+                              (eg. 'DTM' or 'DSM' for DP3.30024.001, 'aspect' for DP3.30025.001)
+                band: band number, or list of band numbers; default = 1
+                cache: neon_aop_remote.BlockCache or cache folder; default is the default BlockCache, 
+                       False keeps the blocks in memory only
+        --------
+        Returns:
+        --------
+        (array, transform) of the area, mosaicked across the tiles it covers; None if no tile covers it
+        --------
+        Usage:
+        --------
+        chm, transform = neon_api.read_aop_window('DP3.30015.001','ARIK','2020',(705200,4395300,706400,4395500))
+        dtm, transform = neon_api.read_aop_window('DP3.30024.001','ARIK','2020',(705200,4395300,706400,4395500),'DTM')
+        """
+        # rasterio is only needed for remote reads; neon_aop_remote is in tutorials/Python/AOP/aop_python_modules
+        try:
+            import neon_aop_remote
+        except ImportError:
+            raise ImportError('read_aop_window needs neon_aop_remote.py (tutorials/Python/AOP/aop_python_modules) on the path')
+        plan = self.build_download_plan(product, site, year, match_string=match_string, bbox=bbox).filter(ext='.tif')
+        if not len(plan):
+            print('WARNING: no ' + product + ' tiles at ' + site + ' in ' + str(year) + ' cover ' + str(tuple(bbox)))
+            return None
+        urls = [self.get_full_data_url(url) for url in plan.urls()]
+        return neon_aop_remote.read_mosaic_window(urls, bbox, band, cache)
+
     def get_aop_file_urls(self, product, site, file_list, year = None):
         """
         get_aop_file_urls lists the urls for NEON AOP files from the API for a given data product, site, 
@@ -354,25 +2098,6 @@ class AopApiHandler:
         get_aop_file_urls('DP3.30015.001','JORN',year='2019')
         """
         
-        #get a list of the urls for a given data product, site, and year (if included)
-        
-        data_urls = self.list_urls_by_product_site(product, site, year)
-               
-        # Create a set of file names from file_list for faster lookup
-        file_set = set(file_list)
-
-        # Iterate through files in the API response and check if they are in file_list
-        file_url_list = []
-        for data_url in data_urls:
-            full_data_url = self.get_full_data_url(data_url)
-            # print(full_data_url)
-            r = self.make_request(full_data_url)
-            files = r.get('data', {}).get('files', [])
-            
-            for file_info in files:
-                file_name = file_info.get('name', '')
-                
-                if file_name in file_set:
-                    file_url_list.append(file_info['url'])
+        #list the files in file_list for a given data product, site, and year (if included)
+        return self.build_download_plan(product, site, year, file_list=file_list).urls()
 
-        return file_url_list
\ No newline at end of file
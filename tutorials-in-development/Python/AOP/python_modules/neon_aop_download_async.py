@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio version of the AopApiHandler in neon_aop_download.py, for crawling the NEON Data API
+(many sites / months of a product) and downloading files concurrently instead of one request at a time.
+
+Requires aiohttp (pip install aiohttp).
+
+Usage (in a Jupyter notebook, which already runs an event loop):
+
+    import neon_aop_download_async as neon_async
+    async with neon_async.AsyncAopApiHandler(token=my_token) as neon_api:
+        sites = await neon_api.list_sites_by_product('DP3.30015.001')
+        plan = await neon_api.build_download_plan('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM')
+        summary = await neon_api.execute_plan(plan)
+
+From a script, wrap the same calls in an async function and run it with asyncio.run().
+"""
+
+import asyncio, os, random, time
+from urllib.parse import urlparse
+import aiohttp
+
+from neon_aop_download import (AopApiHandler, DownloadPlan, ResponseCache, StreamChecksum, ChecksumError,
+                               SizePolicy, quarantine_file, RETRY_STATUS)
+
+class AsyncAopApiHandler(AopApiHandler):
+    """
+    AsyncAopApiHandler mirrors the AopApiHandler methods as coroutines
+    --------
+    Inputs:
+        token, release_tag, cache_dir, cache_ttl, cache_max_bytes, offline: as for AopApiHandler
+        max_concurrency: maximum number of requests in flight at once; default = 16
+        max_per_host: maximum number of connections to any one host; default = 8
+        max_retries: number of retries on connection errors and 429/5xx responses; default = 5
+        rate_limit: requests per second to each host until the API reports its limit (see RateLimiter); 
+            requests are paced by the X-RateLimit-* headers either way
+        backoff: base delay (s) of the exponential backoff between retries; default = 1.0
+        chunk_size: bytes read per chunk when streaming a file to disk; default = 1 MiB
+        connect_timeout: seconds to wait for a connection; default = 30
+        read_timeout: seconds to wait for the next bytes of a response; a stalled transfer is resumed (see 
+            download_file); there is no limit on a whole transfer, since large files take a long time; default = 120
+        mirror: neon_aop_mirror.LocalMirror, as for AopApiHandler: files it holds are linked instead of downloaded,
+            and new downloads are added to it
+    Files are always fetched from the urls the API returns; endpoints (mirror failover) is only used by AopApiHandler.
+    """
+    def __init__(self, token=None, release_tag=None, max_concurrency=16, max_per_host=8, max_retries=5,
+                 backoff=1.0, chunk_size=2**20, connect_timeout=30, read_timeout=120, **kwargs):
+        super().__init__(token=token, release_tag=release_tag, max_per_host=max_per_host,
+                         max_retries=max_retries, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.client = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        if self.client is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.max_per_host)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self.client = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        # honor the server's Retry-After (in seconds) if it sent one, otherwise exponential backoff with jitter
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(60.0, self.backoff * 2**attempt) * (0.5 + random.random())
+
+    async def _get(self, url, headers=None):
+        # GET paced by the host's RateLimiter (as AopApiHandler.request), updated from the rate-limit headers
+        # and retried on connection errors and 429/5xx; the caller is responsible for releasing the response
+        await self.open()
+        limiter = self.rate_limiter(url)
+        for attempt in range(self.max_retries + 1):
+            await limiter.acquire_async()
+            try:
+                start = time.perf_counter()
+                response = await self.client.get(url, headers=headers)
+                self.events.emit('request', url=ResponseCache.cache_key(url), host=urlparse(url).netloc,
+                                 status=response.status, seconds=time.perf_counter() - start, attempt=attempt)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = limiter.backoff(attempt, base=self.backoff)
+                print(f"Request to {ResponseCache.cache_key(url)} failed ({e}), retrying in {round(delay,1)} s")
+                continue
+            limiter.update(response.headers)
+            if response.status not in RETRY_STATUS or attempt == self.max_retries:
+                return response
+            # the limiter pauses every request to the host until the delay is over
+            delay = limiter.backoff(attempt, response.headers.get('Retry-After'), base=self.backoff)
+            print(f"Request returned {response.status}, retrying in {round(delay,1)} s")
+            response.release()
+
+    async def make_request(self, url):
+        # Serve the request from the cache if there is a fresh entry (or any entry, when offline)
+        entry = self.cache.get(url) if self.cache else None
+        if entry is not None and (self.offline or self.cache.is_fresh(entry)):
+            return entry['body']
+        if self.offline:
+            print(f"Offline and no cached response for {ResponseCache.cache_key(url)}")
+            return None
+
+        headers = self.cache.revalidation_headers(entry) if self.cache else {}
+        await self.open()
+        try:
+            async with self._semaphore:
+                response = await self._get(url, headers=headers)
+                try:
+                    if response.status == 304 and entry is not None:
+                        self.cache.touch(url, entry)
+                        return entry['body']
+                    if response.status == 200:
+                        body = await response.json(content_type=None)
+                        if self.cache:
+                            self.cache.put(url, body, response.headers)
+                        return body
+                    print(f"Request failed with status code {response.status}")
+                    return None
+                finally:
+                    response.release()
+        except Exception as e:
+            print(f"An error occurred: {str(e)}")
+            return None
+
+    async def list_sites_by_product(self, dpid):
+        """
+        list_sites_by_product lists all the available sites for a given data product id (dpid)
+        """
+        r = await self.make_request(self.construct_product_url(dpid))
+        return [site_info['siteCode'] for site_info in r['data']['siteCodes']]
+
+    async def list_urls_by_product(self, dpid):
+        """
+        list_urls_by_product lists all the available api urls for a given data product id (dpid)
+        """
+        r = await self.make_request(self.construct_product_url(dpid))
+        data_urls = []
+        for site_info in r['data']['siteCodes']:
+            data_urls.extend(site_info['availableDataUrls'])
+        return data_urls
+
+    async def list_urls_by_product_site(self, dpid, site, year=None):
+        """
+        list_urls_by_product_site lists the api urls for a given data product id (dpid), site and optional year
+        """
+        r = await self.make_request(self.construct_product_url(dpid))
+        data_urls = self._site_data_urls(r, site, year)
+        if len(data_urls)==0:
+            print('WARNING: no urls found for product ' + dpid + ' at site ' + site + 
+                  (' in ' + self.release_tag if self.release_tag else ''))
+        else:
+            return data_urls
+
+    async def build_download_plan(self, product, site, year=None, download_folder='./data', match_string=None, file_list=None):
+        """
+        build_download_plan lists the files for a given data product, site, and optional year,
+        requesting all of the month data documents concurrently; returns a DownloadPlan
+        """
+        urls = await self.list_urls_by_product_site(product, site, year) or []
+        responses = await asyncio.gather(*[self.make_request(self.get_full_data_url(url)) for url in urls])
+
+        plan = DownloadPlan()
+        for url, r in zip(urls, responses):
+            if r is None:
+                print('WARNING: no file listing returned for ' + url)
+                continue
+            self._add_listing(plan, r, download_folder, url)
+        return plan.filter(match_string=match_string, file_list=file_list)
+
+    async def get_aop_file_urls(self, product, site, file_list, year = None):
+        """
+        get_aop_file_urls lists the urls of the files in file_list for a given data product, site and optional year
+        """
+        plan = await self.build_download_plan(product, site, year, file_list=file_list)
+        return plan.urls()
+
+    async def _stream(self, full_url, filename, checksum=None):
+        # stream full_url into filename + '.part', resuming from the end of what is already there with a
+        # Range request if the connection drops or stalls; returns the size of the .part file
+        part_filename = filename + '.part'
+        offset = 0
+        progress = None
+        for attempt in range(self.max_retries + 1):
+            headers = {'Range': 'bytes=' + str(offset) + '-'} if offset else None
+            response = await self._get(full_url, headers=headers)
+            try:
+                if response.status == 416 and offset:
+                    # the server has nothing past offset: the earlier attempt got the whole file
+                    return offset
+                response.raise_for_status()
+                if offset and response.status != 206:
+                    # the server ignored the Range header and sent the whole file again
+                    offset = 0
+                    if checksum is not None:
+                        checksum.reset()
+                if progress is None:
+                    progress = self.events.progress(os.path.basename(filename), response.content_length)
+                with open(part_filename, 'r+b' if offset else 'wb') as f:
+                    f.seek(offset)
+                    f.truncate()
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        f.write(chunk)
+                        offset += len(chunk)
+                        if checksum is not None:
+                            checksum.update(chunk)
+                        if progress is not None:
+                            progress(len(chunk))
+                return offset
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Download of {os.path.basename(filename)} interrupted at {offset} bytes ({e!r}), resuming")
+            finally:
+                response.release()
+            await asyncio.sleep(self._backoff_delay(attempt))
+
+    async def download_file(self, url, filename, md5=None, crc32=None):
+        """
+        download_file streams a single file to disk, chunk_size bytes at a time; returns the number of bytes written
+        md5 / crc32 (optional) are verified while streaming, as in AopApiHandler.download_file
+        --------
+        The file is written to filename + '.part' first; if the connection drops or stalls (read_timeout), 
+        the transfer resumes from the end of the .part file with a Range request, up to max_retries times
+        """
+        full_url = self.get_full_data_url(url)
+        part_filename = filename + '.part'
+        verify = self.verify and (md5 or crc32)
+        await self.open()
+        for attempt in range(self.verify_retries + 1 if verify else 1):
+            checksum = StreamChecksum(md5, crc32) if verify else None
+            async with self._semaphore:
+                nbytes = await self._stream(full_url, filename, checksum)
+            if checksum is None or checksum.matches():
+                os.replace(part_filename, filename)
+                return nbytes
+            quarantined = quarantine_file(filename, part_filename)
+            print('WARNING: checksum mismatch for ' + os.path.basename(filename) + ', moved to ' + quarantined)
+        raise ChecksumError('checksum mismatch for ' + os.path.basename(filename))
+
+    async def execute_plan(self, plan, preflight=True, on_complete=None):
+        """
+        execute_plan downloads every file in a DownloadPlan concurrently (up to max_concurrency at once, 
+        started in plan order), after checking that it fits on disk (see AopApiHandler.preflight); 
+        on_complete (optional) is called with each file's plan entry as soon as it is downloaded; checksum
+        results are recorded in each folder's manifest, as by AopApiHandler.download_file_list; files the 
+        handler's mirror holds are linked instead of downloaded
+        --------
+        Returns a summary dictionary of files downloaded, failures, bytes, elapsed seconds, throughput (bytes/s),
+        and the requests, retries and seconds spent throttled by the rate limiter
+        """
+        if preflight:
+            plan = self.preflight(plan)
+        for folder in set(os.path.dirname(f['path']) for f in plan):
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+
+        loop = asyncio.get_running_loop()
+
+        async def download_one(file_info):
+            # the mirror's file copies and index updates block, so they run in the default thread pool
+            if self.mirror is not None:
+                start = time.perf_counter()
+                if await loop.run_in_executor(None, self.mirror.materialize, file_info, file_info['path']):
+                    print('linked ' + file_info['name'] + ' from the mirror to ' + os.path.dirname(file_info['path']))
+                    self.events.emit('complete', name=file_info['name'], path=file_info['path'], bytes=0, 
+                                     seconds=time.perf_counter() - start, rate=0.0, verified=None)
+                    self.call_on_complete(on_complete, file_info, None)
+                    return 0
+            print('downloading ' + file_info['name'] + ' to ' + os.path.dirname(file_info['path']))
+            self.events.emit('start', name=file_info['name'], url=ResponseCache.cache_key(file_info['url']), 
+                             path=file_info['path'], size=file_info.get('size'), host=urlparse(file_info['url']).netloc)
+            verify = self.verify and bool(file_info.get('md5') or file_info.get('crc32'))
+            start = time.perf_counter()
+            try:
+                nbytes = await self.download_file(file_info['url'], file_info['path'], file_info.get('md5'), file_info.get('crc32'))
+            except Exception as e:
+                if isinstance(e, ChecksumError):
+                    self._record_verification(file_info, file_info['path'], False)
+                self.events.emit('error', name=file_info['name'], path=file_info['path'], bytes=0,
+                                 seconds=time.perf_counter() - start, error=str(e))
+                raise
+            seconds = time.perf_counter() - start
+            if verify:
+                self._record_verification(file_info, file_info['path'], True)
+            if self.mirror is not None:
+                await loop.run_in_executor(None, self.mirror.store, file_info, file_info['path'], verify)
+            self.events.emit('complete', name=file_info['name'], path=file_info['path'], bytes=nbytes, seconds=seconds,
+                             rate=nbytes / seconds if seconds > 0 else 0.0, verified=True if verify else None)
+            self.call_on_complete(on_complete, file_info, None)
+            return nbytes
+
+        start = time.perf_counter()
+        throttle_start = self.throttle_stats()
+        results = await asyncio.gather(*[download_one(f) for f in plan], return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        self.save_manifests()
+
+        total_bytes = 0
+        failed = []
+        for file_info, result in zip(plan, results):
+            if isinstance(result, Exception):
+                print(file_info['name'] + ': ' + str(result))
+                failed.append(file_info['name'])
+            else:
+                total_bytes += result
+        summary = {'files': len(plan) - len(failed),
+                   'failed': failed,
+                   'bytes': total_bytes,
+                   'seconds': elapsed,
+                   'throughput': total_bytes / elapsed if elapsed > 0 else 0.0}
+        for key, value in self.throttle_stats().items():
+            summary[key] = value - throttle_start[key]
+        if len(plan):
+            print(f"downloaded {summary['files']} files ({round(total_bytes/(10**6),2)} MB) in "
+                  f"{round(elapsed,1)} s, {round(summary['throughput']/(10**6),2)} MB/s")
+        if summary['retries'] or summary['throttled_seconds'] >= 0.1:
+            print(f"{summary['retries']} retries, {round(summary['throttled_seconds'],1)} s spent throttled")
+        return summary
+
+    async def download_aop_files(self, product, site, year=None, download_folder='./data', match_string=None, size_policy=None,
+                                 order=None, near=None, on_complete=None):
+        """
+        download_aop_files downloads NEON AOP files for a given data product, site, and optional year,
+        download folder, and match_string. There is no (y/n) prompt, since input() would block the event
+        loop; size_policy (a SizePolicy, a maximum size in bytes, or a function(size, count) returning True 
+        to continue; default: the handler's size_policy) decides from the plan size instead. order, near 
+        and on_complete are as for AopApiHandler.download_aop_files
+        """
+        plan = await self.build_download_plan(product, site, year, download_folder, match_string=match_string)
+        if order is None and near is not None:
+            order = 'distance'
+        if order is not None:
+            plan = plan.prioritize(order, near)
+        plan = self.preflight(plan)
+        plan.print_size()
+        size = plan.total_size()
+        policy = SizePolicy.coerce(size_policy if size_policy is not None else self.size_policy)
+        if policy is not None and not policy(size, len(plan)):
+            print('Exiting download_aop_files')
+            return {'files': 0, 'failed': [], 'bytes': 0, 'seconds': 0.0, 'throughput': 0.0,
+                    'planned_bytes': size, 'approved': False}
+        summary = await self.execute_plan(plan, preflight=False, on_complete=on_complete)
+        summary.update(planned_bytes=size, approved=True)
+        return summary
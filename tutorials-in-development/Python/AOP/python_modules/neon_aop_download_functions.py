@@ -6,7 +6,91 @@ Created on Mon Apr  8 08:18:00 2019
 Functions to display available urls and download NEON AOP data using the NEON Data API.
 """
 
-import requests, urllib, os
+import requests, urllib, os, time
+
+# the session and streaming helpers are shared with the AopApiHandler module in this folder
+from neon_aop_download import BUFFER_SIZE, make_session, stream_to_file, preallocate
+
+# root of the NEON Data API; set the NEON_API_URL environment variable (or change this) to use another server
+NEON_API_URL = os.environ.get('NEON_API_URL', 'http://data.neonscience.org/api/v0/')
+
+# shared HTTP session, so every call in this module reuses pooled keep-alive connections (and retries 429/5xx)
+_session = None
+
+def get_session():
+    # return the shared session, creating it on first use
+    global _session
+    if _session is None:
+        _session = make_session()
+    return _session
+
+class ProductCatalog:
+    """
+    ProductCatalog parses a NEON API products/<dpid> document once and indexes it by site and year,
+    so repeated site / year lookups don't re-decode the (multi-megabyte) product JSON
+    --------
+    Usage:
+    --------
+    chm_catalog = ProductCatalog.fetch('DP3.30015.001')
+    chm_catalog.site_codes()
+    chm_catalog.urls('JORN', '2019')
+    """
+    def __init__(self, product_json):
+        data = product_json['data']
+        self.product = data.get('productCode')
+        # siteCode -> {'availableDataUrls': [...], 'availableMonths': [...]}
+        self.sites = {}
+        # (siteCode, year) -> list of data urls
+        self._by_site_year = {}
+        for site_info in data['siteCodes']:
+            site_code = site_info['siteCode']
+            urls = site_info.get('availableDataUrls', [])
+            self.sites[site_code] = {'availableDataUrls': urls,
+                                     'availableMonths': site_info.get('availableMonths', [])}
+            for url in urls:
+                # data urls end in the year-month, eg. .../DP3.30015.001/JORN/2019-08
+                year = url.rstrip('/').split('/')[-1][:4]
+                self._by_site_year.setdefault((site_code, year), []).append(url)
+
+    @classmethod
+    def fetch(cls, product):
+        r = get_session().get(NEON_API_URL + "products/" + product)
+        r.raise_for_status()
+        return cls(r.json())
+
+    def site_codes(self):
+        return list(self.sites)
+
+    def all_urls(self):
+        data_urls = []
+        for site_info in self.sites.values():
+            data_urls.extend(site_info['availableDataUrls'])
+        return data_urls
+
+    def months(self, site):
+        return self.sites.get(site, {}).get('availableMonths', [])
+
+    def urls(self, site, year=None):
+        if year is None:
+            return self.sites.get(site, {}).get('availableDataUrls', [])
+        return self._by_site_year.get((site, str(year)), [])
+
+# seconds a fetched catalog is used before it is fetched again (the API adds data as flights are processed)
+CATALOG_TTL = 3600
+
+# catalogs already fetched in this session, keyed by data product code: (time fetched, ProductCatalog)
+_catalogs = {}
+
+def get_product_catalog(product, refresh=False):
+    """
+    get_product_catalog returns the ProductCatalog for a data product, fetching and parsing 
+    the products document only the first time it is requested, once it is older than CATALOG_TTL 
+    seconds, or when refresh=True
+    """
+    fetched = _catalogs.get(product)
+    if refresh or fetched is None or time.time() - fetched[0] > CATALOG_TTL:
+        fetched = _catalogs[product] = (time.time(), ProductCatalog.fetch(product))
+    return fetched[1]
 
 def list_all_available_sites(product):
     """
@@ -19,13 +103,7 @@ def list_all_available_sites(product):
     --------
     jorn_chm_urls = list_available_urls('DP3.30015.001')
     """
-    r = requests.get("http://data.neonscience.org/api/v0/products/" + product)
-    site_codes = []
-    for i in range(len(r.json()['data']['siteCodes'])):
-        site_code = r.json()['data']['siteCodes'][i]['siteCode']
-        site_codes.append(site_code)
-
-    return site_codes
+    return get_product_catalog(product).site_codes()
 
 def list_all_available_urls(product):
     """
@@ -38,13 +116,7 @@ def list_all_available_urls(product):
     --------
     jorn_chm_urls = list_available_urls('DP3.30015.001')
     """
-    r = requests.get("http://data.neonscience.org/api/v0/products/" + product)
-    data_urls = []
-    for i in range(len(r.json()['data']['siteCodes'])):
-        data_urls_temp = r.json()['data']['siteCodes'][i]['availableDataUrls']
-        data_urls.extend(data_urls_temp)
-
-    return data_urls
+    return get_product_catalog(product).all_urls()
 
 def list_available_urls(product,site):
     """
@@ -58,10 +130,7 @@ def list_available_urls(product,site):
     --------
     jorn_chm_urls = list_available_urls('DP3.30015.001','JORN')
     """
-    r = requests.get("http://data.neonscience.org/api/v0/products/" + product)
-    for i in range(len(r.json()['data']['siteCodes'])):
-        if site in r.json()['data']['siteCodes'][i]['siteCode']:
-            data_urls=r.json()['data']['siteCodes'][i]['availableDataUrls']
+    data_urls = get_product_catalog(product).urls(site)
     if len(data_urls)==0:
         print('WARNING: no urls found for product ' + product + ' at site ' + site)
     else:
@@ -80,11 +149,7 @@ def list_available_urls_by_year(product,site,year):
     --------
     jorn_chm_2018_url = list_available_urls_by_year('DP3.30015.001','JORN','2018')
     """
-    r = requests.get("http://data.neonscience.org/api/v0/products/" + product)
-    for i in range(len(r.json()['data']['siteCodes'])):
-        if site in r.json()['data']['siteCodes'][i]['siteCode']:
-            all_data_urls=r.json()['data']['siteCodes'][i]['availableDataUrls']
-    data_urls = [url for url in all_data_urls if year in url]
+    data_urls = get_product_catalog(product).urls(site, year)
     if len(data_urls)==0:
         print('WARNING: no urls found for product ' + product + ' at site ' + site + ' in year ' + year)
     else:
@@ -98,10 +163,10 @@ def download_urls(url_list,download_folder_root,zip=False,token=False):
         if not os.path.exists(download_folder):
             os.makedirs(download_folder)
         if token:
-            r=requests.get(url +'&apiToken='+token)
+            r=get_session().get(url +'&apiToken='+token)
         else:
             print('WARNING! No API token entered, to improve download performance, include your API token.')
-            r=requests.get(url)
+            r=get_session().get(url)
         files=r.json()['data']['files']
         for i in range(len(files)):
             if zip==False:
@@ -113,22 +178,29 @@ def download_urls(url_list,download_folder_root,zip=False,token=False):
                     print('downloading ' + files[i]['name'] + ' to ' + download_folder)
                     urllib.request.urlretrieve(files[i]['url'],download_folder + files[i]['name'])
 
-def download_file(url,filename,token=False):
+def download_file(url,filename,token=False,buffer_size=BUFFER_SIZE):
     print('token:',token)
     if token:
-        r = requests.get(url+'&apiToken='+token)
+        r = get_session().get(url+'&apiToken='+token, stream=True)
     else:
-        r = requests.get(url)
-    with open(filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024): 
-            if chunk: # filter out keep-alive new chunks
-                f.write(chunk)
+        r = get_session().get(url, stream=True)
+    try:
+        r.raise_for_status()
+        with open(filename, 'wb') as f:
+            try:
+                preallocate(f, int(r.headers.get('Content-Length', 0)))
+                stream_to_file(r, f, buffer_size)
+            finally:
+                # drop any preallocated space that wasn't written
+                f.truncate(f.tell())
+    finally:
+        r.close()
     return
 
 def get_file_size(urls,match_string):
     size=0
     for url in urls:
-        r = requests.get(url)
+        r = get_session().get(url)
         files = r.json()['data']['files']
         for i in range(len(files)):
             if match_string is not None:
@@ -139,11 +211,11 @@ def get_file_size(urls,match_string):
                 size += int(files[i]['size'])
     if size < 10**3:
         print('Download size:',size,'bytes')
-    elif size > 10**3 and size < 10**6:
-        print('Download size:',round(size/(10**6),2),'kB')
-    elif size > 10**6 and size < 10**9:
+    elif size < 10**6:
+        print('Download size:',round(size/(10**3),2),'kB')
+    elif size < 10**9:
         print('Download size:',round(size/(10**6),2),'MB')
-    elif size > 10**9 and size < 10**12:
+    elif size < 10**12:
         print('Download size:',round(size/(10**9),2),'GB')
     else:
         print('Download size:',round(size/(10**12),2),'TB')
@@ -192,9 +264,9 @@ def download_aop_files(product,site,year=None,download_folder='./data',match_str
     #download files in the urls
     for url in urls:
         if token:
-            r = requests.get(url + '&apiToken=' + token)
+            r = get_session().get(url + '&apiToken=' + token)
         else:
-            r = requests.get(url)
+            r = get_session().get(url)
         files = r.json()['data']['files']
         for i in range(len(files)):
             if match_string is not None:
@@ -226,6 +298,9 @@ def download_all_aop_files(product,year=None,download_folder='./data',match_stri
              match_string: subset of data to match, need to use exact pattern for file name
              check_size: prompt to continue download (y/n) after displaying size; default = True
     --------
+    To download several products, sites and years as one job that can be resumed after an interruption, 
+    with parallel downloads and a bandwidth / disk cap, use download_aop_batch instead.
+    --------
     Usage:
     --------
     download_aop_files('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM','314000_3610000_CHM.tif')
@@ -256,7 +331,7 @@ def download_all_aop_files(product,year=None,download_folder='./data',match_stri
     
     #download files in the urls
     for url in urls:
-        r = requests.get(url)
+        r = get_session().get(url)
         files = r.json()['data']['files']
         for i in range(len(files)):
             if match_string is not None:
@@ -270,4 +345,47 @@ def download_all_aop_files(product,year=None,download_folder='./data',match_stri
                 try:
                     download_file(files[i]['url'],os.path.join(download_folder,files[i]['name']),token)
                 except requests.exceptions.RequestException as e:
-                    print(e)
\ No newline at end of file
+                    print(e)
+
+def download_aop_batch(products,sites,years=None,download_folder='./data',match_string=None,state_file=None,
+                       max_workers=4,max_bandwidth=None,max_disk_bytes=None,token=False):
+    """
+    download_aop_batch downloads NEON AOP files for several data products, sites and years as one job 
+    (using neon_aop_batch.BatchScheduler): the files of every product and site are downloaded in 
+    parallel, interleaved, and the progress is saved, so running it again after an interruption only 
+    downloads the files still missing
+    --------
+     Inputs:
+         required:
+             products: list of data product codes (eg. ['DP3.30015.001','DP3.30024.001'])
+             sites: list of 4-digit NEON site codes, or 'all' for every site where each product is available
+         
+         optional:
+             years: list of years (eg. ['2021','2022']); default (None) is all years
+             download_folder: root folder; files go in <download_folder>/<product>/<site>/<year>; default = ./data
+             match_string: subset of data to match, need to use exact pattern for file name
+             state_file: json file recording the job's progress; default = <download_folder>/batch_state.json
+             max_workers: number of files downloaded at once; default = 4
+             max_bandwidth: cap on the total download rate, in bytes/s
+             max_disk_bytes: cap on the bytes written; the files beyond it are left for a later run
+             token: NEON API token
+    --------
+    Returns:
+    --------
+    dictionary of files downloaded, failed and deferred, bytes and elapsed seconds
+    --------
+    Usage:
+    --------
+    download_aop_batch(['DP3.30015.001','DP3.30024.001'],['SERC','JORN'],['2021','2022'],'./data/batch')
+    """
+    # neon_aop_batch (and neon_aop_download) are only needed here
+    from neon_aop_download import AopApiHandler
+    from neon_aop_batch import BatchJob, BatchScheduler
+    
+    job = BatchJob(products, sites, years, download_folder, match_string=match_string)
+    if state_file is None:
+        state_file = os.path.join(download_folder, 'batch_state.json')
+    handler = AopApiHandler(token=token or None, max_workers=max_workers, max_bandwidth=max_bandwidth,
+                            base_url=NEON_API_URL)
+    scheduler = BatchScheduler(job, state_file, handler=handler, max_workers=max_workers, max_disk_bytes=max_disk_bytes)
+    return scheduler.run()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed local mirror of NEON AOP files, shared by every project (and user) on a machine.
+
+Files are stored once under the checksum the NEON API reports for them (md5, or crc32), and linked
+into each project's own folder layout, so a tile is downloaded once per machine however many projects
+use it. The mirror keeps an index (sqlite) of the stored files and of the project paths linked to them;
+files no project links to any more can be evicted, least recently used first, to keep the mirror under
+a size limit.
+
+Usage:
+
+    import neon_aop_download as neon_dl
+    from neon_aop_mirror import LocalMirror
+
+    mirror = LocalMirror('/shared/neon_mirror', max_bytes=2*10**12)
+    neon_api = neon_dl.AopApiHandler(mirror=mirror)
+    neon_api.download_aop_files('DP3.30015.001', 'SERC', '2022', './project_a/data/CHM', check_size=False)
+    neon_api.download_aop_files('DP3.30015.001', 'SERC', '2022', './project_b/CHM', check_size=False)  # links, no download
+
+The tutorial functions (neon_aop_download_functions.download_aop_files / download_urls) take the same
+mirror argument. The mirror folder defaults to the NEON_MIRROR_DIR environment variable, or ~/.neon_mirror.
+"""
+
+import os, shutil, sqlite3, time, hashlib, zlib, threading, contextlib
+
+def _chmod(path, mode):
+    # best effort: a file or folder created by another user of a shared mirror can't be changed, and
+    # keeps the permissions it was given
+    try:
+        os.chmod(path, mode)
+    except OSError:
+        pass
+
+class LocalMirror:
+    """
+    LocalMirror stores files by checksum and links them into project folders
+    --------
+    Inputs:
+        root (optional): mirror folder; default is NEON_MIRROR_DIR, or ~/.neon_mirror
+        max_bytes (optional): size limit; unreferenced files are evicted (least recently used first) when
+            a new file takes the mirror over it; default (None) is unlimited
+        link (optional): how files are placed in project folders: 'hardlink' (falls back to a symlink across
+            filesystems), 'symlink' or 'copy'; default = 'hardlink'
+    --------
+    Stored files are made read-only, since every project linking to a file shares the same bytes. For a
+    mirror shared by several users, the folders are made group-writable and setgid (so new files belong
+    to the mirror's group) and the index group-writable; the users need a common group, and a umask 
+    that keeps group write (eg. umask 002).
+    """
+    def __init__(self, root=None, max_bytes=None, link='hardlink'):
+        if link not in ('hardlink', 'symlink', 'copy'):
+            raise ValueError("link must be 'hardlink', 'symlink' or 'copy'")
+        self.root = os.path.abspath(root or os.environ.get('NEON_MIRROR_DIR') or
+                                    os.path.join(os.path.expanduser('~'), '.neon_mirror'))
+        self.max_bytes = max_bytes
+        self.link = link
+        self._lock = threading.Lock()
+        self._makedirs(os.path.join(self.root, 'objects'))
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, size INTEGER, added REAL, last_used REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS refs (path TEXT PRIMARY KEY, key TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS refs_key ON refs (key)')
+        _chmod(os.path.join(self.root, 'index.sqlite'), 0o664)
+
+    def _makedirs(self, folder):
+        # create folder and its missing parents up to the mirror root, group-writable and setgid
+        missing = []
+        while not os.path.isdir(folder):
+            missing.append(folder)
+            if os.path.normcase(folder) == os.path.normcase(self.root):
+                break
+            folder = os.path.dirname(folder)
+        for folder in reversed(missing):
+            os.makedirs(folder, exist_ok=True)
+            _chmod(folder, 0o2775)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # one short-lived connection per operation: safe across threads, and sqlite locks across processes;
+        # the operation is one transaction, and the connection is closed (not just committed) when it ends
+        db = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def key(file_info):
+        # mirror key of an API file dictionary (or plan entry), from its md5 or crc32; None if it has neither
+        if file_info.get('md5'):
+            return 'md5-' + file_info['md5'].lower()
+        if file_info.get('crc32'):
+            return 'crc32-' + file_info['crc32'].lower()
+        return None
+
+    def object_path(self, key):
+        algorithm, digest = key.split('-', 1)
+        return os.path.join(self.root, 'objects', algorithm, digest[:2], digest)
+
+    def contains(self, file_info):
+        key = self.key(file_info)
+        return key is not None and os.path.exists(self.object_path(key))
+
+    def _place(self, obj, dest):
+        # link (or copy) obj to dest, replacing whatever is at dest
+        folder = os.path.dirname(dest)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp = dest + '.mirror-tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        if self.link == 'hardlink':
+            try:
+                os.link(obj, tmp)
+            except OSError:
+                # different filesystem (or no hardlink support): fall back to a symlink
+                os.symlink(obj, tmp)
+        elif self.link == 'symlink':
+            os.symlink(obj, tmp)
+        else:
+            shutil.copyfile(obj, tmp)
+        os.replace(tmp, dest)
+
+    def _is_linked(self, path, obj):
+        if self.link == 'copy':
+            return os.path.exists(path)
+        try:
+            return os.path.samefile(path, obj)
+        except OSError:
+            return False
+
+    def materialize(self, file_info, dest):
+        """
+        materialize places the mirrored copy of a file at dest; returns False (and does nothing) if
+        the mirror doesn't have it
+        """
+        key = self.key(file_info)
+        if key is None:
+            return False
+        obj = self.object_path(key)
+        if not os.path.exists(obj):
+            return False
+        dest = os.path.abspath(dest)
+        if not self._is_linked(dest, obj):
+            self._place(obj, dest)
+        with self._lock, self._connect() as db:
+            db.execute('UPDATE objects SET last_used = ? WHERE key = ?', (time.time(), key))
+            db.execute('INSERT OR REPLACE INTO refs (path, key) VALUES (?, ?)', (dest, key))
+        return True
+
+    @staticmethod
+    def _checksum_matches(path, key):
+        algorithm, digest = key.split('-', 1)
+        if algorithm == 'md5':
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(8 * 2**20), b''):
+                    md5.update(block)
+            return md5.hexdigest() == digest
+        crc = 0
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(8 * 2**20), b''):
+                crc = zlib.crc32(block, crc)
+        try:
+            return int(digest, 16) == crc & 0xFFFFFFFF
+        except ValueError:
+            return False
+
+    def store(self, file_info, path, verified=False):
+        """
+        store moves a downloaded file into the mirror and links it back in place; unless verified is True
+        (the download was already checked against the API checksum), the file is checksummed first and
+        not stored if it doesn't match; returns True if the file is now mirrored
+        """
+        key = self.key(file_info)
+        if key is None or not os.path.exists(path):
+            return False
+        if not verified and not self._checksum_matches(path, key):
+            print('WARNING: ' + os.path.basename(path) + ' does not match its API checksum; not added to the mirror')
+            return False
+        obj = self.object_path(key)
+        path = os.path.abspath(path)
+        self._makedirs(os.path.dirname(obj))
+        with self._lock:
+            if not os.path.exists(obj):
+                # a copy, not a link: making the mirror's file read-only must not change the project's file,
+                # which is then replaced by a link to the mirror's copy
+                tmp = obj + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+                shutil.copyfile(path, tmp)
+                _chmod(tmp, 0o444)
+                os.replace(tmp, obj)
+            size = os.path.getsize(obj)
+            now = time.time()
+            with self._connect() as db:
+                db.execute('INSERT OR IGNORE INTO objects (key, size, added, last_used) VALUES (?, ?, ?, ?)',
+                           (key, size, now, now))
+                db.execute('UPDATE objects SET last_used = ? WHERE key = ?', (now, key))
+                db.execute('INSERT OR REPLACE INTO refs (path, key) VALUES (?, ?)', (path, key))
+        if not self._is_linked(path, obj):
+            self._place(obj, path)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+        return True
+
+    def release(self, path, remove=False):
+        # forget that a project path uses its mirrored file (and delete the path if remove=True)
+        path = os.path.abspath(path)
+        with self._lock, self._connect() as db:
+            db.execute('DELETE FROM refs WHERE path = ?', (path,))
+        if remove and os.path.lexists(path):
+            os.remove(path)
+
+    def refcount(self, key):
+        """
+        refcount returns the number of project paths still linked to a mirrored file; paths that were
+        deleted or replaced since they were linked are dropped from the index
+        """
+        obj = self.object_path(key)
+        with self._lock, self._connect() as db:
+            paths = [row[0] for row in db.execute('SELECT path FROM refs WHERE key = ?', (key,))]
+            stale = [path for path in paths if not self._is_linked(path, obj)]
+            db.executemany('DELETE FROM refs WHERE path = ?', [(path,) for path in stale])
+        return len(paths) - len(stale)
+
+    def evict(self, max_bytes=None):
+        """
+        evict removes mirrored files that no project links to, least recently used first, until the
+        mirror is no larger than max_bytes (default: the mirror's max_bytes; None evicts every unreferenced
+        file); returns the number of bytes freed
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes if self.max_bytes is not None else 0
+        with self._connect() as db:
+            rows = list(db.execute('SELECT key, size FROM objects ORDER BY last_used'))
+        total = sum(size for _, size in rows)
+        freed = 0
+        for key, size in rows:
+            if total <= max_bytes:
+                break
+            if self.refcount(key) > 0:
+                continue
+            with self._lock, self._connect() as db:
+                obj = self.object_path(key)
+                if os.path.exists(obj):
+                    # read-only files can't be removed on Windows
+                    _chmod(obj, 0o644)
+                    os.remove(obj)
+                db.execute('DELETE FROM objects WHERE key = ?', (key,))
+            total -= size
+            freed += size
+        return freed
+
+    def usage(self):
+        # number of files, bytes and project links in the mirror
+        with self._connect() as db:
+            files, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+            refs = db.execute('SELECT COUNT(*) FROM refs').fetchone()[0]
+        return {'files': files, 'bytes': size, 'links': refs}
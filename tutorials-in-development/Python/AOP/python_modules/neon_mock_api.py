@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the NEON Data API, for testing and benchmarking the download modules offline.
+
+MockNeonApi serves recorded (or synthetic) products, sites and data documents under /api/v0/, and
+synthetic file payloads of the listed sizes under /files/, with HTTP Range and ETag support. Latency,
+bandwidth, rate limits, error responses, dropped connections and corrupted payloads can be injected
+to exercise the concurrency, retry, resume, verification and cache code paths repeatably.
+
+Usage:
+
+    import neon_mock_api
+    import neon_aop_download as neon_dl
+
+    # record the documents once (needs network access) ...
+    neon_mock_api.record_fixtures(['DP3.30015.001'], './fixtures/chm_jorn.json', sites=['JORN'], years=['2019'])
+
+    # ... then serve them anywhere
+    with neon_mock_api.MockNeonApi('./fixtures/chm_jorn.json', latency=0.05, bandwidth=20*10**6, error_rate=0.02) as mock:
+        neon_api = neon_dl.AopApiHandler(base_url=mock.base_url)
+        neon_api.download_aop_files('DP3.30015.001', 'JORN', '2019', './data/mock', check_size=False)
+        print(mock.stats())
+
+From a shell (the download modules also read the NEON_API_URL environment variable):
+
+    python neon_mock_api.py ./fixtures/chm_jorn.json --port 8080 --latency 0.05
+    NEON_API_URL=http://127.0.0.1:8080/api/v0/ python my_download_script.py
+"""
+
+import os, re, json, time, random, hashlib, threading, argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+# prefix of the urls in recorded documents that are rewritten to point at the mock server
+_API_URL = re.compile(r'^https?://[^/]+/api/v0/')
+
+# size of the pseudo-random block synthetic payloads are built from
+_BLOCK_SIZE = 2**16
+
+def aop_tile_names(domain, site, product_level, suffix, xmin, ymin, ncols, nrows, tile_size=1000):
+    """
+    aop_tile_names lists AOP mosaic file names for a grid of tiles, eg.
+    aop_tile_names('D14','JORN','DP3','CHM.tif',314000,3610000,3,2) -> ['NEON_D14_JORN_DP3_314000_3610000_CHM.tif', ...]
+    """
+    return ['NEON_' + domain + '_' + site + '_' + product_level + '_' + str(xmin + i*tile_size) + '_' +
+            str(ymin + j*tile_size) + '_' + suffix for j in range(nrows) for i in range(ncols)]
+
+def synthetic_fixtures(spec, release='RELEASE-2023'):
+    """
+    synthetic_fixtures builds fixtures in the recorded layout from a nested dictionary
+    --------
+    Inputs:
+        spec: {product code: {site code: {month ('YYYY-MM'): [(file name, size in bytes), ...]}}}
+        release (optional): release tag to report; default = 'RELEASE-2023'
+    --------
+    Usage:
+    --------
+    names = aop_tile_names('D14','JORN','DP3','CHM.tif',314000,3610000,4,4)
+    fixtures = synthetic_fixtures({'DP3.30015.001': {'JORN': {'2019-08': [(n, 2*10**6) for n in names]}}})
+    """
+    fixtures = {'products': {}, 'sites': {}, 'data': {}}
+    for product, sites in spec.items():
+        site_codes = []
+        for site, months in sites.items():
+            urls = ['{API}data/' + product + '/' + site + '/' + month for month in sorted(months)]
+            site_codes.append({'siteCode': site, 'availableMonths': sorted(months), 'availableDataUrls': urls,
+                               'availableReleases': [{'release': release, 'availableMonths': sorted(months)}]})
+            site_doc = fixtures['sites'].setdefault(site, {'data': {'siteCode': site, 'dataProducts': []}})
+            site_doc['data']['dataProducts'].append({'dataProductCode': product, 'availableMonths': sorted(months),
+                                                     'availableDataUrls': urls})
+            for month, files in months.items():
+                fixtures['data'][product + '/' + site + '/' + month] = {'data': {
+                    'productCode': product, 'siteCode': site, 'month': month, 'release': release,
+                    'packages': [],
+                    'files': [{'name': name, 'size': size, 'md5': None, 'crc32': None, 'url': None}
+                              for name, size in files]}}
+        fixtures['products'][product] = {'data': {'productCode': product, 'siteCodes': site_codes,
+                                                  'releases': [{'release': release}]}}
+    return fixtures
+
+def record_fixtures(products, filename, sites=None, years=None, base_url='https://data.neonscience.org/api/v0/',
+                    token=None):
+    """
+    record_fixtures saves the NEON API products, sites and data documents for some data products to a json
+    file that MockNeonApi can serve
+    --------
+    Inputs:
+        products: list of data product codes (eg. ['DP3.30015.001'])
+        filename: json file to write
+        sites (optional): only record these sites; default (None) is every site
+        years (optional): only record these years; default (None) is every year
+        base_url (optional): API to record from; default is the NEON Data API
+        token (optional): NEON API token
+    """
+    session = requests.Session()
+    params = {'apiToken': token} if token else {}
+    def get(url):
+        r = session.get(url, params=params)
+        r.raise_for_status()
+        return r.json()
+
+    fixtures = {'products': {}, 'sites': {}, 'data': {}}
+    for product in products:
+        product_doc = get(base_url + 'products/' + product)
+        fixtures['products'][product] = product_doc
+        for site_info in product_doc['data']['siteCodes']:
+            site = site_info['siteCode']
+            if sites is not None and site not in sites:
+                continue
+            if site not in fixtures['sites']:
+                fixtures['sites'][site] = get(base_url + 'sites/' + site)
+            for url in site_info['availableDataUrls']:
+                month = url.rstrip('/').split('/')[-1]
+                if years is not None and month[:4] not in [str(year) for year in years]:
+                    continue
+                print('recording ' + url)
+                fixtures['data'][product + '/' + site + '/' + month] = get(url)
+    folder = os.path.dirname(filename)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(filename, 'w') as f:
+        json.dump(fixtures, f)
+    return fixtures
+
+def _rewrite_urls(doc):
+    # point every api url in a recorded document at the mock server ('{API}' is replaced when it is served)
+    if isinstance(doc, dict):
+        return {key: _rewrite_urls(value) for key, value in doc.items()}
+    if isinstance(doc, list):
+        return [_rewrite_urls(value) for value in doc]
+    if isinstance(doc, str):
+        return _API_URL.sub('{API}', doc)
+    return doc
+
+class _Pacer:
+    # shared link: spaces out the bytes sent by every connection to a total of rate bytes/s
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, nbytes):
+        with self._lock:
+            now = time.monotonic()
+            self.next_time = max(self.next_time, now) + nbytes / self.rate
+            delay = self.next_time - nbytes / self.rate - now
+        if delay > 0:
+            time.sleep(delay)
+
+class MockNeonApi:
+    """
+    MockNeonApi runs a local NEON Data API stand-in on a background thread
+    --------
+    Inputs:
+        fixtures (optional): fixtures dictionary or json file (see record_fixtures / synthetic_fixtures);
+            default (None) serves a small synthetic CHM product at JORN
+        host, port (optional): address to listen on; default = 127.0.0.1 and a free port
+        latency (optional): seconds added before every response, or a (min, max) range; default = 0
+        bandwidth (optional): total bytes/s shared by all file transfers; default (None) is unlimited
+        error_rate (optional): fraction of requests answered with one of error_statuses; default = 0
+        error_statuses (optional): statuses to inject; default = (500, 502, 503); 429s carry Retry-After
+        retry_after (optional): Retry-After seconds sent with injected 429/503 responses; default = 1
+        drop_rate (optional): fraction of file transfers cut off part way through; default = 0
+        corrupt_rate (optional): fraction of file transfers with one byte changed; default = 0
+        rate_limit (optional): requests allowed per rate_window seconds (then 429 until the window resets),
+            reported in X-RateLimit-Limit / Remaining / Reset headers; default (None) is unlimited
+        rate_window (optional): rate limit window in seconds; default = 1
+        size_scale (optional): factor applied to every recorded file size (eg. 0.001 to shrink a real
+            flightline listing for a quick benchmark); default = 1
+        payload_dir (optional): folder of real files served in place of synthetic payloads of the same name
+        seed (optional): seed of the error injection, for repeatable runs
+    --------
+    Payloads are pseudo-random bytes derived from the file name, so they are identical on every run; the
+    md5 reported in the data documents is the md5 of the payload served (computed on first use).
+    """
+    def __init__(self, fixtures=None, host='127.0.0.1', port=0, latency=0.0, bandwidth=None, error_rate=0.0,
+                 error_statuses=(500, 502, 503), retry_after=1, drop_rate=0.0, corrupt_rate=0.0,
+                 rate_limit=None, rate_window=1.0, size_scale=1.0, payload_dir=None, seed=None):
+        if fixtures is None:
+            names = aop_tile_names('D14', 'JORN', 'DP3', 'CHM.tif', 314000, 3610000, 3, 3)
+            fixtures = synthetic_fixtures({'DP3.30015.001': {'JORN': {'2019-08': [(n, 2*10**6) for n in names]}}})
+        elif isinstance(fixtures, str):
+            with open(fixtures) as f:
+                fixtures = json.load(f)
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.pacer = _Pacer(bandwidth) if bandwidth else None
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.retry_after = retry_after
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.size_scale = size_scale
+        self.payload_dir = payload_dir
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._checksums = {}
+        self._blocks = {}
+        self.server = None
+        self._thread = None
+        self.reset_stats()
+        self._load(fixtures)
+
+    def _load(self, fixtures):
+        # index every document by its path, and every file by its /files/ path
+        self.documents = {}
+        self.files = {}
+        for product, doc in fixtures.get('products', {}).items():
+            self.documents['products/' + product] = _rewrite_urls(doc)
+        self.documents['products'] = {'data': [doc['data'] for key, doc in self.documents.items()]}
+        for site, doc in fixtures.get('sites', {}).items():
+            self.documents['sites/' + site] = _rewrite_urls(doc)
+        self.documents['sites'] = {'data': [doc['data'] for key, doc in self.documents.items() if key.startswith('sites/')]}
+        for key, doc in fixtures.get('data', {}).items():
+            doc = _rewrite_urls(doc)
+            for file_info in doc['data'].get('files', []):
+                path = 'files/' + key + '/' + file_info['name']
+                local = os.path.join(self.payload_dir, file_info['name']) if self.payload_dir else None
+                if local and os.path.exists(local):
+                    size = os.path.getsize(local)
+                else:
+                    local = None
+                    size = max(1, int(int(file_info['size']) * self.size_scale))
+                self.files[path] = {'name': file_info['name'], 'size': size, 'local': local}
+                file_info['size'] = size
+                file_info['url'] = '{ROOT}' + path
+                file_info['crc32'] = None
+            self.documents['data/' + key] = doc
+
+    @property
+    def root_url(self):
+        return 'http://' + self.host + ':' + str(self.port) + '/'
+
+    @property
+    def base_url(self):
+        return self.root_url + 'api/v0/'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        # start serving on a background thread; returns the api base url
+        if self.server is None:
+            mock = self
+            class Handler(_MockHandler):
+                api = mock
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.server.daemon_threads = True
+            self.port = self.server.server_address[1]
+            self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+            self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def serve_forever(self):
+        # serve on the calling thread (used by the command line)
+        self.start()
+        try:
+            self._thread.join()
+        except KeyboardInterrupt:
+            self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'requests': 0, 'products': 0, 'sites': 0, 'data': 0, 'files': 0, 'not_modified': 0,
+                           'bytes_sent': 0, 'errors_injected': 0, 'rate_limited': 0, 'drops': 0, 'corrupted': 0}
+
+    def stats(self):
+        # counts of the requests served (by endpoint), bytes sent and faults injected since the last reset_stats
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _chance(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self.random.random() < rate
+
+    def _rate_limit_headers(self):
+        # fixed window: (allowed, headers)
+        if self.rate_limit is None:
+            return True, {}
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= self.rate_window:
+                self._window_start = now
+                self._window_count = 0
+            self._window_count += 1
+            remaining = self.rate_limit - self._window_count
+            reset = self.rate_window - (now - self._window_start)
+        headers = {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(max(0, remaining)),
+                   'X-RateLimit-Reset': str(round(reset, 3))}
+        return remaining >= 0, headers
+
+    def _block(self, name):
+        # pseudo-random block the payload of a file repeats, derived from its name
+        block = self._blocks.get(name)
+        if block is None:
+            block = random.Random(name).getrandbits(8 * _BLOCK_SIZE).to_bytes(_BLOCK_SIZE, 'little')
+            self._blocks[name] = block
+        return block
+
+    def read_payload(self, path, start, end):
+        # bytes start..end-1 of a file's payload
+        info = self.files[path]
+        if info['local']:
+            with open(info['local'], 'rb') as f:
+                f.seek(start)
+                return f.read(end - start)
+        block = self._block(info['name'])
+        offset = start % _BLOCK_SIZE
+        data = (block[offset:] + block * ((end - start) // _BLOCK_SIZE + 1))[:end - start]
+        return data
+
+    def md5(self, path):
+        # md5 of a file's payload, computed once
+        if path not in self._checksums:
+            size = self.files[path]['size']
+            md5 = hashlib.md5()
+            for start in range(0, size, 2**20):
+                md5.update(self.read_payload(path, start, min(size, start + 2**20)))
+            self._checksums[path] = md5.hexdigest()
+        return self._checksums[path]
+
+    def render(self, key):
+        # a document as served: urls pointing at this server, md5s of the payloads served
+        doc = self.documents[key]
+        if key.startswith('data/'):
+            doc = json.loads(json.dumps(doc))
+            for file_info in doc['data'].get('files', []):
+                file_info['md5'] = self.md5(file_info['url'].replace('{ROOT}', ''))
+        body = json.dumps(doc).replace('{API}', self.base_url).replace('{ROOT}', self.root_url)
+        return body.encode()
+
+class _MockHandler(BaseHTTPRequestHandler):
+    api = None
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; without TCP_NODELAY keep-alive clients stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._handle(head=True)
+
+    def do_GET(self):
+        self._handle(head=False)
+
+    def _send(self, status, body=b'', headers=None, head=False):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head and body:
+            self.wfile.write(body)
+
+    def _error(self, status, detail, headers=None, head=False):
+        body = json.dumps({'errors': [{'status': status, 'detail': detail}]}).encode()
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        self._send(status, body, headers, head)
+
+    def _handle(self, head):
+        api = self.api
+        api._count('requests')
+        latency = api.latency
+        if isinstance(latency, (tuple, list)):
+            with api._lock:
+                latency = api.random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+        path = urlparse(self.path).path.lstrip('/')
+        allowed, headers = api._rate_limit_headers()
+        if not allowed:
+            api._count('rate_limited')
+            headers['Retry-After'] = headers['X-RateLimit-Reset']
+            return self._error(429, 'rate limit exceeded', headers, head)
+        if api._chance(api.error_rate):
+            api._count('errors_injected')
+            status = api.random.choice(api.error_statuses)
+            if status in (429, 503):
+                headers['Retry-After'] = str(api.retry_after)
+            return self._error(status, 'injected error', headers, head)
+
+        if path.startswith('api/v0/'):
+            key = path[len('api/v0/'):].rstrip('/')
+            if key not in api.documents:
+                return self._error(404, 'no fixture for ' + key, headers, head)
+            api._count(key.split('/')[0])
+            body = api.render(key)
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            headers.update({'ETag': etag, 'Content-Type': 'application/json'})
+            if self.headers.get('If-None-Match') == etag:
+                api._count('not_modified')
+                return self._send(304, b'', headers, head)
+            return self._send(200, body, headers, head)
+        if path in api.files:
+            api._count('files')
+            return self._send_file(path, headers, head)
+        return self._error(404, 'not found', headers, head)
+
+    def _send_file(self, path, headers, head):
+        api = self.api
+        size = api.files[path]['size']
+        start, end, status = 0, size, 200
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start >= size:
+                headers['Content-Range'] = 'bytes */' + str(size)
+                return self._error(416, 'range not satisfiable', headers, head)
+            status = 206
+            headers['Content-Range'] = 'bytes ' + str(start) + '-' + str(end - 1) + '/' + str(size)
+        headers.update({'Accept-Ranges': 'bytes', 'Content-Type': 'application/octet-stream',
+                        'ETag': '"' + api.md5(path) + '"'})
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if head:
+            return
+
+        # cut the transfer part way through, or change one byte of it
+        drop_at = start + api.random.randrange(end - start) if api._chance(api.drop_rate) and end > start else None
+        corrupt_at = start + api.random.randrange(end - start) if api._chance(api.corrupt_rate) and end > start else None
+        if corrupt_at is not None:
+            api._count('corrupted')
+        position = start
+        try:
+            while position < end:
+                chunk_end = min(end, position + _BLOCK_SIZE)
+                if drop_at is not None and chunk_end > drop_at:
+                    chunk_end = drop_at
+                data = api.read_payload(path, position, chunk_end)
+                if corrupt_at is not None and position <= corrupt_at < chunk_end:
+                    data = bytearray(data)
+                    data[corrupt_at - position] ^= 0xFF
+                    data = bytes(data)
+                if api.pacer is not None:
+                    api.pacer.wait(len(data))
+                # counted before the write, so a client that has received the bytes never sees stats without them
+                api._count('bytes_sent', len(data))
+                self.wfile.write(data)
+                position = chunk_end
+                if drop_at is not None and position >= drop_at:
+                    api._count('drops')
+                    self.close_connection = True
+                    self.wfile.flush()
+                    self.connection.shutdown(2)
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the NEON Data API')
+    parser.add_argument('fixtures', nargs='?', help='fixtures json file (default: a small synthetic CHM product)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=float, default=None, help='total bytes/s for file transfers')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 5xx')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of file transfers cut off')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help='fraction of file transfers with a changed byte')
+    parser.add_argument('--rate-limit', type=int, default=None, help='requests allowed per --rate-window seconds')
+    parser.add_argument('--rate-window', type=float, default=1.0)
+    parser.add_argument('--size-scale', type=float, default=1.0, help='factor applied to the recorded file sizes')
+    parser.add_argument('--payload-dir', default=None, help='folder of real files to serve by name')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    mock = MockNeonApi(args.fixtures, host=args.host, port=args.port, latency=args.latency, bandwidth=args.bandwidth,
+                       error_rate=args.error_rate, drop_rate=args.drop_rate, corrupt_rate=args.corrupt_rate,
+                       rate_limit=args.rate_limit, rate_window=args.rate_window, size_scale=args.size_scale,
+                       payload_dir=args.payload_dir, seed=args.seed)
+    mock.start()
+    print('serving the NEON API stand-in at ' + mock.base_url + ' (Ctrl+C to stop)')
+    mock.serve_forever()
+
+if __name__ == '__main__':
+    main()
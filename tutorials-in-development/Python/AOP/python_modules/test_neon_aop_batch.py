@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+
+from neon_aop_download import AopApiHandler
+from neon_aop_batch import BatchJob, BatchScheduler
+from neon_aop_mirror import LocalMirror
+
+def test_batch_lockfile_replays_without_catalog_queries(mock_api, tmp_path):
+    mock = mock_api()
+    job = BatchJob(['DP3.30015.001'], ['JORN'], years=['2019'], download_folder=str(tmp_path / 'batch'))
+    scheduler = BatchScheduler(job, str(tmp_path / 'state.json'), handler=AopApiHandler(base_url=mock.base_url))
+    lock = scheduler.save_lockfile(str(tmp_path / 'job.lock.json'))
+    assert lock['job']['products'] == ['DP3.30015.001']
+    assert len(lock['files']) == 4
+
+    mock.reset_stats()
+    handler = AopApiHandler(base_url=mock.base_url)
+    summary = handler.replay_lockfile(str(tmp_path / 'job.lock.json'), str(tmp_path / 'replay'))
+    stats = mock.stats()
+    assert summary['files'] == 4 and summary['failed'] == []
+    assert stats['products'] == stats['data'] == 0
+    for entry in lock['files']:
+        assert os.path.getsize(os.path.join(tmp_path, 'replay', entry['path'])) == entry['size']
+
+def test_batch_files_linked_from_the_mirror_count_as_done(mock_api, tmp_path):
+    mock = mock_api()
+    mirror = LocalMirror(str(tmp_path / 'mirror'))
+    for project in ('a', 'b'):
+        job = BatchJob(['DP3.30015.001'], ['JORN'], years=['2019'], download_folder=str(tmp_path / project))
+        scheduler = BatchScheduler(job, str(tmp_path / project / 'state.json'),
+                                   handler=AopApiHandler(base_url=mock.base_url, mirror=mirror))
+        summary = scheduler.run()
+        assert summary['files'] == 4
+    # project b was linked from the mirror: nothing transferred, but every file is recorded at its size
+    assert summary['bytes'] == 0 and mock.stats()['files'] == 4
+    assert mirror.usage() == {'files': 4, 'bytes': 4 * 10**4, 'links': 8}
+
+    mock.reset_stats()
+    rerun = BatchScheduler(job, str(tmp_path / 'b' / 'state.json'), handler=AopApiHandler(base_url=mock.base_url, mirror=mirror))
+    assert rerun.pending() == []
+    assert mock.stats()['requests'] == 0
+
+def test_batch_resumes_without_catalog_queries_or_repeat_downloads(mock_api, tmp_path):
+    mock = mock_api()
+    job = BatchJob(['DP3.30015.001'], ['JORN'], years=['2019'], download_folder=str(tmp_path / 'batch'))
+    state_file = str(tmp_path / 'state.json')
+    # the disk cap defers half of the files to the next run
+    first = BatchScheduler(job, state_file, handler=AopApiHandler(base_url=mock.base_url), max_disk_bytes=2 * 10**4)
+    summary = first.run()
+    assert summary['files'] == 2 and len(summary['deferred']) == 2
+    # an interruption can leave the last progress line cut short
+    with open(state_file + '.progress', 'a') as f:
+        f.write('{"path": "')
+
+    mock.reset_stats()
+    second = BatchScheduler(job, state_file, handler=AopApiHandler(base_url=mock.base_url))
+    assert sorted(f['name'] for f in second.pending()) == sorted(summary['deferred'])
+    summary = second.run()
+    stats = mock.stats()
+    assert summary['files'] == 2 and summary['failed'] == [] and summary['deferred'] == []
+    assert stats['products'] == stats['data'] == 0 and stats['files'] == 2
+    assert second.pending() == []
+    assert BatchScheduler(job, state_file, handler=AopApiHandler(base_url=mock.base_url)).pending() == []
+
+def test_batch_caps_the_bandwidth_of_a_given_handler(mock_api, tmp_path):
+    mock = mock_api()
+    job = BatchJob(['DP3.30015.001'], ['JORN'], years=['2019'], download_folder=str(tmp_path / 'batch'))
+    handler = AopApiHandler(base_url=mock.base_url)
+    BatchScheduler(job, str(tmp_path / 'state.json'), handler=handler, max_bandwidth=10**6)
+    assert handler.bandwidth is not None and handler.bandwidth.rate == 10**6
+
+def test_download_aop_batch_resumes(mock_api, tmp_path, monkeypatch):
+    import neon_aop_download_functions
+    mock = mock_api()
+    monkeypatch.setattr(neon_aop_download_functions, 'NEON_API_URL', mock.base_url)
+    summary = neon_aop_download_functions.download_aop_batch(['DP3.30015.001'], ['JORN'], ['2019'], str(tmp_path))
+    assert summary['files'] == 4 and summary['failed'] == []
+    assert len([name for name in os.listdir(tmp_path / 'DP3.30015.001' / 'JORN' / '2019') if name.endswith('.tif')]) == 4
+    mock.reset_stats()
+    assert neon_aop_download_functions.download_aop_batch(['DP3.30015.001'], ['JORN'], ['2019'], str(tmp_path))['files'] == 0
+    assert mock.stats()['bytes_sent'] == 0
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import neon_aop_benchmark
+import neon_aop_download_functions
+
+def test_every_strategy_downloads_the_whole_listing(monkeypatch, capsys):
+    # the functions strategy points the module at the mock; put it back afterwards
+    monkeypatch.setattr(neon_aop_download_functions, 'NEON_API_URL', neon_aop_download_functions.NEON_API_URL)
+    results = neon_aop_benchmark.run_benchmarks(scenarios=['many_small', 'flaky'], scale=0.02, trace_memory=False)
+    strategies = neon_aop_benchmark._available_strategies()
+    assert [(r['scenario'], r['strategy']) for r in results] == [(s, name) for s in ['many_small', 'flaky'] for name in strategies]
+    scenarios = neon_aop_benchmark.make_scenarios(0.02)
+    for result in results:
+        files = scenarios[result['scenario']]['files']
+        assert result['error'] is None and result['failed'] == 0
+        assert result['files'] == len(files) and result['bytes'] == sum(size for _, size in files)
+        assert result['requests'] >= result['api_requests'] + result['files']
+    report = capsys.readouterr().out
+    assert 'many_small: many small KML tile boundaries (10 files' in report and 'flaky' in report
+
+def test_memory_is_traced_on_request():
+    scenario = neon_aop_benchmark.make_scenarios(0.02)['many_small']
+    fixtures = neon_aop_benchmark.neon_mock_api.synthetic_fixtures(
+        {scenario['product']: {scenario['site']: {scenario['month']: scenario['files']}}})
+    with neon_aop_benchmark.neon_mock_api.MockNeonApi(fixtures) as mock:
+        result = neon_aop_benchmark.run_benchmark(mock, scenario, 'handler_parallel')
+    assert result['files'] == 10 and result['peak_memory'] > 0
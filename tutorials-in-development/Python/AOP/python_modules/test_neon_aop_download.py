@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+import io, os, json, builtins, time, threading
+
+import requests
+
+from neon_aop_download import (AopApiHandler, DownloadEvents, DownloadPlan, InsufficientSpaceError, JsonLinesSink,
+                               PrometheusTextfileSink, RateLimiter, ResponseCache, TileIndex, confirm_download,
+                               stream_to_file)
+import neon_mock_api
+from conftest import chm_fixtures
+
+def test_rate_limiter_waits_out_an_exhausted_window():
+    limiter = RateLimiter()
+    limiter.update({'X-RateLimit-Limit': '5', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '0.5'})
+    start = time.monotonic()
+    limiter.acquire()
+    assert 0.4 < time.monotonic() - start < 1.0
+    # the steady rate comes from the limit, not from what was left in the window
+    assert limiter.rate > 1.0
+
+def test_rate_limiter_counts_overlapping_waits_once():
+    limiter = RateLimiter()
+    limiter.update({'X-RateLimit-Limit': '5', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '0.5'})
+    threads = [threading.Thread(target=limiter.acquire) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 0.4 < limiter.throttled_seconds < 1.0
+
+def test_rate_limiter_ignores_a_limit_without_a_window():
+    limiter = RateLimiter()
+    limiter.update({'X-RateLimit-Limit': '5', 'X-RateLimit-Remaining': '4'})
+    assert limiter.rate is None and limiter.limit is None
+
+def test_rate_limited_downloads_keep_pace(mock_api, tmp_path):
+    # 10 requests (1 listing + 9 files) at 5 per second take about 2 s
+    mock = mock_api(chm_fixtures(3, 3), rate_limit=5, rate_window=1.0)
+    handler = AopApiHandler(base_url=mock.base_url, max_workers=8)
+    summary = handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False)
+    assert summary['files'] == 9 and summary['failed'] == []
+    assert summary['seconds'] < 5
+    assert summary['throttled_seconds'] < 5
+
+def test_failover_records_a_failed_file_when_every_endpoint_fails(mock_api, tmp_path):
+    mock = mock_api()
+    handler = AopApiHandler(base_url=mock.base_url, max_retries=0, endpoints=['origin', str(tmp_path / 'no_nfs')])
+    plan = handler.build_download_plan('DP3.30015.001', 'JORN', '2019', str(tmp_path / 'data'))
+    # origin is down: nothing listens on port 9
+    for entry in plan:
+        entry['url'] = entry['url'].replace(mock.root_url, 'http://127.0.0.1:9/')
+    summary = handler.execute_plan(plan, max_workers=2)
+    assert summary['files'] == 0
+    assert sorted(summary['failed']) == sorted(entry['name'] for entry in plan)
+
+def test_failover_uses_the_next_endpoint(mock_api, tmp_path):
+    origin = mock_api()
+    mirror = mock_api(corrupt_rate=1.0)
+    handler = AopApiHandler(base_url=origin.base_url, endpoints=[mirror.root_url, 'origin'])
+    # make the corrupting mirror look fastest, so every file is tried there first
+    handler.endpoints.probe = lambda endpoint, url=None: setattr(endpoint, 'latency', 0.0 if endpoint.root else 1.0) or endpoint.latency
+    summary = handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False)
+    assert summary['files'] == 4 and summary['failed'] == []
+    # the mirror is down after max_failures (3) bad files, so the last one goes straight to origin
+    assert mirror.stats()['files'] == 3 and origin.stats()['files'] == 4
+    assert len(list((tmp_path / 'quarantine').iterdir())) > 0
+
+def test_confirm_download_prompts_without_a_terminal(monkeypatch):
+    # notebooks have no tty on stdin, but input() still works there
+    monkeypatch.setattr('sys.stdin', io.StringIO())
+    answers = []
+    monkeypatch.setattr(builtins, 'input', lambda prompt: answers.append(prompt) or 'y')
+    assert confirm_download(10**9, 3)
+    assert len(answers) == 1
+    # a size_policy decides without prompting
+    assert not confirm_download(10**9, 3, size_policy=10**6)
+    assert len(answers) == 1
+
+def test_checksum_mismatches_are_quarantined_and_recorded(mock_api, tmp_path):
+    mock = mock_api(corrupt_rate=1.0)
+    handler = AopApiHandler(base_url=mock.base_url, verify_retries=1)
+    summary = handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False)
+    assert summary['files'] == 0 and len(summary['failed']) == 4
+    # each file is fetched verify_retries + 1 times, and the last copy is kept in quarantine
+    assert mock.stats()['corrupted'] == 8
+    assert len(os.listdir(tmp_path / 'quarantine')) == 4
+    with open(tmp_path / 'neon_manifest.json') as f:
+        manifest = json.load(f)
+    assert len(manifest) == 4 and not any(entry['verified'] for entry in manifest.values())
+
+def test_dropped_transfers_resume_from_the_part_file(mock_api, tmp_path):
+    mock = mock_api(chm_fixtures(size=10**5), drop_rate=0.5, seed=1)
+    handler = AopApiHandler(base_url=mock.base_url, max_retries=30, buffer_size=4096)
+    summary = handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False)
+    assert summary['files'] == 4 and summary['failed'] == []
+    stats = mock.stats()
+    assert stats['drops'] > 0
+    # resumed transfers ask only for the rest of the file; at most the block being read when the
+    # connection dropped is sent again
+    assert 4 * 10**5 <= stats['bytes_sent'] <= 4 * 10**5 + stats['drops'] * 4096
+    names = [name for name in os.listdir(tmp_path) if name.endswith('.tif')]
+    assert len(names) == 4 and all(os.path.getsize(tmp_path / name) == 10**5 for name in names)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.part')]
+
+def test_failed_download_leaves_a_mirror_linked_file_intact(mock_api, tmp_path):
+    from neon_aop_mirror import LocalMirror
+    mock = mock_api()
+    mirror = LocalMirror(str(tmp_path / 'mirror'))
+    AopApiHandler(base_url=mock.base_url, mirror=mirror).download_aop_files('DP3.30015.001', 'JORN', '2019', 
+                                                                              str(tmp_path / 'a'), check_size=False)
+    name = sorted(os.listdir(tmp_path / 'a'))[0]
+    mock.drop_rate = 1.0
+    handler = AopApiHandler(base_url=mock.base_url, max_retries=0)
+    plan = handler.build_download_plan('DP3.30015.001', 'JORN', '2019', str(tmp_path / 'a'))
+    url = [f['url'] for f in plan.files if f['name'] == name][0]
+    try:
+        handler.download_file(url, str(tmp_path / 'a' / name))
+    except Exception:
+        pass
+    # the download went to a .part file; the linked file (and the mirror's copy) kept all its bytes
+    assert os.path.getsize(tmp_path / 'a' / name) == 10**4
+    assert mirror.usage()['bytes'] == 4 * 10**4
+
+def test_a_file_that_cannot_be_written_fails_alone(mock_api, tmp_path):
+    mock = mock_api()
+    handler = AopApiHandler(base_url=mock.base_url, max_workers=2)
+    plan = handler.build_download_plan('DP3.30015.001', 'JORN', '2019', str(tmp_path))
+    # a regular file where the folder should be: writing the download raises an OSError
+    (tmp_path / 'blocker').write_text('')
+    plan.files[0]['path'] = str(tmp_path / 'blocker' / plan.files[0]['name'])
+    summary = handler.download_file_list(plan.files)
+    assert summary['files'] == 3 and summary['failed'] == [plan.files[0]['name']]
+    with open(tmp_path / 'neon_manifest.json') as f:
+        assert len(json.load(f)) == 3
+
+def test_offline_answers_from_the_cache_and_warns_on_a_miss(mock_api, tmp_path):
+    mock = mock_api()
+    handler = AopApiHandler(base_url=mock.base_url, cache_dir=str(tmp_path / 'cache'))
+    urls = handler.list_urls_by_product_site('DP3.30015.001', 'JORN')
+    assert len(urls) == 1
+
+    mock.reset_stats()
+    offline = AopApiHandler(base_url=mock.base_url, cache_dir=str(tmp_path / 'cache'), offline=True)
+    assert offline.list_urls_by_product_site('DP3.30015.001', 'JORN') == urls
+    assert mock.stats()['requests'] == 0
+    # a cold cache: nothing to answer from, and no request made
+    cold = AopApiHandler(base_url=mock.base_url, cache_dir=str(tmp_path / 'cold'), offline=True)
+    assert cold.list_urls_by_product_site('DP3.30015.001', 'JORN') is None
+    assert mock.stats()['requests'] == 0
+
+def test_response_cache_evicts_least_recently_used_entries(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=10**4)
+    for i in range(40):
+        cache.put('http://api/data/' + str(i), {'data': 'x' * 1000})
+    assert sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path)) <= 10**4 + 10**3
+    assert cache.get('http://api/data/39') is not None and cache.get('http://api/data/0') is None
+
+def test_parallel_downloads_stay_within_the_per_host_cap(mock_api, tmp_path):
+    mock = mock_api(chm_fixtures(3, 3), latency=0.1)
+    in_flight = {'now': 0, 'max': 0}
+    lock = threading.Lock()
+    class CountingHandler(AopApiHandler):
+        def download_file(self, *args, **kwargs):
+            with lock:
+                in_flight['now'] += 1
+                in_flight['max'] = max(in_flight['max'], in_flight['now'])
+            try:
+                return super().download_file(*args, **kwargs)
+            finally:
+                with lock:
+                    in_flight['now'] -= 1
+    handler = CountingHandler(base_url=mock.base_url, max_workers=8, max_per_host=3)
+    summary = handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False)
+    assert summary['files'] == 9 and summary['failed'] == []
+    assert in_flight['max'] == 3
+    # 9 files, 3 at a time: about 3 rounds of latency rather than 9
+    assert summary['seconds'] < 9 * 0.1
+
+def test_download_lists_each_month_once(mock_api, tmp_path):
+    names = neon_mock_api.aop_tile_names('D14', 'JORN', 'DP3', 'CHM.tif', 314000, 3610000, 2, 1)
+    mock = mock_api(neon_mock_api.synthetic_fixtures({'DP3.30015.001': {'JORN': {
+        '2019-08': [(n, 10**4) for n in names], '2019-09': [(n.replace('3610000', '3611000'), 10**4) for n in names],
+        '2021-08': [(n, 10**4) for n in names]}}}))
+    handler = AopApiHandler(base_url=mock.base_url)
+    summary = handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), size_policy=10**6)
+    assert summary['files'] == 4 and summary['planned_bytes'] == 4 * 10**4
+    # one catalog and one listing per month of 2019, shared by the size check and the download
+    stats = mock.stats()
+    assert stats['products'] == 1 and stats['data'] == 2 and stats['files'] == 4
+
+def test_stream_to_file_copies_the_body_in_buffer_sized_blocks(mock_api, tmp_path):
+    mock = mock_api(chm_fixtures(size=10**5))
+    url = requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2019-08').json()['data']['files'][0]['url']
+    payload = requests.get(url).content
+    blocks = []
+    with requests.get(url, stream=True) as r, open(tmp_path / 'tile.tif', 'wb') as f:
+        assert stream_to_file(r, f, 2**14, progress=blocks.append) == 10**5
+    assert (tmp_path / 'tile.tif').read_bytes() == payload
+    assert sum(blocks) == 10**5 and max(blocks) <= 2**14
+
+def test_tile_index_selects_the_tiles_covering_an_area():
+    names = neon_mock_api.aop_tile_names('D14', 'JORN', 'DP3', 'CHM.tif', 314000, 3610000, 3, 3)
+    index = TileIndex(names + ['NEON_D14_JORN_DP1_L001-1_2019080713_unclassified_point_cloud.laz'])
+    assert len(index) == 9
+    # a box ending on a tile boundary doesn't pull in the next tile
+    assert index.select_bbox((314500, 3610500, 316000, 3611000)) == [
+        'NEON_D14_JORN_DP3_314000_3610000_CHM.tif', 'NEON_D14_JORN_DP3_315000_3610000_CHM.tif']
+    assert index.select_points([(316500, 3612500)]) == ['NEON_D14_JORN_DP3_316000_3612000_CHM.tif']
+    assert len(index.select_points([(315500, 3611500)], buffer=600)) == 9
+    # a triangle over the lower-left half of the grid
+    selected = index.select_polygon([(314000, 3610000), (316900, 3610000), (314000, 3612900)])
+    assert 'NEON_D14_JORN_DP3_316000_3612000_CHM.tif' not in selected and len(selected) == 6
+
+def test_download_only_the_tiles_in_a_bbox(mock_api, tmp_path):
+    mock = mock_api(chm_fixtures(3, 3))
+    handler = AopApiHandler(base_url=mock.base_url)
+    summary = handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False,
+                                         bbox=(314200, 3610200, 315800, 3610800))
+    assert summary['files'] == 2 and mock.stats()['files'] == 2
+
+def test_preflight_refuses_or_trims_a_plan_over_the_quota(mock_api, tmp_path):
+    mock = mock_api()
+    handler = AopApiHandler(base_url=mock.base_url, disk_quota=25000)
+    try:
+        handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False)
+        assert False, 'expected InsufficientSpaceError'
+    except InsufficientSpaceError:
+        pass
+    assert mock.stats()['files'] == 0
+
+    handler = AopApiHandler(base_url=mock.base_url, disk_quota=25000, on_insufficient_space='trim')
+    summary = handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False)
+    assert summary['files'] == 2 and summary['planned_bytes'] == 2 * 10**4
+
+def test_preflight_counts_only_the_bytes_still_missing(tmp_path):
+    (tmp_path / 'done.tif').write_bytes(b'x' * 100)
+    (tmp_path / 'half.tif.part').write_bytes(b'x' * 60)
+    plan = DownloadPlan([{'name': name, 'path': str(tmp_path / name), 'size': 100} for name in ('done.tif', 'half.tif', 'new.tif')])
+    assert [DownloadPlan.bytes_needed(entry) for entry in plan] == [0, 40, 100]
+    assert len(plan.preflight(quota=140)) == 3
+    assert len(plan.preflight(min_free_bytes=10**18, on_insufficient='trim')) == 1
+
+def test_download_events_reach_every_sink(mock_api, tmp_path):
+    mock = mock_api(chm_fixtures(size=10**5))
+    records = []
+    def broken(record):
+        raise RuntimeError('sink down')
+    prometheus = PrometheusTextfileSink(str(tmp_path / 'neon.prom'))
+    events = DownloadEvents([records.append, broken, JsonLinesSink(str(tmp_path / 'events.jsonl')), prometheus],
+                            progress_interval=0)
+    handler = AopApiHandler(base_url=mock.base_url, buffer_size=2**14, events=events)
+    summary = handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path / 'chm'), check_size=False)
+    # a failing sink doesn't stop the downloads
+    assert summary['files'] == 4
+
+    by_event = {}
+    for record in records:
+        by_event.setdefault(record['event'], []).append(record)
+    assert len(by_event['start']) == len(by_event['complete']) == 4
+    assert sum(record['bytes'] for record in by_event['complete']) == 4 * 10**5
+    assert all(record['verified'] for record in by_event['complete'])
+    assert len(by_event['progress']) >= 4 and len(by_event['request']) >= 2
+    with open(tmp_path / 'events.jsonl') as f:
+        assert [json.loads(line)['event'] for line in f] == [record['event'] for record in records]
+    metrics = (tmp_path / 'neon.prom').read_text()
+    assert 'neon_download_files_total{status="complete"} 4' in metrics
+    assert 'neon_download_bytes_total 400000' in metrics and 'neon_download_in_progress 0' in metrics
+
+def test_prioritize_orders_the_plan():
+    names = neon_mock_api.aop_tile_names('D14', 'JORN', 'DP3', 'CHM.tif', 314000, 3610000, 3, 1)
+    plan = DownloadPlan([{'name': 'NEON_D14_JORN_DP1_20190826_161421_reflectance.h5', 'size': 1},
+                         {'name': names[0], 'size': 30}, {'name': names[1], 'size': 10}, {'name': names[2], 'size': 20},
+                         {'name': names[1].replace('CHM', 'DTM'), 'size': 40}])
+    nearest = [entry['name'] for entry in plan.prioritize('distance', near=(316900, 3610500))]
+    # tiles by distance from the point, the flightline (no tile) last
+    assert nearest[0] == names[2] and nearest[-1].endswith('reflectance.h5')
+    assert [entry['size'] for entry in plan.prioritize('smallest')] == [1, 10, 20, 30, 40]
+    # PRODUCT_ORDER: DTM before CHM before reflectance; ties broken by size
+    assert [entry['size'] for entry in plan.prioritize(['product', 'smallest'])] == [40, 10, 20, 30, 1]
+    assert [entry['size'] for entry in plan.prioritize('product', products=['reflectance'])][0] == 1
+    assert [entry['size'] for entry in plan.prioritize(lambda entry: -entry['size'])] == [40, 30, 20, 10, 1]
+    # the plan itself keeps its order
+    assert [entry['size'] for entry in plan] == [1, 30, 10, 20, 40]
+    for bad in [dict(order='distance'), dict(order='largest')]:
+        try:
+            plan.prioritize(**bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('no error for ' + repr(bad))
+
+def test_nearest_tiles_complete_first(mock_api, tmp_path):
+    mock = mock_api(chm_fixtures(3, 3))
+    handler = AopApiHandler(base_url=mock.base_url, max_workers=1)
+    done = []
+    handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False,
+                               near=(316900, 3612900), on_complete=lambda entry: done.append(entry['name']))
+    assert len(done) == 9
+    assert '_316000_3612000_' in done[0] and '_314000_3610000_' in done[-1]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import asyncio, os, json
+
+from neon_aop_download_async import AsyncAopApiHandler
+from conftest import chm_fixtures
+
+def test_dropped_transfers_resume_from_the_part_file(mock_api, tmp_path):
+    mock = mock_api(chm_fixtures(size=10**5), drop_rate=0.5, seed=1)
+
+    async def run():
+        async with AsyncAopApiHandler(base_url=mock.base_url, max_retries=30, backoff=0) as handler:
+            return await handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path))
+
+    summary = asyncio.run(run())
+    assert summary['files'] == 4 and not summary['failed']
+    stats = mock.stats()
+    assert stats['drops'] > 0
+    # each byte is sent once: resumed transfers ask only for the rest of the file
+    assert stats['bytes_sent'] == 4 * 10**5
+    names = [name for name in os.listdir(tmp_path) if name.endswith('.tif')]
+    assert len(names) == 4 and all(os.path.getsize(tmp_path / name) == 10**5 for name in names)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.part')]
+
+def test_verification_is_recorded_in_the_manifest(mock_api, tmp_path):
+    mock = mock_api(corrupt_rate=0.5, seed=2)
+
+    async def run():
+        async with AsyncAopApiHandler(base_url=mock.base_url, verify_retries=0) as handler:
+            return await handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path))
+
+    summary = asyncio.run(run())
+    with open(tmp_path / 'neon_manifest.json') as f:
+        manifest = json.load(f)
+    assert sorted(manifest) == sorted(os.listdir(tmp_path / 'quarantine') + [name for name in os.listdir(tmp_path) if name.endswith('.tif')])
+    assert sorted(name for name, entry in manifest.items() if not entry['verified']) == sorted(summary['failed'])
+    assert 0 < len(summary['failed']) < 4
+
+def test_async_requests_follow_the_rate_limit_headers(mock_api, tmp_path):
+    # 10 requests (1 listing + 9 files) at 5 per second take about 2 s, without 429s
+    mock = mock_api(chm_fixtures(3, 3), rate_limit=5, rate_window=1.0)
+
+    async def run():
+        async with AsyncAopApiHandler(base_url=mock.base_url) as handler:
+            return await handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path))
+
+    summary = asyncio.run(run())
+    assert summary['files'] == 9 and not summary['failed']
+    assert summary['retries'] == 0 and mock.stats()['rate_limited'] == 0
+    assert 0.5 < summary['throttled_seconds'] < 4
+
+def test_async_downloads_use_the_mirror(mock_api, tmp_path):
+    from neon_aop_mirror import LocalMirror
+    mock = mock_api()
+    mirror = LocalMirror(str(tmp_path / 'mirror'))
+
+    async def run(folder):
+        async with AsyncAopApiHandler(base_url=mock.base_url, mirror=mirror) as handler:
+            return await handler.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path / folder))
+
+    assert asyncio.run(run('a'))['bytes'] == 4 * 10**4
+    sent = mock.stats()['bytes_sent']
+    # the second project is linked from the mirror
+    summary = asyncio.run(run('b'))
+    assert summary['files'] == 4 and summary['bytes'] == 0 and mock.stats()['bytes_sent'] == sent
+    assert mirror.usage() == {'files': 4, 'bytes': 4 * 10**4, 'links': 8}
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+import neon_aop_download_functions as neon_dl
+
+def test_product_catalog_is_reused_until_it_expires(mock_api, monkeypatch):
+    mock = mock_api()
+    monkeypatch.setattr(neon_dl, 'NEON_API_URL', mock.base_url)
+    monkeypatch.setattr(neon_dl, '_catalogs', {})
+    assert neon_dl.list_available_urls_by_year('DP3.30015.001', 'JORN', '2019') == \
+        [mock.base_url + 'data/DP3.30015.001/JORN/2019-08']
+    assert neon_dl.list_all_available_sites('DP3.30015.001') == ['JORN']
+    assert mock.stats()['products'] == 1
+    monkeypatch.setattr(neon_dl, 'CATALOG_TTL', 0)
+    neon_dl.list_all_available_sites('DP3.30015.001')
+    assert mock.stats()['products'] == 2
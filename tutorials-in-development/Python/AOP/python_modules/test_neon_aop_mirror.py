@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import os, stat, hashlib
+
+from neon_aop_mirror import LocalMirror
+
+def test_store_leaves_the_original_file_alone(tmp_path):
+    path = tmp_path / 'project' / 'tile.tif'
+    path.parent.mkdir()
+    path.write_bytes(b'chm tile')
+    # another name for the user's file, eg. a hardlinked backup
+    os.link(path, tmp_path / 'backup.tif')
+    mirror = LocalMirror(str(tmp_path / 'mirror'))
+    file_info = {'name': 'tile.tif', 'md5': hashlib.md5(b'chm tile').hexdigest()}
+    assert mirror.store(file_info, str(path))
+
+    obj = mirror.object_path(mirror.key(file_info))
+    assert os.path.samefile(path, obj)
+    assert not os.path.samefile(tmp_path / 'backup.tif', obj)
+    assert os.stat(tmp_path / 'backup.tif').st_mode & stat.S_IWUSR
+    assert not os.stat(obj).st_mode & stat.S_IWUSR
+
+def test_mirror_folders_and_index_are_group_writable(tmp_path):
+    mirror = LocalMirror(str(tmp_path / 'mirror'))
+    file_info = {'name': 'tile.tif', 'md5': hashlib.md5(b'chm tile').hexdigest()}
+    (tmp_path / 'tile.tif').write_bytes(b'chm tile')
+    mirror.store(file_info, str(tmp_path / 'tile.tif'))
+    for folder in (mirror.root, os.path.join(mirror.root, 'objects'), os.path.dirname(mirror.object_path(mirror.key(file_info)))):
+        assert stat.S_IMODE(os.stat(folder).st_mode) == 0o2775
+    assert stat.S_IMODE(os.stat(os.path.join(mirror.root, 'index.sqlite')).st_mode) == 0o664
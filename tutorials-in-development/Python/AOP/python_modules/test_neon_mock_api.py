@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import hashlib, json
+
+import requests
+
+import neon_mock_api
+
+def test_documents_point_at_the_mock(mock_api):
+    mock = mock_api()
+    doc = requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2019-08').json()
+    files = doc['data']['files']
+    assert len(files) == 4 and all(f['url'].startswith(mock.root_url + 'files/') for f in files)
+    # the md5 listed is the md5 of the payload served
+    payload = requests.get(files[0]['url']).content
+    assert len(payload) == files[0]['size'] == 10**4
+    assert hashlib.md5(payload).hexdigest() == files[0]['md5']
+    assert requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2020-01').status_code == 404
+
+def test_unchanged_documents_are_not_modified(mock_api):
+    mock = mock_api()
+    r = requests.get(mock.base_url + 'products/DP3.30015.001')
+    again = requests.get(mock.base_url + 'products/DP3.30015.001', headers={'If-None-Match': r.headers['ETag']})
+    assert again.status_code == 304 and mock.stats()['not_modified'] == 1
+
+def test_range_requests(mock_api):
+    mock = mock_api()
+    url = requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2019-08').json()['data']['files'][0]['url']
+    payload = requests.get(url).content
+    r = requests.get(url, headers={'Range': 'bytes=100-199'})
+    assert r.status_code == 206 and r.content == payload[100:200]
+    assert r.headers['Content-Range'] == 'bytes 100-199/10000'
+    r = requests.get(url, headers={'Range': 'bytes=9000-'})
+    assert r.status_code == 206 and r.content == payload[9000:]
+    r = requests.get(url, headers={'Range': 'bytes=-10'})
+    assert r.status_code == 206 and r.content == payload[-10:]
+    # a range starting at the end of the file: nothing left to send
+    r = requests.get(url, headers={'Range': 'bytes=10000-'})
+    assert r.status_code == 416 and r.headers['Content-Range'] == 'bytes */10000'
+
+def test_rate_limit(mock_api):
+    mock = mock_api(rate_limit=2, rate_window=60)
+    url = mock.base_url + 'products/DP3.30015.001'
+    first, second, third = [requests.get(url) for i in range(3)]
+    assert first.headers['X-RateLimit-Limit'] == '2'
+    assert [first.headers['X-RateLimit-Remaining'], second.headers['X-RateLimit-Remaining']] == ['1', '0']
+    assert second.status_code == 200 and third.status_code == 429
+    assert float(third.headers['Retry-After']) > 0
+    assert mock.stats()['rate_limited'] == 1
+
+def test_injected_faults_are_counted(mock_api):
+    mock = mock_api(error_rate=1.0, error_statuses=(503,), retry_after=2, seed=0)
+    r = requests.get(mock.base_url + 'products/DP3.30015.001')
+    assert r.status_code == 503 and r.headers['Retry-After'] == '2'
+    mock.error_rate = 0
+    mock.corrupt_rate = 1.0
+    doc = requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2019-08').json()
+    f = doc['data']['files'][0]
+    assert hashlib.md5(requests.get(f['url']).content).hexdigest() != f['md5']
+    stats = mock.stats()
+    assert stats['errors_injected'] == 1 and stats['corrupted'] == 1
+    assert stats['requests'] == 3 and stats['data'] == 1 and stats['files'] == 1
+    mock.reset_stats()
+    assert mock.stats()['requests'] == 0
+
+def test_payload_dir_serves_real_files(mock_api, tmp_path):
+    name = neon_mock_api.aop_tile_names('D14', 'JORN', 'DP3', 'CHM.tif', 314000, 3610000, 1, 1)[0]
+    (tmp_path / name).write_bytes(b'0123456789' * 10)
+    fixtures = neon_mock_api.synthetic_fixtures({'DP3.30015.001': {'JORN': {'2019-08': [(name, 10**6)]}}})
+    mock = mock_api(fixtures, payload_dir=str(tmp_path))
+    f = requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2019-08').json()['data']['files'][0]
+    # the listed size is the size of the real file
+    assert f['size'] == 100 and requests.get(f['url']).content == b'0123456789' * 10
+
+def test_fixtures_load_from_a_file(mock_api, tmp_path):
+    filename = str(tmp_path / 'fixtures.json')
+    with open(filename, 'w') as f:
+        json.dump(neon_mock_api.synthetic_fixtures({'DP3.30024.001': {'SERC': {'2021-07': [('a.tif', 10)]}}}), f)
+    mock = mock_api(filename)
+    sites = requests.get(mock.base_url + 'sites').json()['data']
+    assert [site['siteCode'] for site in sites] == ['SERC']
+    assert requests.get(mock.base_url + 'products/DP3.30024.001').json()['data']['siteCodes'][0]['availableMonths'] == ['2021-07']
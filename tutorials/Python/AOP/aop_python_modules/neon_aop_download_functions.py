@@ -6,7 +6,119 @@ Created on Mon Apr  8 08:18:00 2019
 Functions to display available urls and download NEON AOP data using the NEON Data API.
 """
 
-import requests, urllib, os
+import requests, urllib3, os, json, hashlib, zlib, struct, zipfile, fnmatch, shutil, time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# name of the file, kept in each download folder, that records what has already been downloaded
+MANIFEST_NAME = 'neon_manifest.json'
+
+# read buffer for streaming downloads; large blocks keep the per-chunk Python overhead negligible on multi-GB files
+BUFFER_SIZE = 8 * 2**20
+
+# root of the NEON Data API; set the NEON_API_URL environment variable (or change this) to use another server
+NEON_API_URL = os.environ.get('NEON_API_URL', 'http://data.neonscience.org/api/v0/')
+
+# shared HTTP session, so every call in this module reuses pooled keep-alive connections
+_session = None
+
+def configure_session(pool_size=10, max_retries=3):
+    """
+    configure_session (re)creates the shared HTTP session used by all functions in this module
+    --------
+     Inputs:
+         pool_size: number of connections kept open per host; default = 10
+         max_retries: number of retries (with backoff) on connection errors and 429/5xx responses; default = 3
+    --------
+    Usage:
+    --------
+    configure_session(pool_size=20)
+    """
+    global _session
+    session = requests.Session()
+    retry = Retry(total=max_retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if _session is not None:
+        _session.close()
+    _session = session
+    return session
+
+def get_session():
+    # return the shared session, creating it with the default settings on first use
+    if _session is None:
+        configure_session()
+    return _session
+
+# functions called with a dictionary for every download event (see add_event_sink)
+_event_sinks = []
+
+# minimum seconds between two progress events for the same file
+PROGRESS_INTERVAL = 1.0
+
+def add_event_sink(sink):
+    """
+    add_event_sink registers a function that is called with a dictionary for every download event, 
+    to log, store or export transfer performance
+    --------
+    Every event has 'event', 'time' (unix seconds) and, by event:
+        start: name, url, path, size (expected bytes)
+        progress: name, bytes (on disk so far), size, seconds, rate (bytes/s), eta (seconds, None if the size is unknown)
+        complete: name, path, bytes (transferred), seconds, rate, verified (True, or None if there was no checksum)
+        error: name, path, bytes (transferred), seconds, error
+    The LoggingSink, JsonLinesSink and PrometheusTextfileSink in neon_aop_download.py can be used here too.
+    --------
+    Usage:
+    --------
+    add_event_sink(json_lines_sink('./data/download_events.jsonl'))
+    add_event_sink(lambda e: print(e) if e['event'] == 'complete' else None)
+    """
+    _event_sinks.append(sink)
+
+def remove_event_sink(sink):
+    # stop sending events to a sink registered with add_event_sink
+    _event_sinks.remove(sink)
+
+def json_lines_sink(filename):
+    # event sink that appends every event as one json line to filename
+    def sink(record):
+        with open(filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return sink
+
+def _emit(event, **fields):
+    if not _event_sinks:
+        return
+    record = {'event': event, 'time': time.time()}
+    record.update(fields)
+    for sink in list(_event_sinks):
+        try:
+            sink(record)
+        except Exception as e:
+            # a broken sink must not stop the download
+            print('WARNING: event sink ' + repr(sink) + ' failed: ' + str(e))
+
+class _Progress:
+    # sends throttled progress events for one file; called with the size of each block written
+    def __init__(self, name, size=None):
+        self.name = name
+        self.size = size
+        self.start = self.last = time.perf_counter()
+        self.transferred = 0
+        self.position = 0
+
+    def __call__(self, n):
+        self.transferred += n
+        self.position += n
+        now = time.perf_counter()
+        if now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        seconds = now - self.start
+        rate = self.transferred / seconds if seconds > 0 else 0.0
+        eta = (self.size - self.position) / rate if self.size and rate > 0 else None
+        _emit('progress', name=self.name, bytes=self.position, size=self.size, seconds=seconds, rate=rate, eta=eta)
 
 def list_available_urls(product,site):
     """
@@ -20,11 +132,12 @@ def list_available_urls(product,site):
     --------
     jorn_chm_urls = list_available_urls('DP3.30015.001','JORN')
     """
-    r = requests.get("http://data.neonscience.org/api/v0/products/" + product)
-    for i in range(len(r.json()['data']['siteCodes'])):
-        if site in r.json()['data']['siteCodes'][i]['siteCode']:
-            data_urls=r.json()['data']['siteCodes'][i]['availableDataUrls']
-    if 'data_urls' not in locals() or len(data_urls) == 0:
+    site_codes = get_session().get(NEON_API_URL + "products/" + product).json()['data']['siteCodes']
+    data_urls = []
+    for site_info in site_codes:
+        if site in site_info['siteCode']:
+            data_urls = site_info['availableDataUrls']
+    if len(data_urls) == 0:
         print('WARNING: no urls found for product ' + product + ' at site ' + site)
     else:
         return data_urls
@@ -42,47 +155,579 @@ def list_available_urls_by_year(product,site,year):
     --------
     jorn_chm_2018_url = list_available_urls_by_year('DP3.30015.001','JORN','2018')
     """
-    r = requests.get("http://data.neonscience.org/api/v0/products/" + product)
-    for i in range(len(r.json()['data']['siteCodes'])):
-        if site in r.json()['data']['siteCodes'][i]['siteCode']:
-            all_data_urls=r.json()['data']['siteCodes'][i]['availableDataUrls']
+    site_codes = get_session().get(NEON_API_URL + "products/" + product).json()['data']['siteCodes']
+    all_data_urls = []
+    for site_info in site_codes:
+        if site in site_info['siteCode']:
+            all_data_urls = site_info['availableDataUrls']
     data_urls = [url for url in all_data_urls if year in url]
     if len(data_urls)==0:
         print('WARNING: no urls found for product ' + product + ' at site ' + site + ' in year ' + year)
     else:
         return data_urls
     
-def download_urls(url_list,download_folder_root,zip=False):
+def load_manifest(download_folder):
+    """
+    load_manifest reads the download manifest (MANIFEST_NAME) from a download folder
+    --------
+    Returns a dictionary of {file name: {'size', 'md5', 'crc32', 'mtime'}}; empty if there is no manifest yet
+    """
+    manifest_file = os.path.join(download_folder, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def save_manifest(download_folder, manifest):
+    # write to a temporary file first so an interrupted run never leaves a truncated manifest
+    manifest_file = os.path.join(download_folder, MANIFEST_NAME)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def file_checksum(filename, algorithm='md5'):
+    # hex digest of a local file, algorithm is 'md5' or 'crc32'
+    if algorithm == 'crc32':
+        crc = 0
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                crc = zlib.crc32(block, crc)
+        return format(crc, '08x')
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _same_checksum(a, b):
+    # the API may report crc32 with or without a 0x prefix
+    if a is None or b is None:
+        return False
+    a, b = str(a).lower(), str(b).lower()
+    if a.startswith('0x') or b.startswith('0x'):
+        return int(a, 16) == int(b, 16)
+    return a == b
+
+def is_up_to_date(file_info, download_folder, manifest):
+    """
+    is_up_to_date checks whether a file from the API data['files'] list is already in download_folder
+    --------
+    The local file must have the size reported by the API. If the manifest already recorded that 
+    file (same size, md5/crc32 and modification time), that is trusted; otherwise the local file is 
+    checksummed against the API md5 (or crc32) and the result is added to the manifest.
+    """
+    filename = os.path.join(download_folder, file_info['name'])
+    if not os.path.exists(filename):
+        return False
+    stat = os.stat(filename)
+    if stat.st_size != int(file_info['size']):
+        return False
+
+    entry = manifest.get(file_info['name'])
+    if entry is not None and entry.get('verified') is False:
+        return False
+    if entry is not None and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+        if file_info.get('md5'):
+            return _same_checksum(entry.get('md5'), file_info['md5'])
+        if file_info.get('crc32'):
+            return _same_checksum(entry.get('crc32'), file_info['crc32'])
+        return True
+
+    # not in the manifest (or changed on disk since): verify the content
+    if file_info.get('md5'):
+        if not _same_checksum(file_checksum(filename, 'md5'), file_info['md5']):
+            return False
+    elif file_info.get('crc32'):
+        if not _same_checksum(file_checksum(filename, 'crc32'), file_info['crc32']):
+            return False
+    record_in_manifest(manifest, file_info, download_folder)
+    return True
+
+def record_in_manifest(manifest, file_info, download_folder, verified=True):
+    # record a downloaded file along with the checksums reported by the API and whether it matched them
+    # (a file that failed verification has been quarantined, so there is no local size or mtime to record)
+    filename = os.path.join(download_folder, file_info['name'])
+    stat = os.stat(filename) if os.path.exists(filename) else None
+    manifest[file_info['name']] = {'size': stat.st_size if stat else None,
+                                   'mtime': stat.st_mtime if stat else None,
+                                   'md5': file_info.get('md5'),
+                                   'crc32': file_info.get('crc32'),
+                                   'verified': verified}
+
+def download_urls(url_list,download_folder_root,zip=False,sync=False,verify=False,extract=False,members=None,skip_existing=False,
+                  mirror=None):
     # downloads data from urls to folder, maintaining month-year folder structure
+    # sync=True skips files that are already present and unchanged (see is_up_to_date)
+    # verify=True checks each file against the API md5/crc32 as it downloads and records the result in the manifest
+    # (neon_manifest.json in each month folder); off by default, so plain calls write only the data files
+    # extract=True streams the .zip files and extracts their members (optionally only members, and only those
+    # not already on disk with skip_existing=True) straight into the month folder, without saving the zips
+    # mirror (a neon_aop_mirror.LocalMirror) links files it already holds instead of downloading them, and keeps new ones
     for url in url_list:
         month = url.split('/')[-1]
         download_folder = download_folder_root + month + '/'
         if not os.path.exists(download_folder):
             os.makedirs(download_folder)
-        r=requests.get(url)
+        manifest = load_manifest(download_folder) if (sync or verify) else None
+        r=get_session().get(url)
         files=r.json()['data']['files']
         for i in range(len(files)):
-            if zip==False:
-                if '.zip' not in files[i]['name']:
-                    print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                    urllib.request.urlretrieve(files[i]['url'],download_folder + files[i]['name'])
-            elif zip==True:
-                if '.zip' in files[i]['name']:
-                    print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                    urllib.request.urlretrieve(files[i]['url'],download_folder + files[i]['name'])
-
-def download_file(url,filename):
-    r = requests.get(url)
-    with open(filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024): 
-            if chunk: # filter out keep-alive new chunks
-                f.write(chunk)
-    return
+            if (zip or extract) != ('.zip' in files[i]['name']):
+                continue
+            checksums = {'md5': files[i].get('md5'), 'crc32': files[i].get('crc32')} if verify else {}
+            if extract:
+                print('extracting ' + files[i]['name'] + ' to ' + download_folder)
+                try:
+                    extracted, verified = download_zip_extract(files[i]['url'], download_folder, members, skip_existing, **checksums)
+                except (requests.exceptions.RequestException, zipfile.BadZipFile) as e:
+                    print(e)
+                    continue
+                if manifest is not None:
+                    record_in_manifest(manifest, files[i], download_folder, verified is not False)
+                    manifest[files[i]['name']]['extracted'] = [os.path.relpath(path, download_folder) for path in extracted]
+                    save_manifest(download_folder, manifest)
+                continue
+            if sync and is_up_to_date(files[i], download_folder, manifest):
+                print('skipping ' + files[i]['name'] + ', already in ' + download_folder)
+                continue
+            if mirror is not None and mirror.materialize(files[i], download_folder + files[i]['name']):
+                print('linked ' + files[i]['name'] + ' from the mirror to ' + download_folder)
+                verified = True
+            else:
+                print('downloading ' + files[i]['name'] + ' to ' + download_folder)
+                verified = download_file(files[i]['url'],download_folder + files[i]['name'],int(files[i]['size']),**checksums)
+                if mirror is not None and verified is not False:
+                    mirror.store(files[i], download_folder + files[i]['name'], verified=bool(verified))
+            if manifest is not None:
+                record_in_manifest(manifest, files[i], download_folder, verified is not False)
+                save_manifest(download_folder, manifest)
+        if manifest is not None:
+            save_manifest(download_folder, manifest)
+
+class StreamChecksum:
+    """
+    StreamChecksum keeps a running md5 and/or crc32 of a file as it is written, so a download can be
+    verified against the checksums in the API data['files'] without reading the file a second time
+    """
+    def __init__(self, md5=None, crc32=None):
+        self.expected_md5 = md5
+        self.expected_crc32 = crc32
+        self.reset()
+
+    def reset(self):
+        self.nbytes = 0
+        self._md5 = hashlib.md5() if self.expected_md5 else None
+        self._crc32 = 0 if self.expected_crc32 else None
+
+    def update(self, block):
+        self.nbytes += len(block)
+        if self._md5 is not None:
+            self._md5.update(block)
+        if self._crc32 is not None:
+            self._crc32 = zlib.crc32(block, self._crc32)
+
+    def update_from_file(self, filename):
+        # catch up on bytes written before this call (eg. the start of a resumed .part file)
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                self.update(block)
+
+    def matches(self):
+        # True / False once verified, None if the API gave no checksum to verify against
+        if self._md5 is not None:
+            return _same_checksum(self._md5.hexdigest(), self.expected_md5)
+        if self._crc32 is not None:
+            return _same_checksum(format(self._crc32, '08x'), self.expected_crc32)
+        return None
+
+def stream_to_file(r, f, buffer_size=BUFFER_SIZE, checksum=None, progress=None):
+    """
+    stream_to_file copies the body of a streamed (stream=True) response into an open binary file,
+    reading straight into one reusable buffer with readinto; returns the number of bytes written
+    checksum (optional) is a StreamChecksum updated with every block as it is written
+    progress (optional) is called with the size of each block once it is written
+    """
+    r.raw.decode_content = True
+    buffer = memoryview(bytearray(buffer_size))
+    nbytes = 0
+    try:
+        while True:
+            n = r.raw.readinto(buffer)
+            if not n:
+                break
+            f.write(buffer[:n])
+            nbytes += n
+            if checksum is not None:
+                checksum.update(buffer[:n])
+            if progress is not None:
+                progress(n)
+    # report dropped connections the same way requests' iter_content does
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    return nbytes
+
+def quarantine_file(part_filename, filename):
+    # move a download that failed verification into a quarantine folder next to its destination
+    quarantine_folder = os.path.join(os.path.dirname(filename), 'quarantine')
+    if not os.path.exists(quarantine_folder):
+        os.makedirs(quarantine_folder)
+    quarantined = os.path.join(quarantine_folder, os.path.basename(filename))
+    os.replace(part_filename, quarantined)
+    return quarantined
+
+def _download_part(url, part_filename, size, max_retries, buffer_size, checksum, progress=None):
+    # fetch url into part_filename, resuming after dropped connections; True once the transfer is complete
+    for attempt in range(max_retries + 1):
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        if size is not None and offset > size:
+            # left-over part file is larger than the file on the server; start over
+            os.remove(part_filename)
+            offset = 0
+        if size is not None and offset == size:
+            break
+        headers = {'Range': 'bytes=' + str(offset) + '-'} if offset > 0 else {}
+        try:
+            r = get_session().get(url, headers=headers, stream=True)
+            if r.status_code == 416 and offset > 0:
+                r.close()
+                # nothing past offset: the part file is complete if it is as long as the file on the 
+                # server (Content-Range: bytes */size), otherwise it is stale and the download starts over
+                if r.headers.get('Content-Range', '').split('/')[-1] == str(offset):
+                    size = offset
+                    break
+                os.remove(part_filename)
+                continue
+            r.raise_for_status()
+            # 206 = partial content, append to the part file; 200 = server ignored the range, rewrite
+            # (the part file is not preallocated, since its length is what tells a later call where to resume)
+            mode = 'ab' if r.status_code == 206 else 'wb'
+            checksum.reset()
+            if mode == 'ab':
+                checksum.update_from_file(part_filename)
+            if progress is not None:
+                progress.position = offset if mode == 'ab' else 0
+            with open(part_filename, mode) as f:
+                try:
+                    stream_to_file(r, f, buffer_size, checksum, progress)
+                finally:
+                    r.close()
+            if size is None or os.path.getsize(part_filename) == size:
+                break
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            if attempt == max_retries:
+                raise
+            print('download of ' + os.path.basename(part_filename[:-5]) + ' interrupted (' + str(e) + '), resuming')
+
+    if size is not None and os.path.getsize(part_filename) != size:
+        print('WARNING: ' + os.path.basename(part_filename[:-5]) + ' is ' + str(os.path.getsize(part_filename)) + 
+              ' bytes, expected ' + str(size) + '; keeping ' + part_filename + ' to resume later')
+        return False
+    if checksum.nbytes != os.path.getsize(part_filename):
+        # the part file was already complete from an earlier call, so nothing was streamed through the checksum
+        checksum.reset()
+        checksum.update_from_file(part_filename)
+    return True
+
+def download_file(url,filename,size=None,max_retries=3,buffer_size=BUFFER_SIZE,md5=None,crc32=None,verify_retries=1):
+    """
+    download_file downloads a single file, resuming an interrupted transfer where it stopped, and 
+    verifies it against the API checksum while it streams to disk
+    --------
+     Inputs:
+         url: url of the file to download (the 'url' field in the API data['files'])
+         filename: full path of the file to write
+         size (optional): expected size in bytes (the 'size' field in the API data['files'])
+         max_retries (optional): number of times to resume after a dropped connection; default = 3
+         buffer_size (optional): bytes read per block while streaming to disk; default = BUFFER_SIZE (8 MiB)
+         md5, crc32 (optional): expected checksums (the 'md5' / 'crc32' fields in the API data['files'])
+         verify_retries (optional): number of fresh downloads after a checksum mismatch; default = 1
+    --------
+    Bytes are written to filename + '.part' and the .part file is only renamed to filename once
+    the transfer is complete (and matches size, if given). If a .part file is left over from an
+    earlier call, the download resumes from its end using an HTTP Range request. A file that does
+    not match its checksum is moved to a quarantine folder next to filename and downloaded again.
+    --------
+    Returns:
+    --------
+    True if the checksum matched, False if it did not (or the transfer is incomplete), None if no checksum was given
+    """
+    part_filename = filename + '.part'
+    name = os.path.basename(filename)
+    _emit('start', name=name, url=url.split('?')[0], path=filename, size=size)
+    progress = _Progress(name, size) if _event_sinks else None
+    start = time.perf_counter()
+    def finished(event, **fields):
+        seconds = time.perf_counter() - start
+        transferred = progress.transferred if progress is not None else None
+        _emit(event, name=name, path=filename, bytes=transferred, seconds=seconds, **fields)
+    try:
+        for verify_attempt in range(verify_retries + 1):
+            checksum = StreamChecksum(md5, crc32)
+            if not _download_part(url, part_filename, size, max_retries, buffer_size, checksum, progress):
+                finished('error', error='incomplete transfer')
+                return False
+            verified = checksum.matches()
+            if verified is False:
+                quarantined = quarantine_file(part_filename, filename)
+                print('WARNING: checksum mismatch for ' + os.path.basename(filename) + ', moved to ' + quarantined)
+                continue
+            os.replace(part_filename, filename)
+            seconds = time.perf_counter() - start
+            finished('complete', rate=progress.transferred / seconds if progress is not None and seconds > 0 else 0.0,
+                     verified=verified)
+            return verified
+    except requests.exceptions.RequestException as e:
+        finished('error', error=str(e))
+        raise
+    finished('error', error='checksum mismatch')
+    return False
+
+# zip record signatures
+_ZIP_LOCAL_HEADER = b'PK\x03\x04'
+_ZIP_DATA_DESCRIPTOR = b'PK\x07\x08'
+
+class _StreamReader:
+    # exact-size reads from a streamed response body, with push-back, feeding a StreamChecksum if given;
+    # reopen (optional) is a function(offset) returning a new body from offset on, to resume after a dropped connection
+    def __init__(self, raw, checksum=None, reopen=None, max_retries=3):
+        self.raw = raw
+        self.checksum = checksum
+        self.reopen = reopen
+        self.max_retries = max_retries
+        self.offset = 0
+        self.retries = 0
+        self._pending = b''
+
+    def _read_raw(self, n):
+        try:
+            return self.raw.read(n)
+        except urllib3.exceptions.ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+
+    def read(self, n):
+        data = self._pending[:n]
+        self._pending = self._pending[n:]
+        while len(data) < n:
+            try:
+                block = self._read_raw(n - len(data))
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if self.reopen is None or self.retries == self.max_retries:
+                    raise
+                self.retries += 1
+                print('zip stream interrupted at ' + str(self.offset) + ' bytes (' + str(e) + '), resuming')
+                self.raw = self.reopen(self.offset)
+                continue
+            if not block:
+                break
+            if self.checksum is not None:
+                self.checksum.update(block)
+            self.offset += len(block)
+            data += block
+        return data
+
+    def read_exact(self, n):
+        data = self.read(n)
+        if len(data) < n:
+            raise zipfile.BadZipFile('zip stream ended unexpectedly')
+        return data
+
+    def unread(self, data):
+        self._pending = data + self._pending
+
+def _wanted_member(name, members):
+    # members: None (everything), a glob pattern, a list of names / glob patterns, or a function of the name
+    if members is None:
+        return True
+    if callable(members):
+        return members(name)
+    if isinstance(members, str):
+        members = [members]
+    return any(name == m or os.path.basename(name) == m or fnmatch.fnmatch(name, m) for m in members)
+
+def extract_zip_stream(raw, download_folder, members=None, skip_existing=False, checksum=None, buffer_size=BUFFER_SIZE,
+                       reopen=None, max_retries=3):
+    """
+    extract_zip_stream reads a zip archive sequentially from a stream (eg. the raw body of a 
+    stream=True response) and writes the selected members straight to download_folder, 
+    keeping their folder structure inside the zip; returns the list of paths written
+    --------
+    The zip is never saved to disk. Each member is checked against the crc32 stored in the zip.
+    Stored and deflated members (the methods NEON uses) are supported, including zip64 sizes.
+    If the stream fails, the member being written is removed rather than left as a .part file; with
+    reopen (a function(offset) returning the stream from byte offset on) a dropped connection is 
+    resumed where it stopped instead, up to max_retries times.
+    """
+    reader = _StreamReader(raw, checksum, reopen, max_retries)
+    extracted = []
+    while True:
+        signature = reader.read(4)
+        if signature != _ZIP_LOCAL_HEADER:
+            # central directory (or end of stream): every member has been read
+            break
+        (version, flags, method, mod_time, mod_date, crc, compressed_size, size,
+         name_length, extra_length) = struct.unpack('<HHHHHIIIHH', reader.read_exact(26))
+        name = reader.read_exact(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = reader.read_exact(extra_length)
+        zip64 = False
+        if compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF:
+            # sizes are in the zip64 extra field (header id 1): uncompressed size, then compressed size
+            i = 0
+            while i + 4 <= len(extra):
+                header_id, data_size = struct.unpack('<HH', extra[i:i+4])
+                if header_id == 1:
+                    size, compressed_size = struct.unpack('<QQ', extra[i+4:i+20])
+                    zip64 = True
+                    break
+                i += 4 + data_size
+        if flags & 0x1:
+            raise zipfile.BadZipFile(name + ' is encrypted')
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise zipfile.BadZipFile(name + ' uses an unsupported compression method (' + str(method) + ')')
+        has_descriptor = bool(flags & 0x8)
+        if has_descriptor and method == zipfile.ZIP_STORED:
+            raise zipfile.BadZipFile(name + ' is stored with a data descriptor, which cannot be streamed')
+
+        # never write outside download_folder
+        target = os.path.normpath(os.path.join(download_folder, name))
+        if not target.startswith(os.path.normpath(download_folder) + os.sep):
+            raise zipfile.BadZipFile('unsafe member path ' + name)
+        is_dir = name.endswith('/')
+        extract = (not is_dir and _wanted_member(name, members) and 
+                   not (skip_existing and os.path.exists(target)))
+        if is_dir and _wanted_member(name, members):
+            os.makedirs(target, exist_ok=True)
+        if extract:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            out = open(target + '.part', 'wb')
+        member_crc = 0
+        try:
+            if method == zipfile.ZIP_STORED:
+                remaining = compressed_size
+                while remaining > 0:
+                    block = reader.read_exact(min(buffer_size, remaining))
+                    remaining -= len(block)
+                    if extract:
+                        member_crc = zlib.crc32(block, member_crc)
+                        out.write(block)
+            else:
+                inflater = zlib.decompressobj(-15)
+                remaining = None if has_descriptor else compressed_size
+                while not inflater.eof:
+                    want = buffer_size if remaining is None else min(buffer_size, remaining)
+                    if want == 0:
+                        break
+                    block = reader.read(want)
+                    if not block:
+                        raise zipfile.BadZipFile('zip stream ended inside ' + name)
+                    if remaining is not None:
+                        remaining -= len(block)
+                    if extract:
+                        data = inflater.decompress(block)
+                        member_crc = zlib.crc32(data, member_crc)
+                        out.write(data)
+                    elif remaining is None:
+                        # skipped member of unknown length: inflate only to find where it ends
+                        inflater.decompress(block)
+                if inflater.unused_data:
+                    reader.unread(inflater.unused_data)
+            if has_descriptor:
+                descriptor = reader.read_exact(4)
+                if descriptor == _ZIP_DATA_DESCRIPTOR:
+                    descriptor = reader.read_exact(4)
+                crc = struct.unpack('<I', descriptor)[0]
+                reader.read_exact(16 if zip64 else 8)
+        except BaseException:
+            # don't leave a partial member behind
+            if extract:
+                out.close()
+                os.remove(target + '.part')
+            raise
+        finally:
+            if extract:
+                out.close()
+        if extract:
+            if member_crc != crc:
+                os.remove(target + '.part')
+                raise zipfile.BadZipFile('crc32 mismatch for ' + name)
+            os.replace(target + '.part', target)
+            extracted.append(target)
+    return extracted
+
+def download_zip_extract(url, download_folder, members=None, skip_existing=False, md5=None, crc32=None, buffer_size=BUFFER_SIZE,
+                         max_retries=3):
+    """
+    download_zip_extract streams a zip file from url and extracts the selected members into download_folder
+    as it downloads, without saving the zip itself
+    --------
+     Inputs:
+         url: url of the zip file (the 'url' field in the API data['files'])
+         download_folder: folder to extract into
+         members (optional): members to extract - a list of names or glob patterns (eg. '*.csv'), or a 
+                             function taking the member name; default (None) extracts everything
+         skip_existing (optional): don't rewrite members that already exist in download_folder; default = False
+         md5, crc32 (optional): expected checksums of the zip file, verified as it streams
+         max_retries (optional): times a dropped connection is resumed (with an HTTP Range request) from
+                                 where it stopped; default = 3
+    --------
+    Returns:
+    --------
+    (list of extracted paths, verified) where verified is True / False, or None if no checksum was given
+    --------
+    Usage:
+    --------
+    download_zip_extract(zip_url, './data/2019-08/', members='*.csv', skip_existing=True)
+    """
+    checksum = StreamChecksum(md5, crc32)
+    responses = []
+    def reopen(offset):
+        # the rest of the zip from offset, after a dropped connection
+        r = get_session().get(url, headers={'Range': 'bytes=' + str(offset) + '-'} if offset else {}, stream=True)
+        responses.append(r)
+        r.raise_for_status()
+        r.raw.decode_content = True
+        if offset and r.status_code != 206:
+            # the server ignored the range: skip what was already read (and checksummed)
+            while offset > 0:
+                block = r.raw.read(min(buffer_size, offset))
+                if not block:
+                    raise requests.exceptions.ConnectionError('zip stream ended before byte ' + str(offset))
+                offset -= len(block)
+        return r.raw
+    try:
+        raw = reopen(0)
+        extracted = extract_zip_stream(raw, download_folder, members, skip_existing, checksum, buffer_size,
+                                       reopen, max_retries)
+        # drain the central directory so the whole zip goes through the checksum
+        for block in iter(lambda: responses[-1].raw.read(buffer_size), b''):
+            checksum.update(block)
+    finally:
+        for r in responses:
+            r.close()
+    verified = checksum.matches()
+    if verified is False:
+        print('WARNING: checksum mismatch for ' + os.path.basename(url.split('?')[0]) + 
+              '; the extracted files may be incomplete or corrupt')
+    return extracted, verified
+
+def format_size(size):
+    # size in bytes as a human-readable string, in decimal (SI) units
+    if size < 10**3:
+        return str(size) + ' bytes'
+    for unit, scale in (('kB', 10**3), ('MB', 10**6), ('GB', 10**9)):
+        if size < scale * 10**3:
+            return str(round(size/scale, 2)) + ' ' + unit
+    return str(round(size/(10**12), 2)) + ' TB'
 
 def get_file_size(urls,match_string):
     size=0
     for url in urls:
-        r = requests.get(url)
+        r = get_session().get(url)
         files = r.json()['data']['files']
         for i in range(len(files)):
             if match_string is not None:
@@ -91,19 +736,91 @@ def get_file_size(urls,match_string):
                     size += int(files[i]['size'])
             else:
                 size += int(files[i]['size'])
-    if size < 10**3:
-        print('Download size:',size,'bytes')
-    elif size > 10**3 and size < 10**6:
-        print('Download size:',round(size/(10**6),2),'kB')
-    elif size > 10**6 and size < 10**9:
-        print('Download size:',round(size/(10**6),2),'MB')
-    elif size > 10**9 and size < 10**12:
-        print('Download size:',round(size/(10**9),2),'GB')
-    else:
-        print('Download size:',round(size/(10**12),2),'TB')
+    print('Download size:',format_size(size))
+    return size
+
+def _bytes_needed(file_info, download_folder):
+    # bytes a file still has to add to the disk: none if it is already there at full size, 
+    # less whatever a left-over .part file already holds (download_file resumes it)
+    filename = os.path.join(download_folder, file_info['name'])
+    size = int(file_info['size'])
+    if os.path.exists(filename) and os.path.getsize(filename) == size:
+        return 0
+    if os.path.exists(filename + '.part'):
+        return max(0, size - os.path.getsize(filename + '.part'))
     return size
 
-def download_aop_files(product,site,year=None,download_folder='./data',match_string=None,check_size=True):
+def check_disk_space(files, download_folder, quota=None, min_free_bytes=0, trim=False):
+    """
+    check_disk_space checks, before downloading, that a list of files fits in the free space of the 
+    filesystem download_folder is on, and in an optional quota
+    --------
+     Inputs:
+         files: list of file dictionaries (the API data['files'] field)
+         download_folder: folder the files will be downloaded to
+         quota (optional): maximum number of bytes the download may add
+         min_free_bytes (optional): space to leave free on the filesystem; default = 0
+         trim (optional): if the files don't fit, keep the ones (in order) that do instead of refusing; default = False
+    --------
+    Returns:
+    --------
+    the files to download (all of them, or the trimmed list), or None if they don't fit and trim is False
+    --------
+    Usage:
+    --------
+    files = check_disk_space(files, './data/JORN_2019/CHM', quota=50*10**9, min_free_bytes=10**9)
+    """
+    folder = os.path.abspath(download_folder)
+    while not os.path.exists(folder):
+        folder = os.path.dirname(folder)
+    available = shutil.disk_usage(folder).free - min_free_bytes
+    if quota is not None:
+        available = min(available, quota)
+    needed = [_bytes_needed(file_info, download_folder) for file_info in files]
+    if sum(needed) <= available:
+        return files
+    print('WARNING: download needs ' + format_size(sum(needed)) + ', only ' + format_size(max(0, available)) + 
+          ' available' + (' (quota ' + format_size(quota) + ')' if quota is not None else ''))
+    if not trim:
+        return None
+    kept = []
+    for file_info, nbytes in zip(files, needed):
+        if nbytes <= available:
+            kept.append(file_info)
+            available -= nbytes
+    print('WARNING: downloading ' + str(len(kept)) + ' of ' + str(len(files)) + ' files')
+    return kept
+
+def confirm_download(size, count=0, check_size=True, size_policy=None):
+    """
+    confirm_download decides whether a download of size bytes (count files) goes ahead, by size_policy 
+    if one is given, otherwise by a (y/n) prompt
+    --------
+     Inputs:
+         size: planned download size in bytes
+         count (optional): number of files
+         check_size (optional): prompt to continue (y/n) if there is no size_policy; default = True
+         size_policy (optional): a maximum size in bytes, or a function(size, count) returning True to continue
+                                 (eg. a SizePolicy from neon_aop_download.py); replaces the prompt, for
+                                 unattended jobs
+    --------
+    Usage:
+    --------
+    confirm_download(25*10**9, 120, size_policy=50*10**9)
+    """
+    if size_policy is not None:
+        if callable(size_policy):
+            return bool(size_policy(size, count))
+        if size > size_policy:
+            print('download of ' + format_size(size) + ' exceeds the size_policy limit (' + format_size(size_policy) + ')')
+            return False
+        return True
+    if not check_size:
+        return True
+    return input("Do you want to continue with the download? (y/n) ") == "y"
+
+def download_aop_files(product,site,year=None,download_folder='./data',match_string=None,check_size=True,sync=False,verify=True,
+                       quota=None,min_free_bytes=0,trim=False,size_policy=None,mirror=None):
     """
     download_aop_files downloads NEON AOP files from the AOP for a given data product, site, and 
     optional year, download folder, and 
@@ -118,10 +835,30 @@ def download_aop_files(product,site,year=None,download_folder='./data',match_str
              download_folder: folder to store downloaded files; default (./data) in current directory
              match_string: subset of data to match, need to use exact pattern for file name
              check_size: prompt to continue download (y/n) after displaying size; default = True
+             size_policy: decide without prompting - a maximum size in bytes, or a function(size, count) returning 
+                          True to continue (see confirm_download); default (None) uses check_size
+             mirror: a neon_aop_mirror.LocalMirror shared by all your projects; files it already holds are 
+                     linked into download_folder instead of downloaded, and new downloads are added to it
+             sync: only download files that are new or changed since the last run, using the size 
+                   and md5/crc32 reported by the API and the manifest kept in download_folder; default = False
+             verify: check each file against the API md5/crc32 as it downloads, quarantine and re-download 
+                     mismatches, and record the results in the manifest; default = True
+             quota: maximum number of bytes the download may add to download_folder's filesystem
+             min_free_bytes: space to leave free on that filesystem; default = 0
+             trim: if the files don't fit, download the ones that do instead of refusing; default = False
+    --------
+    Returns:
+    --------
+    dictionary with the planned download size ('planned_bytes'), whether it was approved ('approved'),
+    the number of files downloaded ('files') and the names of the files that failed to download or 
+    did not match their checksum ('failed')
     --------
     Usage:
     --------
     download_aop_files('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM','314000_3610000_CHM.tif')
+    download_aop_files('DP3.30015.001','JORN','2019','./data/JORN_2019/CHM',check_size=False,sync=True)
+    download_aop_files('DP3.30006.001','JORN','2019','./data/JORN_2019/refl',quota=100*10**9,trim=True)
+    download_aop_files('DP3.30006.001','JORN','2019','./data/JORN_2019/refl',size_policy=lambda size, count: size < 50*10**9)
     """
     
     #get a list of the urls for a given data product, site, and year (if included)
@@ -134,29 +871,68 @@ def download_aop_files(product,site,year=None,download_folder='./data',match_str
     if not os.path.exists(download_folder):
         os.makedirs(download_folder)
     
-    #get the size of all the files you are planning to download
-    size = get_file_size(urls,match_string)
+    #list the files you are planning to download, requesting each url once
+    manifest = load_manifest(download_folder) if (sync or verify) else None
+    files = []
+    for url in urls:
+        r = get_session().get(url)
+        for file_info in r.json()['data']['files']:
+            if match_string is not None and match_string not in file_info['name']:
+                continue
+            if sync and is_up_to_date(file_info, download_folder, manifest):
+                print('skipping ' + file_info['name'] + ', already in ' + download_folder)
+                continue
+            files.append(file_info)
     
-    #prompt to continue with download after displaying the file size
-    if check_size:
-        if input("Do you want to continue with the download? (y/n) ") != "y":
-            print('Exiting download_aop_files')
-            return
+    #check the files fit on disk (and in the quota) before anything is downloaded
+    fits = check_disk_space(files, download_folder, quota, min_free_bytes, trim)
+    if fits is None:
+        print('Exiting download_aop_files')
+        return {'planned_bytes': sum(int(file_info['size']) for file_info in files), 'approved': False, 'files': 0, 'failed': []}
+    files = fits
     
-    #download files in the urls
-    for url in urls:
-        r = requests.get(url)
-        files = r.json()['data']['files']
-        for i in range(len(files)):
-            if match_string is not None:
-                if match_string in files[i]['name']:
-                    print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                    try:
-                        download_file(files[i]['url'],os.path.join(download_folder,files[i]['name']))
-                    except requests.exceptions.RequestException as e:
-                        print(e)
-            else:
-                try:
-                    download_file(files[i]['url'],os.path.join(download_folder,files[i]['name']))
-                except requests.exceptions.RequestException as e:
-                    print(e)
+    #display the size of all the files you are planning to download
+    size = sum(int(file_info['size']) for file_info in files)
+    print('Download size:',format_size(size))
+    
+    #decide whether to continue from the size (size_policy, or a prompt if check_size)
+    if not confirm_download(size, len(files), check_size, size_policy):
+        print('Exiting download_aop_files')
+        return {'planned_bytes': size, 'approved': False, 'files': 0, 'failed': []}
+    
+    #download the files
+    downloaded = 0
+    failed = []
+    for file_info in files:
+        filename = os.path.join(download_folder,file_info['name'])
+        if mirror is not None and mirror.materialize(file_info, filename):
+            print('linked ' + file_info['name'] + ' from the mirror to ' + download_folder)
+            downloaded += 1
+            if manifest is not None:
+                record_in_manifest(manifest, file_info, download_folder, True)
+                save_manifest(download_folder, manifest)
+            continue
+        if match_string is not None:
+            print('downloading ' + file_info['name'] + ' to ' + download_folder)
+        checksums = {'md5': file_info.get('md5'), 'crc32': file_info.get('crc32')} if verify else {}
+        try:
+            verified = download_file(file_info['url'],filename,int(file_info['size']),**checksums)
+        except requests.exceptions.RequestException as e:
+            print(e)
+            failed.append(file_info['name'])
+            continue
+        if verified is False:
+            # quarantined (or left as an incomplete .part file) by download_file
+            failed.append(file_info['name'])
+        else:
+            downloaded += 1
+            if mirror is not None:
+                mirror.store(file_info, filename, verified=bool(verified))
+        if manifest is not None:
+            record_in_manifest(manifest, file_info, download_folder, verified is not False)
+            save_manifest(download_folder, manifest)
+    if manifest is not None:
+        save_manifest(download_folder, manifest)
+    if failed:
+        print('WARNING: ' + str(len(failed)) + ' files failed to download or did not match their checksum: ' + ', '.join(failed))
+    return {'planned_bytes': size, 'approved': True, 'files': downloaded, 'failed': failed}
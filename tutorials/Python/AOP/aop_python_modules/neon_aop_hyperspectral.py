@@ -16,7 +16,9 @@ ls_dataset (called with h5py.File.visititems):
 aop_h5refl2array:
     reads in NEON AOP reflectance hdf5 file, convert to a cleaned reflectance 
     array and return associated metadata (spatial information and band center 
-    wavelengths)
+    wavelengths); the file can also be read remotely from its url, fetching 
+    only the parts covering the requested pixels and bands (this uses the 
+    RemoteFile of neon_aop_remote.py, in the same folder as this module)
 
 plot_aop_refl:
     reads in and plot a single band or 3 stacked bands of a reflectance array
@@ -71,6 +73,21 @@ def ls_dataset(name,node):
     if isinstance(node, h5py.Dataset):
         print(node)
 
+# bytes per range request when reading a remote hdf5 file; each block holds several hdf5 chunks, so the few 
+# chunks covering a pixel are usually fetched in one or two requests
+REMOTE_BLOCK_SIZE = 2**20
+
+def _window(index, length):
+    # (start, stop) of the rows / columns selected by an integer or a slice; a window is contiguous, so a
+    # slice with a step is refused rather than given the extent of every pixel between start and stop
+    if isinstance(index, slice):
+        start, stop, step = index.indices(length)
+        if step != 1:
+            raise ValueError('pixels must be indices or slices without a step, got ' + str(index))
+        return start, stop
+    index = index + length if index < 0 else index
+    return index, index + 1
+
 # define raster types for the 
 _RASTER_TYPES = Literal["Cast_Shadow",
                         "Data_Selection_Index",
@@ -91,14 +108,17 @@ _RASTER_TYPES = Literal["Cast_Shadow",
 #     options = get_args(_TYPES)
 #     assert type_ in options, f"'{type_}' is not in {options}"
 
-def aop_h5refl2array(h5_filename, raster_type_: _RASTER_TYPES, only_metadata = False):
+def aop_h5refl2array(h5_filename, raster_type_: _RASTER_TYPES, only_metadata = False, pixels = None, bands = None,
+                     block_size = REMOTE_BLOCK_SIZE, cache = None):
     """read in NEON AOP reflectance hdf5 file and return the un-scaled 
     reflectance array, associated metadata, and wavelengths
            
     Parameters
     ----------
         h5_filename : string
-            reflectance hdf5 file name, including full or relative path
+            reflectance hdf5 file name, including full or relative path, or the 
+            url of the file (http/https), which is then read remotely with 
+            neon_aop_remote.RemoteFile instead of being downloaded
         raster : string
             name of raster value to read in; this will typically be the reflectance data, 
             but other data stored in the h5 file can be accessed as well
@@ -117,6 +137,21 @@ def aop_h5refl2array(h5_filename, raster_type_: _RASTER_TYPES, only_metadata = F
                 to-sensor_Zenith_Angle
                 Visibility_Index_Map: sea level values of visibility index / total optical thickeness
                 Weather_Quality_Indicator: estimated percentage of overhead cloud cover during acquisition
+        only_metadata : bool (optional)
+            return only the metadata and wavelengths, without reading the raster 
+            (raster_array is then None); default = False
+        pixels : tuple (optional)
+            (row, column) to read, each an index or a slice without a step, eg. 
+            (y_index, x_index) for a single pixel's spectrum or 
+            (slice(0,100), slice(200,300)) for a window; default (None) reads the 
+            whole raster
+        bands : list or slice (optional)
+            band indices to read (in increasing order); default (None) reads all bands
+        block_size : int (optional)
+            bytes fetched per range request when reading from a url; default = 1 MiB
+        cache : neon_aop_remote.BlockCache or folder (optional)
+            keep the blocks read from a url on disk, so reading the file again 
+            fetches nothing; default (None) only keeps them in memory
 
     Returns 
     --------
@@ -127,21 +162,33 @@ def aop_h5refl2array(h5_filename, raster_type_: _RASTER_TYPES, only_metadata = F
             bad_band_window1 (tuple)
             bad_band_window2 (tuple)
             bands: # of bands (float)
+            band_indices: indices of the bands read, when bands selects a subset (ndarray)
             data ignore value: value corresponding to no data (float)
             epsg: coordinate system code (float)
             map info: coordinate system, datum & ellipsoid, pixel dimensions, and origin coordinates (string)
             reflectance scale factor: factor by which reflectance is scaled (float)
     wavelengths: array
-            wavelength values, in nm
+            wavelength values, in nm (of the selected bands)
     --------
     Example Execution:
     --------
-    refl, refl_metadata = aop_h5refl2array('NEON_D02_SERC_DP3_368000_4306000_reflectance.h5','Reflectance') """
+    refl, refl_metadata = aop_h5refl2array('NEON_D02_SERC_DP3_368000_4306000_reflectance.h5','Reflectance') 
+    spectrum, refl_metadata, wavelengths = aop_h5refl2array(h5_url,'Reflectance',pixels=(y_index,x_index)) """
 
     raster_options = get_args(_RASTER_TYPES)
     assert raster_type_ in raster_options, f"'{raster_type_}' is not a recognized raster. You must select one of the following rasters: {raster_options}."
 
-    with h5py.File(h5_filename) as hdf5_file:
+    # read files given by url remotely, only fetching the blocks h5py asks for
+    if h5_filename.startswith(('http://','https://')):
+        try:
+            from neon_aop_remote import RemoteFile
+        except ImportError:
+            raise ImportError('reading an hdf5 file from its url needs neon_aop_remote.py (from the same folder as this module) on the path')
+        h5_source = RemoteFile(h5_filename, block_size, cache, memory_blocks=256)
+    else:
+        h5_source = h5_filename
+
+    with h5py.File(h5_source,'r') as hdf5_file:
         print('Reading in ',h5_filename)
         # get the site name
         sitename = str(list(hdf5_file.items())).split("'")[1]
@@ -230,13 +277,46 @@ def aop_h5refl2array(h5_filename, raster_type_: _RASTER_TYPES, only_metadata = F
         metadata['ext_dict']['yMin'] = yMin
         metadata['ext_dict']['yMax'] = yMax
         
+        # selection to read: every pixel and band by default
+        if pixels is None:
+            pixels = (slice(None), slice(None))
+        selection = tuple(pixels)
+        if len(rasterShape) == 3:
+            if bands is None:
+                bands = slice(None)
+            elif not isinstance(bands, slice):
+                bands = sorted(set(bands)) # h5py only reads band lists in increasing order
+            selection += (bands,)
+        
+        # extent of the selected window
+        row_start, row_stop = _window(pixels[0], rasterShape[0])
+        col_start, col_stop = _window(pixels[1], rasterShape[1])
+        if (row_start, row_stop, col_start, col_stop) != (0, rasterShape[0], 0, rasterShape[1]):
+            xMin, xMax = xMin + col_start*metadata['res']['pixelWidth'], xMin + col_stop*metadata['res']['pixelWidth']
+            yMin, yMax = yMax - row_stop*metadata['res']['pixelHeight'], yMax - row_start*metadata['res']['pixelHeight']
+            metadata['extent'] = (xMin,xMax,yMin,yMax)
+            metadata['ext_dict'] = {'xMin': xMin, 'xMax': xMax, 'yMin': yMin, 'yMax': yMax}
+        
+        wavelengths = wavelengths[:]
+        band_indices = np.arange(len(wavelengths))[bands] if len(rasterShape) == 3 else None
+        metadata['source'] = h5_filename
+        if only_metadata:
+            # nothing of the raster is read; metadata['shape'] is that of the whole raster
+            if band_indices is not None and len(band_indices) != len(wavelengths):
+                metadata['band_indices'] = band_indices
+                wavelengths = wavelengths[band_indices]
+            return None, metadata, wavelengths
+
+        # read only the selection; from a url, only the chunks covering it are fetched
         if raster_type_ == 'Radiance':
-            raster_array = productLoc['RadianceIntegerPart'][:] + productLoc['RadianceDecimalPart'][:]/metadata['scale_factor']
-            raster_array[raster_array==productLoc['RadianceIntegerPart'].attrs['Data_Ignore_Value']+productLoc['RadianceDecimalPart'].attrs['Data_Ignore_Value']/metadata['scale_factor']]=-9999
+            integerPart = productLoc['RadianceIntegerPart']
+            decimalPart = productLoc['RadianceDecimalPart']
+            raster_array = integerPart[selection] + decimalPart[selection]/metadata['scale_factor']
+            raster_array[raster_array==integerPart.attrs['Data_Ignore_Value']+decimalPart.attrs['Data_Ignore_Value']/metadata['scale_factor']]=-9999
             metadata['no_data_value'] = -9999
-
-        raster_array = raster_array[:]
-        wavelengths = wavelengths[:]
+        else:
+            raster_array = raster_array[selection]
+        metadata['shape'] = raster_array.shape
 
         if raster_type_ == 'Reflectance_Data':
             # create dictionary linking wavelength and band #
@@ -252,14 +332,14 @@ def aop_h5refl2array(h5_filename, raster_type_: _RASTER_TYPES, only_metadata = F
             # get bad bands
             bad_bands = list(range(bb1_min,bb1_max)) + list(range(bb2_min,bb2_max))
             
-            raster_array[:,:,bad_bands] = -100
+            raster_array[..., np.isin(band_indices, bad_bands)] = -100
 
-    metadata['source'] = h5_filename
-    
-    if only_metadata:
-        return raster_array[:], metadata, wavelengths
-    else:
-        return raster_array, metadata, wavelengths
+        # wavelengths of the bands that were read
+        if band_indices is not None and len(band_indices) != len(wavelengths):
+            wavelengths = wavelengths[band_indices]
+            metadata['band_indices'] = band_indices
+
+    return raster_array, metadata, wavelengths
 
 def plot_aop_refl(band_array,refl_extent,colorlimit=(0,1),ax=plt.gca(),title='',cbar ='on',cmap_title='',colormap='Greys'):
     
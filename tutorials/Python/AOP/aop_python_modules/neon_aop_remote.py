@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Windowed reads of NEON AOP GeoTIFF tiles (CHM, DTM, DSM, slope, aspect, ...) straight from their urls,
+for small-area analyses that only need part of a tile.
+
+A tile is opened with rasterio through RemoteFile, a file object that fetches fixed-size blocks of the
+file with HTTP range requests and keeps them in a local on-disk BlockCache, so reading a window only
+transfers the blocks (the GeoTIFF header and the internal tiles / strips) that cover it, and reading
+it again - in the same session or a later one - transfers nothing.
+
+RemoteFile and BlockCache only need requests, so other readers share them: neon_aop_hyperspectral opens
+remote reflectance hdf5 files with h5py through a RemoteFile. The raster functions (open_raster, read_window,
+read_mosaic_window) require rasterio 1.4 or later (pip install rasterio).
+
+Usage:
+
+    import neon_aop_remote
+    chm, transform = neon_aop_remote.read_window(chm_url, (705200, 4395300, 705400, 4395500))
+
+    cache = neon_aop_remote.BlockCache('./data/raster_cache', max_bytes=5*10**9)
+    with neon_aop_remote.open_raster(dtm_url, cache) as src:
+        print(src.profile)
+
+or through the development download module (tutorials-in-development/Python/AOP/python_modules/neon_aop_download.py), 
+which finds the tiles covering the window:
+
+    neon_api = neon_dl.AopApiHandler()
+    chm, transform = neon_api.read_aop_window('DP3.30015.001', 'ARIK', '2020', (705200, 4395300, 706400, 4395500))
+"""
+
+import io, os, hashlib, threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+
+# bytes per range request and cached block; NEON GeoTIFF tiles are a few MB, so a window usually
+# needs a handful of blocks
+REMOTE_BLOCK_SIZE = 256 * 2**10
+
+class BlockCache:
+    """
+    BlockCache keeps blocks of remote files on local disk, one file per block, shared by every
+    RemoteFile (and process) using the same folder
+    --------
+    Inputs (all optional):
+        cache_dir: cache folder; default is NEON_RASTER_CACHE, or ~/.neon_raster_cache
+        max_bytes: size limit; least recently used blocks are removed once it is exceeded; default = 2 GB
+    """
+    def __init__(self, cache_dir=None, max_bytes=2*10**9):
+        self.cache_dir = os.path.abspath(cache_dir or os.environ.get('NEON_RASTER_CACHE') or
+                                         os.path.join(os.path.expanduser('~'), '.neon_raster_cache'))
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._added = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(url, size, block_size, version=None):
+        # a file is identified by its host and path (not the query, which may hold a token or a signature),
+        # its size, the block size it was cut into and its version (the server's ETag or Last-Modified), so 
+        # the blocks of a file replaced by one of the same size are not served for it
+        parts = urlparse(url)
+        return hashlib.sha1((parts.netloc + parts.path + ':' + str(size) + ':' + str(block_size) + ':' + 
+                             str(version or '')).encode()).hexdigest()
+
+    def _path(self, key, index):
+        return os.path.join(self.cache_dir, key[:2], key, str(index))
+
+    def get(self, key, index):
+        path = self._path(key, index)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        # mark the block as recently used
+        os.utime(path)
+        return data
+
+    def put(self, key, index, data):
+        path = self._path(key, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._added += len(data)
+            added = self._added
+        # check the size every tenth of max_bytes written, rather than on every block
+        if self.max_bytes is not None and added >= self.max_bytes / 10:
+            self.evict()
+
+    def usage(self):
+        blocks = []
+        for folder, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                blocks.append((stat.st_mtime, stat.st_size, path))
+        return blocks
+
+    def evict(self, max_bytes=None):
+        # remove the least recently used blocks until the cache is no larger than max_bytes; returns bytes freed
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock:
+            self._added = 0
+        blocks = sorted(self.usage())
+        total = sum(size for _, size, _ in blocks)
+        freed = 0
+        for _, size, path in blocks:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            freed += size
+        return freed
+
+    def clear(self):
+        return self.evict(0)
+
+class RemoteFile(io.RawIOBase):
+    """
+    RemoteFile is a read-only, seekable file object over HTTP range requests; blocks are looked up in
+    memory, then in the BlockCache (if given), and only then fetched, each run of missing blocks with
+    a single request
+    --------
+    Inputs:
+        url: url of the file; a redirect (eg. from a NEON Data API file url to the storage bucket) is
+            followed once and its target is used for every range request
+        block_size (optional): bytes per block; default = 256 kB
+        cache (optional): BlockCache, or a cache folder
+        memory_blocks (optional): blocks also kept in memory (least recently used are dropped); default = 64
+        session (optional): requests.Session to send the requests with
+    --------
+    The requests, bytes fetched and blocks served from the disk cache are counted in requests,
+    bytes_fetched and cache_hits.
+    """
+    def __init__(self, url, block_size=REMOTE_BLOCK_SIZE, cache=None, memory_blocks=64, session=None):
+        super().__init__()
+        self.source_url = url
+        self.block_size = block_size
+        self.cache = BlockCache(cache) if isinstance(cache, str) else cache
+        self.memory_blocks = memory_blocks
+        self.session = session if session is not None else requests.Session()
+        self._blocks = OrderedDict()
+        self._pos = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+        self.cache_hits = 0
+        self._resolve()
+
+    def _resolve(self):
+        # a one-byte GET rather than a HEAD: signed storage urls are often only valid for GET
+        r = self.session.get(self.source_url, headers={'Range': 'bytes=0-0'}, stream=True)
+        try:
+            r.raise_for_status()
+            if r.status_code != 206 or 'Content-Range' not in r.headers:
+                raise IOError(self.source_url + ' does not support range requests')
+            self.url = r.url
+            self.size = int(r.headers['Content-Range'].split('/')[-1])
+            self.version = r.headers.get('ETag') or r.headers.get('Last-Modified')
+        finally:
+            r.close()
+        key = BlockCache.key(self.url, self.size, self.block_size, self.version)
+        if key != getattr(self, 'key', key):
+            # the file changed since it was opened: blocks read before are stale
+            self._blocks.clear()
+        self.key = key
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError('invalid whence: ' + str(whence))
+        return self._pos
+
+    def _get_range(self, start, end, attempts=3):
+        # bytes start..end (inclusive), retrying dropped connections, and an expired redirect target once
+        resolved = False
+        for attempt in range(attempts):
+            try:
+                r = self.session.get(self.url, headers={'Range': 'bytes=' + str(start) + '-' + str(end)})
+                if r.status_code in (400, 403) and not resolved and self.url != self.source_url:
+                    resolved = True
+                    self._resolve()
+                    continue
+                r.raise_for_status()
+                data = r.content
+                if r.status_code != 206 or len(data) != end - start + 1:
+                    raise IOError('unexpected response to range request for ' + self.source_url)
+                self.requests += 1
+                self.bytes_fetched += len(data)
+                return data
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                if attempt == attempts - 1:
+                    raise
+        raise IOError('range request for ' + self.source_url + ' failed')
+
+    def _keep(self, index, data):
+        self._blocks[index] = data
+        while len(self._blocks) > self.memory_blocks:
+            self._blocks.popitem(last=False)
+
+    def _fetch(self, first, last):
+        # blocks first..last, from memory, the disk cache or (a run of missing blocks per request) the server
+        blocks = {}
+        missing = []
+        for i in range(first, last + 1):
+            if i in self._blocks:
+                self._blocks.move_to_end(i)
+                blocks[i] = self._blocks[i]
+                continue
+            data = self.cache.get(self.key, i) if self.cache is not None else None
+            if data is not None:
+                self.cache_hits += 1
+                blocks[i] = data
+                self._keep(i, data)
+            else:
+                missing.append(i)
+        runs = []
+        for i in missing:
+            if runs and runs[-1][1] == i - 1:
+                runs[-1][1] = i
+            else:
+                runs.append([i, i])
+        for start, stop in runs:
+            data = self._get_range(start*self.block_size, min((stop + 1)*self.block_size, self.size) - 1)
+            for i in range(start, stop + 1):
+                offset = (i - start)*self.block_size
+                blocks[i] = data[offset:offset + self.block_size]
+                self._keep(i, blocks[i])
+                if self.cache is not None:
+                    self.cache.put(self.key, i, blocks[i])
+        return blocks
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+        view = memoryview(b).cast('B')
+        first = self._pos // self.block_size
+        last = (self._pos + n - 1) // self.block_size
+        blocks = self._fetch(first, last)
+        written = 0
+        while written < n:
+            i, offset = divmod(self._pos + written, self.block_size)
+            chunk = blocks[i][offset:offset + n - written]
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+        self._pos += n
+        return n
+
+def _coerce_cache(cache):
+    return BlockCache(cache) if isinstance(cache, str) else cache
+
+def open_raster(url, cache=None, block_size=REMOTE_BLOCK_SIZE, session=None):
+    """
+    open_raster opens a remote GeoTIFF with rasterio, reading it through a RemoteFile; returns the
+    rasterio dataset (use it in a with statement)
+    --------
+    Inputs:
+        url: url of the tile
+        cache (optional): BlockCache or cache folder; default (None) is the default BlockCache; pass
+            False to only cache in memory
+    """
+    import rasterio
+    cache = BlockCache() if cache is None else (None if cache is False else _coerce_cache(cache))
+    session = session if session is not None else requests.Session()
+    def opener(path, mode='rb'):
+        # GDAL also asks for sidecar files (.aux.xml, .ovr, ...), and rasterio probes the opener when it is 
+        # registered; only the tile itself is remote
+        if path != url:
+            raise FileNotFoundError(path)
+        if 'r' not in mode:
+            raise IOError('remote rasters are read-only')
+        return RemoteFile(path, block_size, cache, session=session)
+    return rasterio.open(url, opener=opener)
+
+def read_window(url, bounds, band=1, cache=None, block_size=REMOTE_BLOCK_SIZE):
+    """
+    read_window reads the (xmin, ymin, xmax, ymax) window of a remote GeoTIFF tile, in the tile's
+    coordinates; returns (array, transform of the window)
+    --------
+    Inputs:
+        url: url of the tile
+        bounds: (xmin, ymin, xmax, ymax); the part outside the tile is filled with the tile's nodata value
+        band (optional): band number, or a list of band numbers; default = 1
+        cache, block_size (optional): as for open_raster
+    --------
+    Usage:
+    --------
+    chm, transform = read_window(chm_url, (705200, 4395300, 705400, 4395500))
+    """
+    from rasterio.windows import from_bounds
+    with open_raster(url, cache, block_size) as src:
+        window = from_bounds(*bounds, transform=src.transform).round_offsets().round_lengths()
+        return src.read(band, window=window, boundless=True), src.window_transform(window)
+
+def read_mosaic_window(urls, bounds, band=1, cache=None, block_size=REMOTE_BLOCK_SIZE):
+    """
+    read_mosaic_window reads the (xmin, ymin, xmax, ymax) window across several remote tiles (eg. every
+    tile of a product intersecting it) as a single array; only the blocks of each tile covering the
+    window are fetched; returns (array, transform)
+    """
+    from rasterio.merge import merge
+    cache = BlockCache() if cache is None else (None if cache is False else _coerce_cache(cache))
+    indexes = [band] if isinstance(band, int) else list(band)
+    datasets = [open_raster(url, cache if cache is not None else False, block_size) for url in urls]
+    try:
+        array, transform = merge(datasets, bounds=bounds, indexes=indexes)
+    finally:
+        for dataset in datasets:
+            dataset.close()
+    return (array[0] if isinstance(band, int) else array), transform
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import os, json, zipfile
+
+import requests
+
+import neon_mock_api
+import neon_aop_download_functions as neon_dl
+
+def first_file(mock):
+    doc = requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2019-08').json()
+    file_info = doc['data']['files'][0]
+    return file_info, requests.get(file_info['url']).content
+
+def file_names(mock):
+    doc = requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2019-08').json()
+    return [f['name'] for f in doc['data']['files']]
+
+def test_download_resumes_from_a_part_file(mock_api, tmp_path):
+    mock = mock_api()
+    file_info, payload = first_file(mock)
+    filename = str(tmp_path / file_info['name'])
+    with open(filename + '.part', 'wb') as f:
+        f.write(payload[:4000])
+    mock.reset_stats()
+    assert neon_dl.download_file(file_info['url'], filename, file_info['size'], md5=file_info['md5'])
+    assert mock.stats()['bytes_sent'] == len(payload) - 4000
+    with open(filename, 'rb') as f:
+        assert f.read() == payload
+    assert not os.path.exists(filename + '.part')
+
+def test_a_complete_part_file_is_finished_without_its_size(mock_api, tmp_path):
+    mock = mock_api()
+    file_info, payload = first_file(mock)
+    filename = str(tmp_path / file_info['name'])
+    with open(filename + '.part', 'wb') as f:
+        f.write(payload)
+    mock.reset_stats()
+    # the Range request past the end gets a 416, with the file's size in Content-Range
+    assert neon_dl.download_file(file_info['url'], filename, md5=file_info['md5'])
+    assert mock.stats()['bytes_sent'] == 0
+    assert os.path.getsize(filename) == len(payload) and not os.path.exists(filename + '.part')
+
+def test_a_stale_part_file_longer_than_the_file_is_replaced(mock_api, tmp_path):
+    mock = mock_api()
+    file_info, payload = first_file(mock)
+    filename = str(tmp_path / file_info['name'])
+    with open(filename + '.part', 'wb') as f:
+        f.write(payload + b'stale')
+    assert neon_dl.download_file(file_info['url'], filename, md5=file_info['md5'])
+    with open(filename, 'rb') as f:
+        assert f.read() == payload
+
+def test_download_urls_writes_a_manifest_only_when_verifying(mock_api, tmp_path):
+    mock = mock_api()
+    url = mock.base_url + 'data/DP3.30015.001/JORN/2019-08'
+    neon_dl.download_urls([url], str(tmp_path / 'plain') + '/')
+    assert sorted(os.listdir(tmp_path / 'plain' / '2019-08')) == sorted(file_names(mock))
+    neon_dl.download_urls([url], str(tmp_path / 'verified') + '/', verify=True)
+    assert 'neon_manifest.json' in os.listdir(tmp_path / 'verified' / '2019-08')
+
+def test_sync_downloads_only_new_or_changed_files(mock_api, tmp_path, monkeypatch):
+    mock = mock_api()
+    monkeypatch.setattr(neon_dl, 'NEON_API_URL', mock.base_url)
+    folder = str(tmp_path / 'chm')
+    summary = neon_dl.download_aop_files('DP3.30015.001', 'JORN', '2019', folder, check_size=False, sync=True)
+    assert summary['files'] == 4
+
+    mock.reset_stats()
+    summary = neon_dl.download_aop_files('DP3.30015.001', 'JORN', '2019', folder, check_size=False, sync=True)
+    assert summary['files'] == 0 and mock.stats()['bytes_sent'] == 0
+
+    # a file changed on disk is checked against its md5 and downloaded again
+    name = sorted(file_names(mock))[0]
+    with open(os.path.join(folder, name), 'r+b') as f:
+        f.write(b'\0')
+    summary = neon_dl.download_aop_files('DP3.30015.001', 'JORN', '2019', folder, check_size=False, sync=True)
+    assert summary['files'] == 1 and mock.stats()['bytes_sent'] == 10**4
+
+def test_requests_reuse_the_pooled_session(mock_api, tmp_path, monkeypatch):
+    mock = mock_api()
+    monkeypatch.setattr(neon_dl, 'NEON_API_URL', mock.base_url)
+    session = neon_dl.configure_session(pool_size=4)
+    neon_dl.download_aop_files('DP3.30015.001', 'JORN', '2019', str(tmp_path), check_size=False)
+    assert neon_dl.get_session() is session
+    # the catalog, the listing and the four files over one keep-alive connection
+    pools = session.adapters['http://'].poolmanager.pools
+    assert [(pools[key].num_requests, pools[key].num_connections) for key in pools.keys()] == [(6, 1)]
+
+def zip_fixtures(tmp_path):
+    # a zipped product (like the L1 spectrometer or lidar QA zips), served from tmp_path/payload
+    payload_dir = tmp_path / 'payload'
+    payload_dir.mkdir()
+    name = 'NEON_D14_JORN_DP1_20190807_QA.zip'
+    with zipfile.ZipFile(payload_dir / name, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('QA/summary.csv', 'tile,rmse\n' * 2000)
+        z.writestr('QA/report.pdf', os.urandom(50000), compress_type=zipfile.ZIP_STORED)
+        z.writestr('QA/metadata/processing.xml', '<processing/>' * 500)
+    fixtures = neon_mock_api.synthetic_fixtures({'DP1.30003.001': {'JORN': {'2019-08': [(name, 1)]}}})
+    return fixtures, str(payload_dir), name
+
+def test_zip_members_are_extracted_while_streaming(mock_api, tmp_path):
+    fixtures, payload_dir, name = zip_fixtures(tmp_path)
+    mock = mock_api(fixtures, payload_dir=payload_dir)
+    url = mock.base_url + 'data/DP1.30003.001/JORN/2019-08'
+    root = str(tmp_path / 'data') + '/'
+    neon_dl.download_urls([url], root, extract=True, members=['*.csv', 'processing.xml'], verify=True)
+    folder = tmp_path / 'data' / '2019-08'
+    assert (folder / 'QA' / 'summary.csv').read_text() == 'tile,rmse\n' * 2000
+    assert (folder / 'QA' / 'metadata' / 'processing.xml').exists()
+    assert not (folder / 'QA' / 'report.pdf').exists() and not (folder / name).exists()
+    with open(folder / 'neon_manifest.json') as f:
+        assert json.load(f)[name]['verified']
+
+def test_zip_extraction_resumes_after_dropped_connections(mock_api, tmp_path):
+    fixtures, payload_dir, name = zip_fixtures(tmp_path)
+    mock = mock_api(fixtures, payload_dir=payload_dir, drop_rate=0.5, seed=3)
+    file_info = requests.get(mock.base_url + 'data/DP1.30003.001/JORN/2019-08').json()['data']['files'][0]
+    extracted, verified = neon_dl.download_zip_extract(file_info['url'], str(tmp_path / 'out'), md5=file_info['md5'],
+                                                       max_retries=20)
+    assert verified and mock.stats()['drops'] > 0
+    with zipfile.ZipFile(os.path.join(payload_dir, name)) as z:
+        assert sorted(os.path.relpath(path, tmp_path / 'out').replace(os.sep, '/') for path in extracted) == sorted(z.namelist())
+        assert (tmp_path / 'out' / 'QA' / 'report.pdf').read_bytes() == z.read('QA/report.pdf')
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import h5py
+import numpy as np
+import requests
+
+import neon_mock_api
+from neon_aop_hyperspectral import aop_h5refl2array
+
+NAME = 'NEON_D14_JORN_DP3_314000_3610000_reflectance.h5'
+
+def write_reflectance(filename, nrows=100, ncols=100, nbands=40):
+    # a small reflectance file in the NEON layout, chunked like the real ones
+    data = np.arange(nrows * ncols * nbands, dtype=np.int16).reshape(nrows, ncols, nbands)
+    with h5py.File(filename, 'w') as f:
+        refl = f.create_group('JORN/Reflectance')
+        refl.attrs['Band_Window_1_Nanometers'] = [1340, 1445]
+        refl.attrs['Band_Window_2_Nanometers'] = [1790, 1955]
+        dataset = refl.create_dataset('Reflectance_Data', data=data, chunks=(10, 10, nbands))
+        dataset.attrs['Data_Ignore_Value'] = -9999.0
+        dataset.attrs['Scale_Factor'] = 10000.0
+        refl['Metadata/Spectral_Data/Wavelength'] = np.linspace(400, 2500, nbands)
+        coords = refl.create_group('Metadata/Coordinate_System')
+        coords['Proj4'] = '+proj=utm +zone=13 +ellps=WGS84 +datum=WGS84 +units=m +no_defs'
+        coords['EPSG Code'] = '32613'
+        coords['Map_Info'] = 'UTM,  1.000,  1.000,  314000.00,  3611000.0,  1.0000000,  1.0000000,  13,  North,  WGS-84,  units=Meters'
+    return data
+
+def test_remote_subset_and_metadata_reads(mock_api, tmp_path):
+    data = write_reflectance(str(tmp_path / NAME))
+    fixtures = neon_mock_api.synthetic_fixtures({'DP3.30006.001': {'JORN': {'2019-08': [(NAME, 1)]}}})
+    mock = mock_api(fixtures, payload_dir=str(tmp_path))
+    doc = requests.get(mock.base_url + 'data/DP3.30006.001/JORN/2019-08').json()
+    url = doc['data']['files'][0]['url']
+
+    spectrum, metadata, wavelengths = aop_h5refl2array(url, 'Reflectance', pixels=(12, 7), bands=[2, 5, 9],
+                                                    block_size=2**12)
+    assert list(spectrum) == list(data[12, 7, [2, 5, 9]])
+    assert list(metadata['band_indices']) == [2, 5, 9] and len(wavelengths) == 3
+
+    sent = mock.stats()['bytes_sent']
+    raster, metadata, wavelengths = aop_h5refl2array(url, 'Reflectance', only_metadata=True, block_size=2**12)
+    assert raster is None and metadata['shape'] == data.shape and len(wavelengths) == 40
+    # the header and metadata only: a small part of the raster
+    assert mock.stats()['bytes_sent'] - sent < data.nbytes / 10
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import requests
+
+import neon_mock_api
+from neon_aop_remote import BlockCache, RemoteFile, read_window, read_mosaic_window
+from conftest import chm_fixtures
+
+def test_remote_file_reads_ranges_through_the_block_cache(mock_api, tmp_path):
+    mock = mock_api(chm_fixtures(size=10**5))
+    doc = requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2019-08').json()
+    url = doc['data']['files'][0]['url']
+    payload = requests.get(url).content
+    cache = BlockCache(str(tmp_path / 'cache'))
+
+    remote = RemoteFile(url, block_size=2**14, cache=cache)
+    remote.seek(30000)
+    assert remote.read(5000) == payload[30000:35000]
+    assert remote.requests == 1 and remote.bytes_fetched == 2 * 2**14
+
+    # a second reader of the same file gets the blocks from the disk cache
+    again = RemoteFile(url, block_size=2**14, cache=cache)
+    again.seek(30000)
+    assert again.read(5000) == payload[30000:35000]
+    assert again.requests == 0 and again.cache_hits == 2
+
+def test_block_cache_keys_follow_the_file_version():
+    url = 'https://storage.googleapis.com/neon-aop-products/2019/CHM.tif?signature=abc'
+    assert BlockCache.key(url, 100, 16) == BlockCache.key(url.split('?')[0], 100, 16)
+    assert BlockCache.key(url, 100, 16, '"etag-1"') != BlockCache.key(url, 100, 16, '"etag-2"')
+
+def write_chm(filename, xmin, ymin, size=1000):
+    # a 1 m CHM tile with internal 256 x 256 tiles; each pixel holds its easting + northing / 10**7
+    import rasterio
+    from rasterio.transform import from_origin
+    x = xmin + np.arange(size) + 0.5
+    y = ymin + size - np.arange(size) - 0.5
+    data = (x[None, :] + y[:, None] / 10**7).astype(np.float64)
+    with rasterio.open(filename, 'w', driver='GTiff', width=size, height=size, count=1, dtype='float64',
+                       crs='EPSG:32613', transform=from_origin(xmin, ymin + size, 1, 1), nodata=-9999,
+                       tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(data, 1)
+    return data
+
+def serve_chm_tiles(mock_api, folder, ncols=2):
+    names = neon_mock_api.aop_tile_names('D14', 'JORN', 'DP3', 'CHM.tif', 314000, 3610000, ncols, 1)
+    for i, name in enumerate(names):
+        write_chm(str(folder / name), 314000 + 1000*i, 3610000)
+    fixtures = neon_mock_api.synthetic_fixtures({'DP3.30015.001': {'JORN': {'2019-08': [(n, 1) for n in names]}}})
+    mock = mock_api(fixtures, payload_dir=str(folder))
+    doc = requests.get(mock.base_url + 'data/DP3.30015.001/JORN/2019-08').json()
+    return mock, sorted(f['url'] for f in doc['data']['files'])
+
+def test_read_window_fetches_only_the_blocks_it_needs(mock_api, tmp_path):
+    mock, urls = serve_chm_tiles(mock_api, tmp_path)
+    cache = str(tmp_path / 'cache')
+    mock.reset_stats()
+    chm, transform = read_window(urls[0], (314200, 3610300, 314250, 3610320), cache=cache, block_size=2**15)
+    assert chm.shape == (20, 50) and (transform.c, transform.f) == (314200, 3610320)
+    assert chm[0, 0] == 314200.5 + 3610319.5 / 10**7 and chm[-1, -1] == 314249.5 + 3610300.5 / 10**7
+    # the header and one internal tile, not the 8 MB file
+    sent = mock.stats()['bytes_sent']
+    assert sent < 8 * 10**6 / 10
+    # read again: every block comes from the cache, only the one-byte version checks go out
+    again, _ = read_window(urls[0], (314200, 3610300, 314250, 3610320), cache=cache, block_size=2**15)
+    assert (again == chm).all() and mock.stats()['bytes_sent'] - sent < 10
+
+def test_read_mosaic_window_across_tiles(mock_api, tmp_path):
+    mock, urls = serve_chm_tiles(mock_api, tmp_path)
+    chm, transform = read_mosaic_window(urls, (314990, 3610500, 315010, 3610510), cache=str(tmp_path / 'cache'),
+                                        block_size=2**15)
+    assert chm.shape == (10, 20) and (transform.c, transform.f) == (314990, 3610510)
+    # eastings run on across the tile edge
+    assert list(np.floor(chm[0])) == list(np.arange(314990, 315010))